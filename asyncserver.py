@@ -0,0 +1,701 @@
+# An alternative to webserver.py (gunicorn + gevent + flask): the same
+#   HTTP API, served by asyncio directly.  Select it with
+#   KAFKA_PROXY_SERVER=asyncio (see run-kafka-proxy.sh), or run it by hand:
+#
+#   python asyncserver.py --port 8080 --workers 4
+#
+# It understands the same environment variables as webserver.py, but reads
+#   them once at startup.  The differences from webserver.py:
+#
+#   * HTTP/1.1 is spoken by hand (see _read_request).  Connections are
+#     kept alive, and pipelined requests are answered in order, one at a
+#     time; a client can have its next POST on its way while the last one
+#     is being answered.  Bodies may be sent with a Content-Length or
+#     chunked.
+#
+#   * Flusher connections are asyncio streams (see AsyncFlusherPool), so a
+#     worker process never blocks waiting for a flusher, and is only ever
+#     doing one thing (parsing, or writing to a socket) at a time.  The
+#     shared-memory ring (ring.py) is used the same way.
+#
+#   * A compressed body, or an uncompressed body that's bigger than
+#     KAFKA_PROXY_STREAM_THRESHOLD (or chunked), is streamed to the flusher
+#     as it comes in, with the same chunk boundaries as webserver.py (so
+#     batch IDs of chunks mean the same thing).  A compressed body is fed
+#     to the decompressor a piece at a time as it's read (see
+#     compression.Decompressor), so neither it nor what it decompresses to
+#     is ever all in memory.
+#
+#   * With --workers N (N > 1), the main process opens the listening socket,
+#     forks N worker processes that all accept connections on it, and
+#     starts a new worker if one dies.
+#
+# Everything else (checking requests, the responses, and the metrics) is
+#   in ingest.py, shared with webserver.py, so the responses (status, text,
+#   and headers) are the same as webserver.py's for the same requests.
+
+import os
+import sys
+import ssl
+import json
+import time
+import http
+import signal
+import socket
+import asyncio
+import logging
+import argparse
+import collections
+import urllib.parse
+
+import flusherproto
+import compression
+import avroencode
+import ingest
+
+_logger = logging.getLogger(__name__)
+_logger.propagate = False
+if not _logger.hasHandlers():
+    _logout = logging.StreamHandler( sys.stderr )
+    _logger.addHandler( _logout )
+    _formatter = logging.Formatter( '[%(asctime)s - asyncserver %(process)d - %(levelname)s] - %(message)s',
+                                    datefmt='%Y-%m-%d %H:%M:%S' )
+    _logout.setFormatter( _formatter )
+    _logger.setLevel( logging.INFO )
+
+
+def _share_metrics():
+    # See webserver.py
+    ingest.share_metrics( _logger )
+
+
+# Request headers (the request line and headers together) can be at most
+#   this big
+MAX_HEADER_SIZE = 65536
+# When a response goes out before the request body was read (e.g. a wrong
+#   token), a body up to this big is read and thrown away so the
+#   connection can be kept; with a bigger one, the connection is closed.
+MAX_DISCARD_SIZE = 1048576
+
+
+class AsyncFlusherPool:
+    # Like webserver.FlusherConnectionPool, but with asyncio streams.
+    #   Every connection is used for one frame and its reply at a time, so
+    #   as many requests can be waiting on the flusher at once as there
+    #   are connections; up to maxidle are kept between requests.
+    def __init__( self, socket_file, timeout=2, maxidle=8, maxidleage=60 ):
+        self.socket_file = socket_file
+        self.timeout = timeout
+        self.maxidle = maxidle
+        self.maxidleage = maxidleage
+        self.idle = collections.deque()
+
+    async def _connect( self ):
+        return await asyncio.wait_for( asyncio.open_unix_connection( self.socket_file ), self.timeout )
+
+    async def _checkout( self ):
+        now = time.monotonic()
+        while len( self.idle ) > 0:
+            reader, writer, lastused = self.idle.pop()
+            # An idle connection should have nothing to read; if the
+            #   flusher went away, we'll have seen EOF
+            if ( now - lastused < self.maxidleage ) and ( not reader.at_eof() ) and ( not writer.is_closing() ):
+                return reader, writer, True
+            writer.close()
+        reader, writer = await self._connect()
+        return reader, writer, False
+
+    def _checkin( self, reader, writer ):
+        if len( self.idle ) < self.maxidle:
+            self.idle.append( ( reader, writer, time.monotonic() ) )
+        else:
+            writer.close()
+
+    @staticmethod
+    async def _exchange( reader, writer, verb, payload, flags ):
+        paylen = sum( memoryview( b ).nbytes for b in payload )
+        writer.write( flusherproto.pack_header( verb, paylen, flags ) )
+        for buf in payload:
+            writer.write( buf )
+        await writer.drain()
+        try:
+            header = await reader.readexactly( flusherproto.HEADER.size )
+            respverb, _flags, paylen = flusherproto.unpack_header( header )
+            resp = ( await reader.readexactly( paylen ) ) if paylen > 0 else b''
+        except asyncio.IncompleteReadError as ex:
+            raise ConnectionError( f"Flusher closed the connection after {len(ex.partial)} bytes of reply" )
+        return respverb, resp
+
+    async def request( self, verb, payload=b'', flags=0, timeout=None ):
+        # Send one frame to the flusher (see flusherproto.py) and return the
+        #   verb and payload of the flusher's reply.  payload may be a list
+        #   of bytes-like objects.  Raises TimeoutError if there's no reply
+        #   within timeout (or self.timeout) seconds.
+        if not isinstance( payload, list ):
+            payload = [ payload ]
+        timeout = self.timeout if timeout is None else timeout
+        reader, writer, reused = await self._checkout()
+        try:
+            try:
+                respverb, resp = await asyncio.wait_for( self._exchange( reader, writer, verb, payload, flags ),
+                                                         timeout )
+            except ConnectionError:
+                if not reused:
+                    raise
+                # The flusher probably restarted since this connection was
+                #   last used; try again once on a new connection.
+                writer.close()
+                reader, writer = await self._connect()
+                respverb, resp = await asyncio.wait_for( self._exchange( reader, writer, verb, payload, flags ),
+                                                         timeout )
+        except BaseException:
+            # Who knows what state the connection is in now
+            writer.close()
+            raise
+        self._checkin( reader, writer )
+        return respverb, resp
+
+
+class AsyncFlusherShards( ingest.ShardRouting ):
+    # webserver.FlusherShards, with the requests to flushers awaited
+    def __init__( self, config, downtime=5 ):
+        socket_files, ringpaths = ingest.shard_paths( config.socket_file, config.nshards, config.ringpath )
+        rings = None if ringpaths is None else [ ingest.flusher_ring( r, _logger ) for r in ringpaths ]
+        super().__init__( socket_files, config.comm_timeout, rings, _logger, downtime=downtime )
+        self.pools = [ AsyncFlusherPool( f, timeout=self.timeout, maxidle=config.pool_size ) for f in socket_files ]
+
+    async def request( self, verb, payload=b'', flags=0, timeout=None, shard=None ):
+        busy = None
+        lastex = None
+        for i in self.order( shard ):
+            try:
+                respverb, resp = await self.pools[i].request( verb, payload, flags, timeout )
+            except ( ConnectionError, FileNotFoundError ) as ex:
+                self.unreachable( i, ex )
+                lastex = ex
+                continue
+            if self.settle( i, respverb, flags ):
+                return respverb, resp
+            busy = ( respverb, resp )
+
+        if busy is not None:
+            return busy
+        raise lastex
+
+    async def send_messages( self, payload, nmsgs, topic=None, flags=0, wait=None, batchid=None ):
+        # See webserver.FlusherShards.send_messages
+        reply, payload, flags, timeout, shard = self.route_messages( payload, nmsgs, topic, flags, wait, batchid )
+        if reply is not None:
+            return reply
+        return await self.request( b'MSGS', payload, flags, timeout=timeout, shard=shard )
+
+    async def broadcast( self, verb, payload=b'' ):
+        # Send the same frame to every shard at once.  Returns a list of
+        #   ( socket_file, verb, payload ) of the replies; verb is None and
+        #   payload is the exception if a shard couldn't be reached.
+        async def one( socket_file, pool ):
+            try:
+                return ( socket_file, *await pool.request( verb, payload ) )
+            except Exception as ex:
+                return ( socket_file, None, ex )
+        return await asyncio.gather( *[ one( f, p ) for f, p in zip( self.socket_files, self.pools ) ] )
+
+
+class BadRequest( Exception ):
+    pass
+
+
+class Request:
+    # One HTTP request: the request line and headers, and (through read())
+    #   the body
+    def __init__( self, method, target, version, headers, reader ):
+        self.method = method
+        self.path, _, self.query = target.partition( '?' )
+        self.version = version
+        # Header names are lower case.  (If a header is given more than
+        #   once, the last one wins.)
+        self.headers = headers
+        self.reader = reader
+        self.continued = False
+        self.writer = None
+
+        connection = headers.get( 'connection', '' ).lower()
+        if version == 'HTTP/1.0':
+            self.keepalive = 'keep-alive' in connection
+        else:
+            self.keepalive = 'close' not in connection
+
+        self.content_length = None
+        self.chunked = 'chunked' in headers.get( 'transfer-encoding', '' ).lower()
+        if not self.chunked:
+            try:
+                self.content_length = int( headers.get( 'content-length', '0' ) )
+                if self.content_length < 0:
+                    raise ValueError( "negative" )
+            except ValueError:
+                raise BadRequest( f"Bad Content-Length {headers.get('content-length')}" )
+        self.remaining = self.content_length
+        self.chunkleft = 0
+        self.done = ( self.content_length == 0 )
+
+    @property
+    def content_type( self ):
+        return self.headers.get( 'content-type' )
+
+    @property
+    def mimetype( self ):
+        # The content type without parameters (like flask's)
+        return ( self.content_type or '' ).partition( ';' )[0].strip().lower()
+
+    async def _continue( self ):
+        # A client that sent "Expect: 100-continue" waits for this before
+        #   sending the body
+        if ( not self.continued ) and ( self.headers.get( 'expect', '' ).lower() == '100-continue' ):
+            self.writer.write( f"{self.version} 100 Continue\r\n\r\n".encode( 'latin-1' ) )
+            await self.writer.drain()
+        self.continued = True
+
+    async def read( self, n=65536 ):
+        # Return up to n more bytes of the body; b'' at the end of it.
+        #   Raises ConnectionError if the client goes away before the end,
+        #   and BadRequest if the chunked encoding is broken.
+        if self.done:
+            return b''
+        await self._continue()
+        try:
+            if not self.chunked:
+                data = await self.reader.read( min( n, self.remaining ) )
+                if len( data ) == 0:
+                    raise ConnectionError( f"Client closed the connection with {self.remaining} bytes "
+                                           f"of the body to go" )
+                self.remaining -= len( data )
+                self.done = ( self.remaining == 0 )
+                return data
+
+            if self.chunkleft == 0:
+                line = await self.reader.readuntil( b'\r\n' )
+                try:
+                    self.chunkleft = int( line.split( b';', 1 )[0].strip(), 16 )
+                except ValueError:
+                    raise BadRequest( f"Bad chunk size {line[:20]}" )
+                if self.chunkleft == 0:
+                    # The last chunk; skip any trailers
+                    while ( await self.reader.readuntil( b'\r\n' ) ) != b'\r\n':
+                        pass
+                    self.done = True
+                    return b''
+            data = await self.reader.read( min( n, self.chunkleft ) )
+            if len( data ) == 0:
+                raise ConnectionError( "Client closed the connection in the middle of a chunk" )
+            self.chunkleft -= len( data )
+            if self.chunkleft == 0:
+                if ( await self.reader.readexactly( 2 ) ) != b'\r\n':
+                    raise BadRequest( "Chunk not followed by CRLF" )
+            return data
+        except ( asyncio.IncompleteReadError, asyncio.LimitOverrunError ) as ex:
+            raise ConnectionError( f"Body ended early: {ex}" )
+
+    async def read_all( self, limit ):
+        # The whole body, as a bytearray.  Raises compression.BodyTooLarge
+        #   if it's more than limit bytes.
+        if ( self.content_length is not None ) and ( self.content_length > limit ):
+            raise compression.BodyTooLarge( f"Body is {self.content_length} bytes, more than the "
+                                            f"maximum of {limit}" )
+        body = bytearray()
+        while True:
+            data = await self.read( max( 65536, self.remaining or 0 ) )
+            if len( data ) == 0:
+                return body
+            body += data
+            if len( body ) > limit:
+                raise compression.BodyTooLarge( f"Body is more than the maximum of {limit} bytes" )
+
+    async def discard( self ):
+        # Read and throw away the rest of the body, so the next request on
+        #   the connection can be read.  Returns False if that's not worth
+        #   doing (the connection should be closed instead).
+        if self.done:
+            return True
+        if ( not self.continued ) and ( self.headers.get( 'expect', '' ).lower() == '100-continue' ):
+            # The client hasn't sent the body, and won't now
+            return False
+        if ( self.content_length is None ) or ( self.remaining > MAX_DISCARD_SIZE ):
+            return False
+        try:
+            while len( await self.read() ) > 0:
+                pass
+        except ( ConnectionError, BadRequest ):
+            return False
+        return True
+
+
+async def _read_request( reader ):
+    # Read the request line and headers of the next request on a
+    #   connection.  Returns None if the client closed the connection
+    #   instead of sending another request.
+    try:
+        head = await reader.readuntil( b'\r\n\r\n' )
+    except asyncio.IncompleteReadError as ex:
+        if len( ex.partial.strip() ) == 0:
+            return None
+        raise BadRequest( "Connection closed in the middle of the request headers" )
+    except asyncio.LimitOverrunError:
+        raise BadRequest( f"Request headers are more than {MAX_HEADER_SIZE} bytes" )
+
+    lines = head.decode( 'latin-1' ).split( '\r\n' )
+    # Clients may send blank lines between requests
+    while ( len( lines ) > 0 ) and ( lines[0] == '' ):
+        lines.pop( 0 )
+    try:
+        method, target, version = lines[0].split( ' ' )
+    except ( ValueError, IndexError ):
+        raise BadRequest( "Bad request line" )
+    if version not in ( 'HTTP/1.0', 'HTTP/1.1' ):
+        raise BadRequest( f"Unsupported HTTP version {version}" )
+    headers = {}
+    for line in lines[1:]:
+        if len( line ) == 0:
+            continue
+        name, sep, value = line.partition( ':' )
+        if ( len( sep ) == 0 ) or ( name != name.strip() ):
+            raise BadRequest( "Bad header line" )
+        headers[ name.lower() ] = value.strip()
+    return Request( method, target, version, headers, reader )
+
+
+def _render_response( version, resp, keepalive ):
+    # resp is what a handler returns, the way a flask view would: ( body,
+    #   status ) or ( body, status, headers ), where body is a str (sent
+    #   as text/html, like flask does) or a dict (sent as JSON)
+    body, status, *headers = resp
+    headers = { k.lower(): v for k, v in ( headers[0] if len( headers ) > 0 else {} ).items() }
+    if isinstance( body, dict ):
+        body = json.dumps( body ) + "\n"
+        headers.setdefault( 'content-type', 'application/json' )
+    else:
+        headers.setdefault( 'content-type', 'text/html; charset=utf-8' )
+    body = body.encode( 'utf-8' )
+    try:
+        reason = http.HTTPStatus( status ).phrase
+    except ValueError:
+        reason = "Unknown"
+    lines = [ f"{version} {status} {reason}",
+              f"Content-Length: {len(body)}",
+              f"Connection: {'keep-alive' if keepalive else 'close'}" ]
+    lines += [ f"{k}: {v}" for k, v in headers.items() ]
+    return ( "\r\n".join( lines ) + "\r\n\r\n" ).encode( 'latin-1' ) + body
+
+
+class IngestServer:
+    def __init__( self, config ):
+        self.config = config
+        self.shards = AsyncFlusherShards( config )
+
+    async def handle_connection( self, reader, writer ):
+        # Requests are read and answered one after another, so the
+        #   responses to pipelined requests go out in the order the
+        #   requests came in
+        try:
+            while True:
+                try:
+                    request = await _read_request( reader )
+                except BadRequest as ex:
+                    writer.write( _render_response( 'HTTP/1.1', ( f"Error, {ex}", 400 ), False ) )
+                    await writer.drain()
+                    return
+                if request is None:
+                    return
+                request.writer = writer
+
+                try:
+                    resp = await self.route( request )
+                except BadRequest as ex:
+                    request.keepalive = False
+                    resp = f"Error, {ex}", 400
+                if not await request.discard():
+                    request.keepalive = False
+                writer.write( _render_response( request.version, resp, request.keepalive ) )
+                await writer.drain()
+                if not request.keepalive:
+                    return
+        except ( ConnectionError, asyncio.IncompleteReadError ) as ex:
+            _logger.debug( f"Connection lost: {ex}" )
+        except Exception as ex:
+            _logger.exception( ex )
+        finally:
+            writer.close()
+
+    async def route( self, request ):
+        parts = [ urllib.parse.unquote( p ) for p in request.path.strip( '/' ).split( '/' ) ]
+        if parts == [ '' ]:
+            parts = []
+
+        if ( len( parts ) == 1 ) and ( parts[0] == 'metrics' ):
+            if request.method != 'GET':
+                return "Method not allowed", 405, { 'Allow': 'GET' }
+            return await self.handle_metrics( request )
+
+        if len( parts ) == 0:
+            handler, args = self.handle_messages, ( None, )
+        elif ( len( parts ) == 2 ) and ( parts[0] == 'topics' ):
+            handler, args = self.handle_messages, ( parts[1], )
+        elif ( len( parts ) == 2 ) and ( parts[0] == 'avro' ):
+            handler, args = self.handle_messages, ( None, parts[1] )
+        elif ( len( parts ) == 4 ) and ( parts[0] == 'topics' ) and ( parts[2] == 'avro' ):
+            handler, args = self.handle_messages, ( parts[1], parts[3] )
+        elif ( len( parts ) == 2 ) and ( parts[0] in ingest.TOPIC_VERBS ):
+            handler, args = self.handle_topic, ( ingest.TOPIC_VERBS[ parts[0] ], parts[1] )
+        else:
+            return "Not found", 404
+        if request.method != 'POST':
+            return "Method not allowed", 405, { 'Allow': 'POST' }
+        return await handler( request, *args )
+
+    async def handle_messages( self, request, topic, schema=None ):
+        t0 = time.perf_counter()
+        try:
+            resp = await self.handle_post( request, topic, schema )
+        except BaseException:
+            ingest.requests['500'].inc()
+            raise
+        ingest.request_seconds.observe( time.perf_counter() - t0 )
+        ingest.requests.get( str( resp[1] ), ingest.requests['other'] ).inc()
+        return resp
+
+    async def handle_post( self, request, topic, schema=None ):
+        # See webserver.HandleRequest.handle_post
+        config = self.config
+        err, post = ingest.check_post( config, request.headers, request.content_type, request.mimetype,
+                                       topic, schema )
+        if err is not None:
+            return err
+
+        if schema is not None:
+            return await self.handle_avro( request, post, schema )
+
+        if post.encoding is not None:
+            try:
+                decompressor = compression.Decompressor( post.encoding, config.max_decompressed_size )
+            except compression.CompressionError as ex:
+                return ingest.body_error( ex, _logger )
+            return await self.dispatch_stream( post, self._body_chunks( request, decompressor ) )
+
+        if ( request.content_length is None ) or ( request.content_length > config.stream_threshold ):
+            return await self.dispatch_stream( post, self._body_chunks( request ) )
+
+        try:
+            data = memoryview( await request.read_all( config.stream_threshold ) )
+        except BadRequest as ex:
+            request.keepalive = False
+            return f"Error, {ex}", 400
+        err, nmsgs = ingest.check_messages( data, post.flags, _logger )
+        if err is not None:
+            return err
+
+        status = bytearray()
+        err, duplicate = await self.forward_messages( post, data, nmsgs, post.wait, status, post.batchid )
+        if err is not None:
+            return err
+        return ingest.post_response( post, nmsgs, status, duplicate, _logger )
+
+    async def _body_pieces( self, request, decompressor=None ):
+        # The body as it comes in; if there's a decompressor (a
+        #   compression.Decompressor), each piece read is fed to it as soon
+        #   as it's read, and what comes out comes out
+        while True:
+            data = await request.read()
+            if len( data ) == 0:
+                break
+            if decompressor is None:
+                yield data
+            else:
+                for piece in decompressor.feed( data ):
+                    yield piece
+        if decompressor is not None:
+            decompressor.end()
+
+    async def _body_chunks( self, request, decompressor=None ):
+        # The body, a chunk of whole messages at a time, as it comes in
+        chunker = flusherproto.MessageChunker( self.config.stream_chunk_size, self.config.max_message_size )
+        async for data in self._body_pieces( request, decompressor ):
+            for chunk in chunker.feed( data ):
+                yield chunk
+        for chunk in chunker.end():
+            yield chunk
+
+    async def handle_avro( self, request, post, schema ):
+        # See webserver.HandleRequest.handle_avro
+        config = self.config
+        err, avro = ingest.check_avro( config, request.headers, schema, _logger )
+        if err is not None:
+            return err
+        parsed, schema_id = avro
+
+        try:
+            if post.encoding is not None:
+                body = bytearray()
+                async for piece in self._body_pieces( request, compression.Decompressor( post.encoding,
+                                                                                          config.max_json_size ) ):
+                    body += piece
+            else:
+                body = await request.read_all( config.max_json_size )
+        except compression.CompressionError as ex:
+            return ingest.body_error( ex, _logger )
+        except BadRequest as ex:
+            request.keepalive = False
+            return f"Error, {ex}", 400
+
+        t0 = time.perf_counter()
+        chunks = []
+        try:
+            for chunk in ingest.encode_avro( config, body, request.mimetype, parsed, schema_id ):
+                chunks.append( chunk )
+                # Let this worker's other connections have a turn
+                await asyncio.sleep( 0 )
+        except avroencode.BadRecords as ex:
+            _logger.error( f"Refusing Avro POST for schema {schema}: {ex}" )
+            return f"Error, {ex}", 400
+        ingest.parse_seconds.observe( time.perf_counter() - t0 )
+
+        async def encoded():
+            for chunk in chunks:
+                yield chunk
+
+        return await self.dispatch_stream( post, encoded() )
+
+    async def forward_messages( self, post, payload, nmsgs, wait=None, status=None, batchid=None ):
+        # See webserver.HandleRequest.forward_messages
+        ingest.rate_limiter( self.config.rate_limit_path ).charge( post.client, nmsgs, len( payload ) )
+        try:
+            t0 = time.perf_counter()
+            verb, resp = await self.shards.send_messages( payload, nmsgs, post.topic, post.flags, wait, batchid )
+            ingest.flusher_seconds.observe( time.perf_counter() - t0 )
+        except Exception as ex:
+            return ingest.flusher_failure( ex, _logger ), False
+        return ingest.flusher_reply( verb, resp, len( payload ), nmsgs, wait, status, batchid, _logger )
+
+    async def dispatch_stream( self, post, chunks ):
+        # See webserver.HandleRequest.dispatch_chunks; chunks is an async
+        #   iterator of ( chunk, nmsgs )
+        streamed = ingest.StreamedPost( post, _logger )
+        err = None
+        try:
+            async for chunk, nmsgs in chunks:
+                chunkwait, chunkid = streamed.next_chunk( chunk )
+                err, duplicate = await self.forward_messages( post, chunk, nmsgs, chunkwait, streamed.status,
+                                                              chunkid )
+                if err is not None:
+                    break
+                streamed.accepted( chunk, nmsgs, duplicate )
+        except BadRequest as ex:
+            err = streamed.malformed( ex )
+        except ConnectionError:
+            # The client's gone; there's nobody to answer
+            raise
+        except Exception as ex:
+            err = streamed.failed( ex )
+        return streamed.response( err )
+
+    async def handle_topic( self, request, verb, topic ):
+        # See webserver.TopicRequest
+        err = ingest.check_topic_change( self.config, request.headers, verb, topic )
+        if err is not None:
+            return err
+        replies = await self.shards.broadcast( verb, topic.encode( 'utf-8' ) )
+        return ingest.topic_change_response( verb, topic, replies, self.config.nshards, _logger )
+
+    async def handle_metrics( self, request ):
+        # See webserver.MetricsRequest
+        err = ingest.check_metrics( self.config, request.headers )
+        if err is not None:
+            return err
+        return ingest.metrics_response( await self.shards.broadcast( b'STAT' ), _logger )
+
+
+async def serve( sock, sslcontext=None, config=None ):
+    # Answer requests on the listening socket sock until cancelled
+    server = IngestServer( ingest.Config() if config is None else config )
+    aserver = await asyncio.start_server( server.handle_connection, sock=sock, ssl=sslcontext,
+                                          limit=MAX_HEADER_SIZE )
+    async with aserver:
+        await aserver.serve_forever()
+
+
+def _worker( sock, sslcontext ):
+    _share_metrics()
+    try:
+        asyncio.run( serve( sock, sslcontext ) )
+    except KeyboardInterrupt:
+        pass
+
+
+def main( argv=None ):
+    parser = argparse.ArgumentParser( 'asyncserver.py', description='asyncio HTTP front end for the kafka proxy',
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( "-b", "--bind", default="0.0.0.0", help="Address to listen on" )
+    parser.add_argument( "-p", "--port", default=8080, type=int, help="Port to listen on" )
+    parser.add_argument( "-w", "--workers", default=int( os.getenv( "KAFKA_PROXY_WORKERS", "4" ) ), type=int,
+                         help="Number of worker processes (env var KAFKA_PROXY_WORKERS)" )
+    parser.add_argument( "--certfile", default=None, help="SSL certificate file (serve https)" )
+    parser.add_argument( "--keyfile", default=None, help="SSL key file" )
+    parser.add_argument( "--backlog", default=1024, type=int, help="Listen backlog" )
+    parser.add_argument( "-v", "--verbose", action='store_true', default=False )
+    args = parser.parse_args( argv )
+
+    if args.verbose:
+        _logger.setLevel( logging.DEBUG )
+
+    sslcontext = None
+    if args.certfile is not None:
+        sslcontext = ssl.SSLContext( ssl.PROTOCOL_TLS_SERVER )
+        sslcontext.load_cert_chain( args.certfile, args.keyfile )
+
+    sock = socket.create_server( ( args.bind, args.port ), backlog=args.backlog )
+    _logger.info( f"Listening on {args.bind}:{args.port} with {args.workers} worker processes" )
+    if args.workers <= 1:
+        _worker( sock, sslcontext )
+        return
+
+    # Every worker accepts connections on the same socket
+    workers = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal( signal.SIGTERM, signal.SIG_DFL )
+            signal.signal( signal.SIGINT, signal.SIG_DFL )
+            try:
+                _worker( sock, sslcontext )
+            finally:
+                os._exit( 0 )
+        workers.add( pid )
+
+    def stop( signum, frame ):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill( pid, signal.SIGTERM )
+            except ProcessLookupError:
+                pass
+
+    signal.signal( signal.SIGTERM, stop )
+    signal.signal( signal.SIGINT, stop )
+    for _ in range( args.workers ):
+        spawn()
+    while len( workers ) > 0:
+        try:
+            pid, waitstatus = os.wait()
+        except ChildProcessError:
+            break
+        workers.discard( pid )
+        if not stopping:
+            _logger.error( f"Worker {pid} exited ({waitstatus}); starting another" )
+            time.sleep( 0.1 )
+            spawn()
+
+
+# ======================================================================
+if __name__ == "__main__":
+    main()
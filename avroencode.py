@@ -0,0 +1,157 @@
+# Encoding records sent as JSON into Avro, for POSTs to /avro/<schema>
+#   (see webserver.py and asyncserver.py), so that clients don't need an
+#   Avro library (or their own copy of the schema).
+#
+# Schemas live in the schema directory (KAFKA_PROXY_SCHEMA_DIR), one per
+#   file: schema <name> is <name>.avsc.  If there's also a file <name>.id
+#   holding an integer, that's the schema's ID in a Confluent schema
+#   registry, and records can be encoded in the Confluent wire format
+#   (WIRE_MAGIC, then the ID as a 4-byte big-endian integer, then the
+#   Avro); otherwise, they can only be encoded as plain (schemaless) Avro.
+#   Schemas are parsed once and kept (see SchemaCache); a changed file is
+#   noticed within a second or so.
+#
+# The body of the POST is either JSON (a list of records, or one record),
+#   or newline-delimited JSON (one record per line).  The records are all
+#   encoded before any of them are passed on, so a record that doesn't
+#   fit the schema means none of them are; the encoded messages come out
+#   as MSGS payloads of about chunk_size bytes (see encode_records), which
+#   go to the flusher like the chunks of a streamed POST.  The encoding is
+#   done by the webserver's worker processes, so as many POSTs can be
+#   encoded at once as there are workers.
+#
+# fastavro is needed for this; without it, supported() is False.
+
+import io
+import re
+import json
+import time
+import struct
+import pathlib
+
+import flusherproto
+
+try:
+    import fastavro
+except ImportError:
+    fastavro = None
+
+JSON_CONTENT_TYPE = "application/json"
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+FORMATS = ( 'avro', 'confluent' )
+WIRE_MAGIC = b'\x00'
+SCHEMA_ID = struct.Struct( '>I' )
+SCHEMA_NAME = re.compile( r'^[A-Za-z0-9_][A-Za-z0-9_.\-]*$' )
+
+
+class AvroError( Exception ):
+    pass
+
+
+class UnknownSchema( AvroError ):
+    pass
+
+
+class BadRecords( AvroError ):
+    pass
+
+
+def supported():
+    return fastavro is not None
+
+
+class _Schema:
+    def __init__( self, parsed, schema_id, mtimes ):
+        self.parsed = parsed
+        self.schema_id = schema_id
+        self.mtimes = mtimes
+
+
+class SchemaCache:
+    # Parsed schemas from directory, by name.  A schema's files are looked
+    #   at again (to see if they've changed) at most every checkevery
+    #   seconds.
+    def __init__( self, directory, checkevery=1 ):
+        self.directory = pathlib.Path( directory )
+        self.checkevery = checkevery
+        self.schemas = {}
+        self.lastcheck = {}
+
+    @staticmethod
+    def _mtime( path ):
+        try:
+            return path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def get( self, name ):
+        # Returns ( parsed schema, schema ID or None ); raises UnknownSchema
+        if SCHEMA_NAME.match( name ) is None:
+            raise UnknownSchema( f"Bad schema name {name}" )
+        now = time.monotonic()
+        if ( name in self.schemas ) and ( now - self.lastcheck[ name ] < self.checkevery ):
+            schema = self.schemas[ name ]
+            return schema.parsed, schema.schema_id
+
+        self.lastcheck[ name ] = now
+        avscpath = self.directory / f"{name}.avsc"
+        idpath = self.directory / f"{name}.id"
+        mtimes = ( self._mtime( avscpath ), self._mtime( idpath ) )
+        if mtimes[0] is None:
+            self.schemas.pop( name, None )
+            raise UnknownSchema( f"No schema {name}" )
+        if ( name not in self.schemas ) or ( self.schemas[ name ].mtimes != mtimes ):
+            try:
+                parsed = fastavro.parse_schema( json.loads( avscpath.read_text() ) )
+                schema_id = None if mtimes[1] is None else int( idpath.read_text().strip() )
+            except Exception as ex:
+                self.schemas.pop( name, None )
+                raise UnknownSchema( f"Can't load schema {name}: {ex}" )
+            self.schemas[ name ] = _Schema( parsed, schema_id, mtimes )
+        schema = self.schemas[ name ]
+        return schema.parsed, schema.schema_id
+
+
+def parse_records( body, content_type ):
+    # The records in a POST body (bytes-like), as a list
+    try:
+        if content_type == NDJSON_CONTENT_TYPE:
+            return [ json.loads( line ) for line in bytes( body ).splitlines() if len( line.strip() ) > 0 ]
+        records = json.loads( bytes( body ) )
+    except ValueError as ex:
+        raise BadRecords( f"Bad JSON: {ex}" )
+    return records if isinstance( records, list ) else [ records ]
+
+
+def encode_records( records, parsed, schema_id=None, chunk_size=1048576, max_message_size=None ):
+    # Encode records (with the Confluent wire format prefix if schema_id
+    #   isn't None) as length-prefixed messages, yielding ( payload, nmsgs )
+    #   for each chunk_size or so bytes of whole messages.  (A caller can
+    #   let other requests run between chunks; see webserver.py.)  Raises
+    #   BadRecords, before yielding the chunk it's in, if a record doesn't
+    #   fit the schema, or encodes to more than max_message_size bytes.
+    prefix = b'' if schema_id is None else WIRE_MAGIC + SCHEMA_ID.pack( schema_id )
+    buf = io.BytesIO()
+    nmsgs = 0
+    for i, record in enumerate( records ):
+        start = buf.tell()
+        buf.write( flusherproto.MSGLEN.pack( 0 ) )
+        buf.write( prefix )
+        try:
+            fastavro.schemaless_writer( buf, parsed, record )
+        except Exception as ex:
+            raise BadRecords( f"Record {i} doesn't fit the schema: {ex}" )
+        end = buf.tell()
+        if ( max_message_size is not None ) and ( end - start - flusherproto.MSGLEN.size > max_message_size ):
+            raise BadRecords( f"Record {i} is {end - start - flusherproto.MSGLEN.size} bytes encoded, more than "
+                              f"the maximum of {max_message_size}" )
+        buf.seek( start )
+        buf.write( flusherproto.MSGLEN.pack( end - start - flusherproto.MSGLEN.size ) )
+        buf.seek( end )
+        nmsgs += 1
+        if end >= chunk_size:
+            yield buf.getbuffer(), nmsgs
+            buf = io.BytesIO()
+            nmsgs = 0
+    if nmsgs > 0:
+        yield buf.getbuffer(), nmsgs
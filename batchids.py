@@ -0,0 +1,143 @@
+# The batch IDs the flusher has accepted recently, so that a client that
+#   resends a POST (e.g. because its first try timed out before it heard
+#   back) doesn't get the messages into kafka twice.  Each batch ID is
+#   remembered for ttl seconds, and at most maxsize of them are kept; when
+#   there are more, the least recently seen ones are forgotten first.
+#
+# If the flusher is spooling, the batch IDs are kept in a file in the
+#   spool directory as well, so that they survive a restart just like the
+#   messages do.  The file is an append-only log of records
+#
+#   8 bytes : time.time() when the batch ID expires (double)
+#   4 bytes : number of messages in the batch (little-endian unsigned int)
+#   2 bytes : length of the utf-8 encoded batch ID (little-endian)
+#   the batch ID
+#
+# which gets rewritten with just the live batch IDs when it has grown to
+#   be mostly dead ones.
+
+import os
+import time
+import struct
+import pathlib
+import collections
+
+RECORD = struct.Struct( '<dIH' )
+
+
+class BatchIdCache:
+    def __init__( self, maxsize=100000, ttl=600, path=None ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # batch ID -> ( expires, nmsgs, ack ), least recently seen first.
+        #   ack is whatever the caller wants to remember about the batch;
+        #   it isn't saved to the file.
+        self.entries = collections.OrderedDict()
+        self.path = None if path is None else pathlib.Path( path )
+        self.fp = None
+        self.nwritten = 0
+        self.dirty = False
+        if self.path is not None:
+            self._load()
+            self._rewrite()
+
+
+    def _load( self ):
+        try:
+            with open( self.path, 'rb' ) as ifp:
+                data = ifp.read()
+        except FileNotFoundError:
+            return
+        now = time.time()
+        pos = 0
+        while pos + RECORD.size <= len( data ):
+            expires, nmsgs, idlen = RECORD.unpack_from( data, pos )
+            pos += RECORD.size
+            if pos + idlen > len( data ):
+                # Torn by a crash
+                break
+            try:
+                batchid = str( data[ pos : pos+idlen ], 'utf-8' )
+            except UnicodeDecodeError:
+                break
+            pos += idlen
+            if expires > now:
+                self.entries[ batchid ] = ( expires, nmsgs, None )
+                self.entries.move_to_end( batchid )
+        self._expire()
+
+
+    def _rewrite( self ):
+        # Replace the file with one holding just the live batch IDs
+        if self.fp is not None:
+            self.fp.close()
+        tmppath = self.path.parent / f".{self.path.name}.{os.getpid()}"
+        with open( tmppath, 'wb' ) as ofp:
+            for batchid, ( expires, nmsgs, _ack ) in self.entries.items():
+                bid = batchid.encode( 'utf-8' )
+                ofp.write( RECORD.pack( expires, nmsgs, len(bid) ) + bid )
+            ofp.flush()
+            os.fsync( ofp.fileno() )
+        os.replace( tmppath, self.path )
+        self.fp = open( self.path, 'ab' )
+        self.nwritten = len( self.entries )
+        self.dirty = False
+
+
+    def _expire( self ):
+        # Forget the least recently seen batch IDs beyond maxsize, and any
+        #   expired ones at that end.
+        now = time.time()
+        while len( self.entries ) > 0:
+            batchid, ( expires, _nmsgs, _ack ) = next( iter( self.entries.items() ) )
+            if ( len( self.entries ) <= self.maxsize ) and ( expires > now ):
+                break
+            self.entries.popitem( last=False )
+
+
+    def __len__( self ):
+        return len( self.entries )
+
+
+    def lookup( self, batchid ):
+        # Returns ( nmsgs, ack ) from when batchid was added, or None if
+        #   we haven't seen it (or have forgotten it).
+        entry = self.entries.get( batchid )
+        if entry is None:
+            return None
+        expires, nmsgs, ack = entry
+        if expires <= time.time():
+            del self.entries[ batchid ]
+            return None
+        self.entries.move_to_end( batchid )
+        return nmsgs, ack
+
+
+    def add( self, batchid, nmsgs, ack=None ):
+        expires = time.time() + self.ttl
+        self.entries[ batchid ] = ( expires, nmsgs, ack )
+        self.entries.move_to_end( batchid )
+        self._expire()
+        if self.fp is not None:
+            bid = batchid.encode( 'utf-8' )
+            self.fp.write( RECORD.pack( expires, nmsgs, len(bid) ) + bid )
+            self.nwritten += 1
+            self.dirty = True
+
+
+    def sync( self ):
+        # Make sure that everything add()ed so far is on disk
+        if not self.dirty:
+            return
+        self.fp.flush()
+        os.fsync( self.fp.fileno() )
+        self.dirty = False
+        if self.nwritten > 2 * len( self.entries ) + 1000:
+            self._rewrite()
+
+
+    def close( self ):
+        if self.fp is not None:
+            self.sync()
+            self.fp.close()
+            self.fp = None
@@ -0,0 +1,545 @@
+# Load test for the proxy that doesn't need a kafka server: the flusher
+#   runs with fakekafka.py's stand-in Producer (with a configurable ack
+#   latency and failure rate), and client threads POST messages to the
+#   webserver as fast as it will take them for a while.  The results
+#   (POSTs and messages per second, POST latency, and the latency from a
+#   message being POSTed to its delivery report) are written as JSON, so
+#   that runs from different commits can be compared:
+#
+#   python benchmark.py run --duration 10 --clients 8 --output before.json
+#   ... change things ...
+#   python benchmark.py run --duration 10 --clients 8 --output after.json
+#   python benchmark.py compare before.json after.json
+#
+# With --mode inprocess (the default), the flusher runs in a thread, and
+#   the clients call the Flask app directly (its test client), so there's
+#   no HTTP; this is for catching regressions in the request handling and
+#   flusher code, though everything shares one GIL.  With --mode
+#   subprocess, the flusher and the webserver (gunicorn with gevent
+#   workers, as in run-kafka-proxy.sh) are separate processes, and the
+#   clients POST over keep-alive HTTP connections.  --server asyncio runs
+#   asyncserver.py as the webserver instead of gunicorn, to compare the
+#   two:
+#
+#   python benchmark.py run --mode subprocess --server gunicorn -o gunicorn.json
+#   python benchmark.py run --mode subprocess --server asyncio -o asyncio.json
+#   python benchmark.py compare gunicorn.json asyncio.json
+#
+# Options after -- are passed to the flusher (see flusher.py), e.g.
+#
+#   python benchmark.py run --mode subprocess -- --adaptive --latency-target 0.2
+
+import sys
+import os
+import io
+import gzip
+import json
+import time
+import uuid
+import random
+import socket
+import shutil
+import signal
+import logging
+import pathlib
+import argparse
+import datetime
+import tempfile
+import threading
+import subprocess
+import http.client
+
+import fakekafka
+import flusherproto
+
+_logger = logging.getLogger( __name__ )
+_logger.propagate = False
+if not _logger.hasHandlers():
+    _logout = logging.StreamHandler( sys.stderr )
+    _logger.addHandler( _logout )
+    _formatter = logging.Formatter( '[%(asctime)s - benchmark - %(levelname)s] - %(message)s',
+                                    datefmt='%Y-%m-%d %H:%M:%S' )
+    _logout.setFormatter( _formatter )
+    _logger.setLevel( logging.INFO )
+
+TOKEN = "benchmark-token"
+TOPIC = "benchmark"
+CODEDIR = pathlib.Path( __file__ ).resolve().parent
+
+
+def _range( text ):
+    # "200" or "100-1000"
+    lo, _, hi = text.partition( '-' )
+    lo = int( lo )
+    hi = lo if hi == '' else int( hi )
+    if not ( 0 < lo <= hi ):
+        raise argparse.ArgumentTypeError( f"bad range {text}" )
+    return lo, hi
+
+
+class _Payloads:
+    # A few POST bodies of the requested shape.  Every message value starts
+    #   with room for the time the POST is sent (fakekafka.SENT), which
+    #   stamp() fills in.
+    def __init__( self, args, seed, nbodies=16 ):
+        rng = random.Random( seed )
+        self.records = args.records
+        self.bodies = []
+        for _ in range( nbodies ):
+            body = bytearray()
+            offsets = []
+            nmsgs = rng.randint( *args.messages_per_post )
+            for i in range( nmsgs ):
+                size = max( fakekafka.SENT.size, rng.randint( *args.message_size ) )
+                # Something compressible, like real alerts
+                value = bytes( fakekafka.SENT.size ) + bytes( rng.choices( b'abcdefghijklmnop0123456789',
+                                                                           k=size - fakekafka.SENT.size ) )
+                msg = flusherproto.pack_record( value, key=f"key-{i}".encode() ) if self.records else value
+                body += len( msg ).to_bytes( 4, byteorder='little' )
+                offsets.append( len( body ) + len( msg ) - len( value ) )
+                body += msg
+            self.bodies.append( ( body, offsets, nmsgs ) )
+        self.next = 0
+
+    def stamp( self ):
+        # Returns ( body, nmsgs ) for the next POST
+        body, offsets, nmsgs = self.bodies[ self.next ]
+        self.next = ( self.next + 1 ) % len( self.bodies )
+        now = time.time()
+        for offset in offsets:
+            fakekafka.SENT.pack_into( body, offset, now )
+        return bytes( body ), nmsgs
+
+
+class _TestClient:
+    def __init__( self, app ):
+        self.client = app.test_client()
+
+    def post( self, path, body, headers ):
+        return self.client.post( path, data=body, headers=headers ).status_code
+
+    def close( self ):
+        pass
+
+
+class _HttpClient:
+    # One keep-alive connection to the webserver
+    def __init__( self, host, port ):
+        self.host = host
+        self.port = port
+        self.conn = None
+
+    def post( self, path, body, headers ):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection( self.host, self.port, timeout=60 )
+        try:
+            self.conn.request( 'POST', path, body=body, headers=headers )
+            resp = self.conn.getresponse()
+            resp.read()
+            return resp.status
+        except Exception:
+            self.close()
+            raise
+
+    def close( self ):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def _client_loop( client, payloads, args, deadline, results ):
+    headers = { 'x-kafka-proxy-token': TOKEN,
+                'content-type': flusherproto.RECORDS_CONTENT_TYPE if args.records else 'application/octet-stream' }
+    if args.gzip:
+        headers[ 'content-encoding' ] = 'gzip'
+    if args.wait_for_delivery is not None:
+        headers[ 'x-kafka-proxy-wait-for-delivery' ] = str( args.wait_for_delivery )
+    latencies = []
+    statuses = {}
+    nmsgs = 0
+    nbytes = 0
+    nerrors = 0
+    while time.monotonic() < deadline:
+        body, n = payloads.stamp()
+        if args.gzip:
+            body = gzip.compress( body, compresslevel=1 )
+        if args.batch_ids:
+            headers[ 'x-kafka-proxy-batch-id' ] = str( uuid.uuid4() )
+        t0 = time.perf_counter()
+        try:
+            status = client.post( '/', body, headers )
+        except Exception as ex:
+            _logger.error( f"POST failed: {ex}" )
+            nerrors += 1
+            continue
+        latencies.append( time.perf_counter() - t0 )
+        statuses[ status ] = statuses.get( status, 0 ) + 1
+        if status == 200:
+            nmsgs += n
+            nbytes += len( body )
+        elif status == 503:
+            # The flusher is full.  A real client would wait as long as
+            #   Retry-After says, but we want to know how fast things go
+            #   when pushed, so just don't spin.
+            time.sleep( args.busy_backoff )
+    client.close()
+    results.append( ( latencies, statuses, nmsgs, nbytes, nerrors ) )
+
+
+def _percentiles( values ):
+    if len( values ) == 0:
+        return None
+    values = sorted( values )
+
+    def pct( p ):
+        return 1000. * values[ min( len(values) - 1, int( p / 100. * len(values) ) ) ]
+
+    return { 'p50': pct( 50 ), 'p90': pct( 90 ), 'p99': pct( 99 ), 'max': 1000. * values[-1],
+             'mean': 1000. * sum( values ) / len( values ) }
+
+
+def _flusher_stats( sockpath ):
+    # The flusher's unlabelled metrics (see metrics.py), by name
+    with socket.socket( socket.AF_UNIX, socket.SOCK_STREAM ) as sock:
+        sock.settimeout( 10 )
+        sock.connect( str( sockpath ) )
+        flusherproto.send_frame( sock, b'STAT' )
+        verb, _flags, payload = flusherproto.recv_frame( sock )
+    if verb != b'OK  ':
+        raise RuntimeError( f"Flusher replied {verb} to STAT" )
+    return { m['name']: m['value'] for m in json.loads( payload )['metrics'] if 'value' in m }
+
+
+def _wait_for_flusher( sockpath, naccepted, timeout ):
+    # Wait for the flusher to have dealt with (delivered or given up on)
+    #   every message the webserver accepted.  Returns its stats.
+    deadline = time.monotonic() + timeout
+    while True:
+        stats = _flusher_stats( sockpath )
+        if ( stats['kafka_flusher_delivered_total'] + stats['kafka_flusher_dropped_total'] >= naccepted ):
+            return stats
+        if time.monotonic() > deadline:
+            _logger.warning( f"Gave up waiting for the flusher to deliver {naccepted} messages" )
+            return stats
+        time.sleep( 0.05 )
+
+
+def _wait_for_path( path, proc, timeout=20 ):
+    deadline = time.monotonic() + timeout
+    while not pathlib.Path( path ).exists():
+        if ( proc is not None ) and ( proc.poll() is not None ):
+            raise RuntimeError( f"Process exited with status {proc.returncode}" )
+        if time.monotonic() > deadline:
+            raise TimeoutError( f"{path} didn't show up" )
+        time.sleep( 0.05 )
+
+
+def _wait_for_port( host, port, proc, timeout=30 ):
+    deadline = time.monotonic() + timeout
+    while True:
+        if proc.poll() is not None:
+            raise RuntimeError( f"Webserver exited with status {proc.returncode}" )
+        try:
+            socket.create_connection( ( host, port ), timeout=1 ).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError( f"Webserver didn't start listening on {host}:{port}" )
+            time.sleep( 0.1 )
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind( ( '127.0.0.1', 0 ) )
+        return sock.getsockname()[1]
+
+
+def _commit():
+    # The commit being benchmarked, with "-dirty" if there are changes
+    try:
+        commit = subprocess.run( [ 'git', 'rev-parse', '--short', 'HEAD' ], cwd=CODEDIR, capture_output=True,
+                                 text=True, check=True ).stdout.strip()
+        dirty = subprocess.run( [ 'git', 'status', '--porcelain', '--untracked-files=no' ], cwd=CODEDIR,
+                                capture_output=True, text=True, check=True ).stdout.strip()
+        return commit + ( "-dirty" if len( dirty ) > 0 else "" )
+    except ( OSError, subprocess.CalledProcessError ):
+        return None
+
+
+def _environment( args, tmpdir ):
+    # What both the flusher and the webserver need to find each other
+    env = { 'KAFKA_PROXY_TOKEN': TOKEN,
+            'KAFKA_FLUSHER_SOCKET_PATH': str( tmpdir / "flusher_socket" ),
+            'KAFKA_FLUSHER_TOPIC_CACHE': str( tmpdir / "topic" ),
+            'KAFKA_FLUSHER_RING_SIZE': str( args.ring_size ),
+            'KAFKA_FLUSHER_RING_PATH': str( tmpdir / "ring" ) }
+    if args.ring_size > 0:
+        # Rings want to be on a memory filesystem
+        env[ 'KAFKA_FLUSHER_RING_PATH' ] = f"/dev/shm/kafka_proxy_benchmark_{os.getpid()}_ring"
+    return env
+
+
+def _flusher_argv( args, env ):
+    return [ '-t', TOPIC, '--force-topic', '-p', env['KAFKA_FLUSHER_SOCKET_PATH'],
+             '--ring-size', str( args.ring_size ), '--ring-path', env['KAFKA_FLUSHER_RING_PATH'] ] + args.flusher_args
+
+
+def _run_clients( args, makeclient ):
+    results = []
+    clients = [ ( makeclient(), _Payloads( args, seed=i ) ) for i in range( args.clients ) ]
+    t0 = time.monotonic()
+    deadline = t0 + args.duration
+    threads = [ threading.Thread( target=_client_loop, args=( client, payloads, args, deadline, results ) )
+                for client, payloads in clients ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.monotonic() - t0
+
+
+def run_inprocess( args, tmpdir ):
+    env = _environment( args, tmpdir )
+    os.environ.update( env )
+    # Each request should see the same metrics; don't share them with
+    #   anything else on this machine
+    os.environ[ 'KAFKA_PROXY_METRICS_DIR' ] = ''
+    fakekafka.install()
+    fakekafka.configure( latency=args.kafka_latency, failure_rate=args.kafka_failure_rate, timestamped=True )
+    fakekafka.reset()
+    import flusher
+    import webserver
+    # Otherwise it's mostly complaints about being busy
+    flusher._logger.setLevel( logging.ERROR )
+    webserver.app.logger.setLevel( logging.ERROR )
+
+    thread = threading.Thread( target=flusher.main, args=( _flusher_argv( args, env ), ), daemon=True )
+    thread.start()
+    _wait_for_path( env['KAFKA_FLUSHER_SOCKET_PATH'], None )
+
+    results, elapsed = _run_clients( args, lambda: _TestClient( webserver.app ) )
+    naccepted = sum( r[2] for r in results )
+    stats = _wait_for_flusher( env['KAFKA_FLUSHER_SOCKET_PATH'], naccepted, args.drain_timeout )
+    # The flusher thread just gets abandoned when we exit
+    return results, elapsed, stats, fakekafka.results()
+
+
+def run_subprocess( args, tmpdir ):
+    env = { **os.environ, **_environment( args, tmpdir ),
+            'KAFKA_PROXY_METRICS_DIR': str( tmpdir / "metrics" ),
+            'FAKEKAFKA_LATENCY': str( args.kafka_latency ),
+            'FAKEKAFKA_FAILURE_RATE': str( args.kafka_failure_rate ),
+            'FAKEKAFKA_TIMESTAMPED': "1",
+            'FAKEKAFKA_RESULTS': str( tmpdir / "fakekafka.json" ),
+            'PYTHONPATH': os.pathsep.join( [ str( CODEDIR ) ] + [ p for p in [ os.getenv( 'PYTHONPATH' ) ] if p ] ) }
+    host = '127.0.0.1'
+    port = _free_port()
+    logfile = open( tmpdir / "servers.log", 'wb' )
+    flusherproc = subprocess.Popen( [ sys.executable, str( CODEDIR / "benchmark.py" ), 'flusher',
+                                      *_flusher_argv( args, env ) ],
+                                    env=env, cwd=CODEDIR, stdout=logfile, stderr=subprocess.STDOUT )
+    webproc = None
+    try:
+        _wait_for_path( env['KAFKA_FLUSHER_SOCKET_PATH'], flusherproc )
+        if args.server == 'asyncio':
+            webargv = [ sys.executable, str( CODEDIR / "asyncserver.py" ), '-w', str( args.workers ),
+                        '-b', host, '-p', str( port ) ]
+        else:
+            webargv = [ sys.executable, '-m', 'gunicorn', '-w', str( args.workers ), '-k', 'gevent',
+                        '-b', f"{host}:{port}", '--timeout', '0', '--log-level', 'warning', 'webserver:app' ]
+        webproc = subprocess.Popen( webargv, env=env, cwd=CODEDIR, stdout=logfile, stderr=subprocess.STDOUT )
+        _wait_for_port( host, port, webproc )
+
+        results, elapsed = _run_clients( args, lambda: _HttpClient( host, port ) )
+        naccepted = sum( r[2] for r in results )
+        stats = _wait_for_flusher( env['KAFKA_FLUSHER_SOCKET_PATH'], naccepted, args.drain_timeout )
+    except Exception:
+        _logger.error( f"Benchmark failed; the flusher and webserver logged to {tmpdir / 'servers.log'}:\n"
+                       + ( tmpdir / "servers.log" ).read_text( errors='replace' )[-4000:] )
+        raise
+    finally:
+        if webproc is not None:
+            webproc.terminate()
+            webproc.wait( 30 )
+        # SIGINT lets the flusher shut down cleanly, so fakekafka writes
+        #   its results
+        flusherproc.send_signal( signal.SIGINT )
+        try:
+            flusherproc.wait( 30 )
+        except subprocess.TimeoutExpired:
+            flusherproc.kill()
+        logfile.close()
+        if args.ring_size > 0:
+            for path in ( env['KAFKA_FLUSHER_RING_PATH'], env['KAFKA_FLUSHER_RING_PATH'] + ".wake" ):
+                pathlib.Path( path ).unlink( missing_ok=True )
+
+    with open( tmpdir / "fakekafka.json" ) as ifp:
+        kafka = json.load( ifp )
+    return results, elapsed, stats, kafka
+
+
+def run( args ):
+    tmpdir = pathlib.Path( tempfile.mkdtemp( prefix="kafka_proxy_benchmark_" ) )
+    try:
+        _logger.info( f"Running {args.mode} benchmark for {args.duration} s with {args.clients} clients..." )
+        runner = run_inprocess if args.mode == 'inprocess' else run_subprocess
+        results, elapsed, stats, kafka = runner( args, tmpdir )
+    finally:
+        shutil.rmtree( tmpdir, ignore_errors=True )
+
+    latencies = [ t for r in results for t in r[0] ]
+    statuses = {}
+    for r in results:
+        for status, n in r[1].items():
+            statuses[ str( status ) ] = statuses.get( str( status ), 0 ) + n
+    nmsgs = sum( r[2] for r in results )
+    nbytes = sum( r[3] for r in results )
+    summary = { 'commit': _commit(),
+                'time': datetime.datetime.now( tz=datetime.UTC ).isoformat(),
+                'python': sys.version.split()[0],
+                'config': { 'mode': args.mode, 'clients': args.clients, 'duration': args.duration,
+                            'workers': args.workers if args.mode == 'subprocess' else None,
+                            'server': args.server if args.mode == 'subprocess' else None,
+                            'message_size': list( args.message_size ),
+                            'messages_per_post': list( args.messages_per_post ),
+                            'records': args.records, 'gzip': args.gzip,
+                            'wait_for_delivery': args.wait_for_delivery, 'batch_ids': args.batch_ids,
+                            'ring_size': args.ring_size, 'kafka_latency': args.kafka_latency,
+                            'kafka_failure_rate': args.kafka_failure_rate, 'busy_backoff': args.busy_backoff,
+                            'flusher_args': args.flusher_args },
+                'elapsed': elapsed,
+                'posts': len( latencies ),
+                'post_errors': sum( r[4] for r in results ),
+                'statuses': statuses,
+                'messages': nmsgs,
+                'bytes': nbytes,
+                'posts_per_second': len( latencies ) / elapsed,
+                'messages_per_second': nmsgs / elapsed,
+                'megabytes_per_second': nbytes / elapsed / 1e6,
+                'post_latency_ms': _percentiles( latencies ),
+                'delivery_latency_ms': _percentiles( kafka['latencies'] ),
+                'delivered': kafka['delivered'],
+                'delivery_failures': kafka['failed'],
+                'flusher': stats }
+    return summary
+
+
+# The numbers compare shows, and whether bigger is better
+_COMPARED = [ ( ( 'messages_per_second', ), True ),
+              ( ( 'megabytes_per_second', ), True ),
+              ( ( 'posts_per_second', ), True ),
+              ( ( 'post_latency_ms', 'p50' ), False ),
+              ( ( 'post_latency_ms', 'p99' ), False ),
+              ( ( 'delivery_latency_ms', 'p50' ), False ),
+              ( ( 'delivery_latency_ms', 'p99' ), False ) ]
+
+
+def compare( old, new ):
+    # Returns a text table of how new (results) differs from old
+    out = io.StringIO()
+    out.write( f"{'':28s} {old.get('commit') or 'old':>14s} {new.get('commit') or 'new':>14s} {'change':>9s}\n" )
+    for keys, bigger_better in _COMPARED:
+        values = []
+        for results in ( old, new ):
+            value = results
+            for key in keys:
+                value = None if value is None else value.get( key )
+            values.append( value )
+        name = '.'.join( keys )
+        if None in values:
+            out.write( f"{name:28s} {str(values[0]):>14s} {str(values[1]):>14s}\n" )
+            continue
+        change = ( values[1] - values[0] ) / values[0] * 100. if values[0] != 0 else float( 'inf' )
+        better = ( change > 0 ) == bigger_better
+        out.write( f"{name:28s} {values[0]:14.2f} {values[1]:14.2f} {change:+8.1f}%"
+                   f"{'' if abs( change ) < 5 else ( '  better' if better else '  WORSE' )}\n" )
+    return out.getvalue()
+
+
+def _flusher_main( argv ):
+    # For --mode subprocess: run flusher.py against the fake kafka
+    fakekafka.install()
+    fakekafka.configure_from_env()
+    import flusher
+    try:
+        flusher.main( argv )
+    except KeyboardInterrupt:
+        pass
+
+
+# ======================================================================
+def main():
+    if ( len( sys.argv ) > 1 ) and ( sys.argv[1] == 'flusher' ):
+        # Not for people; see run_subprocess
+        return _flusher_main( sys.argv[2:] )
+
+    parser = argparse.ArgumentParser( 'benchmark.py', description='Load test the proxy against a fake kafka',
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    subparsers = parser.add_subparsers( dest='command', required=True )
+
+    runparser = subparsers.add_parser( 'run', help="Run a benchmark",
+                                       formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    runparser.add_argument( "--mode", default='inprocess', choices=[ 'inprocess', 'subprocess' ],
+                            help="Run everything in this process, or the flusher and webserver as processes" )
+    runparser.add_argument( "-d", "--duration", type=float, default=10, help="Seconds to send messages for" )
+    runparser.add_argument( "-c", "--clients", type=int, default=8, help="Number of clients POSTing at once" )
+    runparser.add_argument( "--server", default='gunicorn', choices=[ 'gunicorn', 'asyncio' ],
+                            help="Webserver to run (--mode subprocess): webserver.py under gunicorn, "
+                            "or asyncserver.py" )
+    runparser.add_argument( "-w", "--workers", type=int, default=4,
+                            help="Number of webserver worker processes (--mode subprocess)" )
+    runparser.add_argument( "-s", "--message-size", type=_range, default=( 200, 200 ),
+                            help="Bytes in each message; a range like 100-1000 picks sizes at random" )
+    runparser.add_argument( "-n", "--messages-per-post", type=_range, default=( 100, 100 ),
+                            help="Messages in each POST; a range like 1-500 picks at random" )
+    runparser.add_argument( "--records", action='store_true', default=False,
+                            help="POST records (with keys) instead of plain messages" )
+    runparser.add_argument( "--gzip", action='store_true', default=False, help="gzip the POST bodies" )
+    runparser.add_argument( "--wait-for-delivery", type=float, default=None,
+                            help="Have every POST wait up to this many seconds for delivery" )
+    runparser.add_argument( "--batch-ids", action='store_true', default=False,
+                            help="Give every POST a batch ID" )
+    runparser.add_argument( "--ring-size", type=int, default=0,
+                            help="Have the webserver use a shared-memory ring this big to send to the flusher" )
+    runparser.add_argument( "--kafka-latency", type=float, default=0.005,
+                            help="Seconds the fake kafka takes to acknowledge a message" )
+    runparser.add_argument( "--kafka-failure-rate", type=float, default=0.,
+                            help="Fraction of messages the fake kafka fails to deliver" )
+    runparser.add_argument( "--busy-backoff", type=float, default=0.05,
+                            help="Seconds a client waits after a 503 (server busy) before POSTing again" )
+    runparser.add_argument( "--drain-timeout", type=float, default=60,
+                            help="Most seconds to wait, after the clients stop, for everything to be delivered" )
+    runparser.add_argument( "-o", "--output", default=None, help="Write the results (JSON) here, not to stdout" )
+    runparser.add_argument( "flusher_args", nargs='*', help="Arguments for the flusher (after --)" )
+
+    compareparser = subparsers.add_parser( 'compare', help="Compare the results of two runs" )
+    compareparser.add_argument( "old", help="Results (JSON) of the earlier run" )
+    compareparser.add_argument( "new", help="Results (JSON) of the later run" )
+
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open( args.old ) as ifp:
+            old = json.load( ifp )
+        with open( args.new ) as ifp:
+            new = json.load( ifp )
+        sys.stdout.write( compare( old, new ) )
+        return
+
+    summary = run( args )
+    text = json.dumps( summary, indent=2 )
+    if args.output is None:
+        print( text )
+    else:
+        with open( args.output, 'w' ) as ofp:
+            ofp.write( text + "\n" )
+    post = summary['post_latency_ms'] or {}
+    delivery = summary['delivery_latency_ms'] or {}
+    _logger.info( f"{summary['messages_per_second']:.0f} messages/s, {summary['megabytes_per_second']:.2f} MB/s; "
+                  f"POST p50 {post.get('p50', 0):.2f} ms, p99 {post.get('p99', 0):.2f} ms; "
+                  f"delivery p50 {delivery.get('p50', 0):.2f} ms, p99 {delivery.get('p99', 0):.2f} ms" )
+
+
+# ======================================================================
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# Decompression of POST bodies sent with a Content-Encoding.
+#
+# A Decompressor is fed the compressed body a piece at a time, as it
+#   arrives, and gives back the decompressed data a bounded amount at a
+#   time, so it can go straight into a flusherproto.MessageChunker without
+#   the whole body ever being in memory, compressed or decompressed.  (This
+#   is what asyncserver.py uses.)  DecompressingReader does the same the
+#   other way around: it wraps the request's input stream and gives back a
+#   file-like object with a read() that returns decompressed data, so it
+#   can go into a flusherproto.MessageStreamReader.  Either refuses to
+#   produce more than max_size bytes in total, so a small compressed body
+#   can't make us chew through an enormous amount of data (a "zip bomb").
+#
+# gzip (and deflate) are always supported.  zstd and lz4 need the
+#   zstandard and lz4 python packages; if they aren't installed, those
+#   encodings are reported as unsupported.
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class CompressionError( Exception ):
+    pass
+
+
+class UnsupportedEncoding( CompressionError ):
+    pass
+
+
+class BodyTooLarge( CompressionError ):
+    pass
+
+
+def supported_encodings():
+    encodings = [ 'gzip', 'deflate' ]
+    if zstandard is not None:
+        encodings.append( 'zstd' )
+    if lz4 is not None:
+        encodings.append( 'lz4' )
+    return encodings
+
+
+# zstandard can't be told to stop decompressing after so many bytes, so
+#   compressed zstd data is given to it this much at a time, which bounds
+#   what a single piece can blow up into.
+ZSTD_SLICE = 1024
+
+
+class Decompressor:
+    def __init__( self, encoding, max_size, outsize=65536 ):
+        self.encoding = encoding.strip().lower()
+        self.max_size = max_size
+        self.outsize = outsize
+        self.nbytes = 0
+
+        if self.encoding in ( 'gzip', 'x-gzip', 'deflate' ):
+            # 16+MAX_WBITS means expect a gzip header and trailer; deflate
+            #   (per HTTP) is a zlib stream.
+            self.wbits = 16 + zlib.MAX_WBITS if self.encoding != 'deflate' else zlib.MAX_WBITS
+            self._new = lambda: zlib.decompressobj( self.wbits )
+            self._pieces = self._zlib_pieces
+        elif ( self.encoding == 'zstd' ) and ( zstandard is not None ):
+            self._new = zstandard.ZstdDecompressor().decompressobj
+            self._pieces = self._zstd_pieces
+        elif ( self.encoding == 'lz4' ) and ( lz4 is not None ):
+            self._new = lz4.frame.LZ4FrameDecompressor
+            self._pieces = self._lz4_pieces
+        else:
+            raise UnsupportedEncoding( f"Unsupported Content-Encoding {encoding}; supported encodings are "
+                                       f"{', '.join( supported_encodings() )}" )
+        self.decomp = self._new()
+
+    def feed( self, data ):
+        # Decompress data, the next piece of the compressed body.  Yields
+        #   the decompressed data, at most outsize bytes at a time; the
+        #   rest isn't decompressed until it's asked for.
+        try:
+            for piece in self._pieces( data ):
+                self.nbytes += len( piece )
+                if self.nbytes > self.max_size:
+                    raise BodyTooLarge( f"Decompressed body is more than the maximum of {self.max_size} bytes" )
+                yield piece
+        except CompressionError:
+            raise
+        except Exception as ex:
+            raise CompressionError( f"Failed to decompress {self.encoding} data: {ex}" )
+
+    def end( self ):
+        # Call at the end of the compressed body
+        if not self.decomp.eof:
+            raise CompressionError( f"{self.encoding} data ended early" )
+
+    def _zlib_pieces( self, data ):
+        full = False
+        while True:
+            d = self.decomp
+            if d.eof:
+                # End of one gzip member; there may be another one after it
+                if len( data ) == 0:
+                    return
+                self.decomp = d = self._new()
+            elif ( len( data ) == 0 ) and ( not full ):
+                return
+            out = d.decompress( data, self.outsize )
+            # If that filled the output, there may be more to come even
+            #   without more input
+            full = ( len( out ) == self.outsize )
+            data = d.unused_data if d.eof else d.unconsumed_tail
+            if len( out ) > 0:
+                yield out
+
+    def _lz4_pieces( self, data ):
+        while True:
+            d = self.decomp
+            if d.eof:
+                # End of one lz4 frame; there may be another one after it
+                if len( data ) == 0:
+                    return
+                self.decomp = d = self._new()
+            elif ( len( data ) == 0 ) and d.needs_input:
+                return
+            out = d.decompress( data, max_length=self.outsize )
+            data = ( d.unused_data or b'' ) if d.eof else b''
+            if len( out ) > 0:
+                yield out
+
+    def _zstd_pieces( self, data ):
+        while len( data ) > 0:
+            d = self.decomp
+            if d.eof:
+                # End of one zstd frame; there may be another one after it
+                self.decomp = d = self._new()
+            out = d.decompress( data[:ZSTD_SLICE] )
+            data = data[ZSTD_SLICE:]
+            if d.eof:
+                data = d.unused_data + data
+            for i in range( 0, len( out ), self.outsize ):
+                yield out[ i : i+self.outsize ]
+
+
+class DecompressingReader:
+    def __init__( self, stream, encoding, max_size, readsize=65536 ):
+        self.stream = stream
+        self.readsize = readsize
+        self.decompressor = Decompressor( encoding, max_size, outsize=readsize )
+        self.pieces = iter( () )
+        self.leftover = b''
+        self.ended = False
+
+    @property
+    def nbytes( self ):
+        return self.decompressor.nbytes
+
+    def read( self, n=65536 ):
+        while len( self.leftover ) == 0:
+            piece = next( self.pieces, None )
+            if piece is not None:
+                self.leftover = piece
+            elif self.ended:
+                return b''
+            else:
+                data = self.stream.read( self.readsize )
+                if len( data ) == 0:
+                    self.decompressor.end()
+                    self.ended = True
+                    return b''
+                self.pieces = self.decompressor.feed( data )
+        data = self.leftover[:n]
+        self.leftover = self.leftover[n:]
+        return data
@@ -0,0 +1,179 @@
+# A stand-in for the confluent_kafka module, with a Producer that doesn't
+#   talk to any kafka server, for benchmark.py.  install() puts it in
+#   sys.modules, so it has to be called before flusher is imported.
+#
+# Every message produced is "acknowledged" latency seconds later (by the
+#   first poll() or flush() after that), failing with probability
+#   failure_rate.  If timestamped is True, each message value starts
+#   with the time.time() it was sent to the proxy (a little-endian
+#   double; see benchmark.py), and the time from then to its delivery
+#   report is recorded.  results() gives counts and those latencies.
+#
+# A flusher running in another process picks up its configuration from
+#   the environment (see configure_from_env), and writes results() as JSON
+#   to FAKEKAFKA_RESULTS when it exits.
+
+import os
+import sys
+import json
+import time
+import types
+import heapq
+import atexit
+import random
+import struct
+import threading
+import itertools
+
+SENT = struct.Struct( '<d' )
+
+_config = { 'latency': 0., 'failure_rate': 0., 'timestamped': False, 'queue_size': 1000000 }
+_results = { 'produced': 0, 'delivered': 0, 'failed': 0, 'latencies': [] }
+_lock = threading.Lock()
+# At most this many delivery latencies are kept (a random sample of them
+#   once there are more)
+MAX_LATENCIES = 200000
+
+
+class KafkaException( Exception ):
+    pass
+
+
+class KafkaError:
+    def __init__( self, text, fatal=False ):
+        self.text = text
+        self._fatal = fatal
+
+    def fatal( self ):
+        return self._fatal
+
+    def str( self ):
+        return self.text
+
+    def __str__( self ):
+        return self.text
+
+
+class _Message:
+    def __init__( self, topic, value, key ):
+        self._topic = topic
+        self._value = value
+        self._key = key
+
+    def topic( self ):
+        return self._topic
+
+    def value( self ):
+        return self._value
+
+    def key( self ):
+        return self._key
+
+
+class Producer:
+    def __init__( self, config ):
+        self.config = config
+        # ( due, sequence, topic, value, key, on_delivery ), soonest first
+        self.pending = []
+        self.seq = itertools.count()
+
+    def __len__( self ):
+        return len( self.pending )
+
+    def produce( self, topic, value=None, key=None, headers=None, timestamp=0, partition=-1, on_delivery=None ):
+        if len( self.pending ) >= _config['queue_size']:
+            raise BufferError( "Local: Queue full" )
+        heapq.heappush( self.pending, ( time.monotonic() + _config['latency'], next( self.seq ),
+                                        topic, value, key, on_delivery ) )
+
+    def poll( self, timeout=0 ):
+        # Deliver everything that's due, waiting up to timeout for
+        #   something to be
+        if ( len( self.pending ) > 0 ) and ( timeout is not None ) and ( timeout > 0 ):
+            wait = min( timeout, self.pending[0][0] - time.monotonic() )
+            if wait > 0:
+                time.sleep( wait )
+        elif ( len( self.pending ) == 0 ) and ( timeout is not None ) and ( timeout > 0 ):
+            time.sleep( timeout )
+
+        now = time.monotonic()
+        wallnow = time.time()
+        ndone = 0
+        latencies = []
+        while ( len( self.pending ) > 0 ) and ( self.pending[0][0] <= now ):
+            _due, _seq, topic, value, key, on_delivery = heapq.heappop( self.pending )
+            failed = random.random() < _config['failure_rate']
+            if _config['timestamped'] and ( not failed ) and ( value is not None ) and ( len( value ) >= SENT.size ):
+                latencies.append( wallnow - SENT.unpack_from( value )[0] )
+            if on_delivery is not None:
+                on_delivery( KafkaError( "Fake delivery failure" ) if failed else None,
+                             _Message( topic, value, key ) )
+            ndone += 1
+            with _lock:
+                _results[ 'failed' if failed else 'delivered' ] += 1
+        with _lock:
+            _results['produced'] += ndone
+            _record_latencies( latencies )
+        return ndone
+
+    def flush( self, timeout=None ):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len( self.pending ) > 0:
+            if ( deadline is not None ) and ( time.monotonic() >= deadline ):
+                break
+            self.poll( 0.01 )
+        return len( self.pending )
+
+
+def _record_latencies( latencies ):
+    kept = _results['latencies']
+    for latency in latencies:
+        if len( kept ) < MAX_LATENCIES:
+            kept.append( latency )
+        else:
+            # Reservoir sampling
+            i = random.randrange( _results['delivered'] )
+            if i < MAX_LATENCIES:
+                kept[i] = latency
+
+
+def configure( latency=None, failure_rate=None, timestamped=None, queue_size=None ):
+    for key, value in [ ( 'latency', latency ), ( 'failure_rate', failure_rate ),
+                        ( 'timestamped', timestamped ), ( 'queue_size', queue_size ) ]:
+        if value is not None:
+            _config[ key ] = value
+
+
+def configure_from_env():
+    configure( latency=float( os.getenv( "FAKEKAFKA_LATENCY", "0" ) ),
+               failure_rate=float( os.getenv( "FAKEKAFKA_FAILURE_RATE", "0" ) ),
+               timestamped=os.getenv( "FAKEKAFKA_TIMESTAMPED", "0" ) not in ( "", "0" ) )
+    path = os.getenv( "FAKEKAFKA_RESULTS" )
+    if path is not None:
+        atexit.register( _write_results, path )
+
+
+def _write_results( path ):
+    with open( path, 'w' ) as ofp:
+        json.dump( results(), ofp )
+
+
+def results():
+    with _lock:
+        return { 'produced': _results['produced'], 'delivered': _results['delivered'],
+                 'failed': _results['failed'], 'latencies': list( _results['latencies'] ) }
+
+
+def reset():
+    with _lock:
+        _results.update( produced=0, delivered=0, failed=0, latencies=[] )
+
+
+def install():
+    # Make "import confluent_kafka" get this
+    module = types.ModuleType( 'confluent_kafka' )
+    module.Producer = Producer
+    module.KafkaError = KafkaError
+    module.KafkaException = KafkaException
+    sys.modules[ 'confluent_kafka' ] = module
+    return module
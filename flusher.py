@@ -3,12 +3,34 @@ import os
 import time
 import pathlib
 import socket
-import select
+import selectors
 import logging
 import argparse
+import threading
+import functools
+import math
+import json
+import struct
+import collections
 
 import confluent_kafka
 
+import flusherproto
+import spool
+import ring
+import topicmap
+import batchids
+import metrics
+
+# Each record in the spool (see spool.py) is one message:
+#   1 byte  : record format version; 1 if the message is just the value,
+#             2 if it's a record with key, headers, and timestamp (see
+#             flusherproto.py)
+#   2 bytes : length of the utf-8 encoded topic (little-endian)
+#   topic
+#   the message
+SPOOLREC = struct.Struct( '<BH' )
+
 _logger = logging.getLogger(__name__)
 _logger.propagate = False
 if not _logger.hasHandlers():
@@ -20,51 +42,730 @@ if not _logger.hasHandlers():
     _logger.setLevel( logging.INFO )
 
 
+class _Connection:
+    # State the flusher keeps for each connected client: bytes received
+    #   that don't yet make up a whole frame, and replies that haven't
+    #   been sent yet.
+    def __init__( self, sock ):
+        self.sock = sock
+        self.rbuf = bytearray()
+        self.wbuf = bytearray()
+        self.closing = False
+        # The _Ack we're holding our reply to a MSGS frame for, if any
+        self.waiting = None
+
+
+class _TopicBuffer:
+    # Messages for one topic that haven't been sealed into a _Batch yet.
+    #   If the flusher is spooling, segs[i] is the spool segment that
+    #   message i was written to.
+    def __init__( self, spooling ):
+        self.msgs = []
+        self.segs = [] if spooling else None
+        self.nbytes = 0
+        self.started = time.monotonic()
+        self.acks = []
+
+
+class _Ack:
+    # Keeps track of what happened to the messages of a MSGS frame whose
+    #   sender asked (with FLAG_ACK) to hear back once kafka has them, or
+    #   that has a batch ID (FLAG_BATCHID), so the sender might resend it
+    #   and ask then.  status[i] is the flusherproto.ACK_* of message i of
+    #   the frame.  The flush worker thread fills in status (with
+    #   Flusher.acklock held) and wakes the event loop when nothing is
+    #   pending any more; see Flusher.waits for who gets told.
+    def __init__( self, nmsgs ):
+        self.status = bytearray( [ flusherproto.ACK_PENDING ] ) * nmsgs
+        self.npending = nmsgs
+        self.topic = None
+
+
+class _Batch:
+    # A sealed buffer of messages that the flush worker thread is to send
+    #   to kafka.  Each message is either the message value (bytes), or a
+    #   tuple ( value, key, headers, timestamp ) from
+    #   flusherproto.unpack_record.  todo is the indexes of the messages
+    #   being sent by the current attempt, and sent is those of them that
+    #   were actually handed to the producer.  results is replaced for
+    #   every attempt (and when one is over, so that late delivery reports
+    #   from it are ignored); the delivery report for message i of an
+    #   attempt puts its error (None for success) in results[i].  The
+    #   attempt used producer, and is over once every message in sent has
+    #   a result, or at deadline.  Between attempts, retryat is when to try
+    #   again with the messages that didn't make it.  If the flusher is
+    #   spooling, segs[i] is the spool segment that message i was written
+    #   to, and released is the indexes of the messages that have been
+    #   released from the spool (which must happen exactly once each).
+    #   nbytes is how much the messages count against the memory budget.
+    #   acks is a list of ( start, _Ack ), meaning that messages start and
+    #   on are the ones that _Ack is keeping track of; it's empty unless
+    #   somebody asked to wait for delivery or sent a batch ID.
+    def __init__( self, topic, msgs, segs=None, nbytes=None, acks=[] ):
+        self.topic = topic
+        self.msgs = msgs
+        self.segs = segs
+        self.nbytes = sum( len(m) for m in msgs ) if nbytes is None else nbytes
+        self.acks = acks
+        self.attempts = 0
+        self.todo = range( len( msgs ) )
+        self.sent = []
+        self.results = {}
+        self.released = set()
+        self.producer = None
+        self.attemptstart = None
+        self.deadline = None
+        self.retryat = None
+        self.sealedat = time.monotonic()
+        self.sentat = None
+
+
 class Flusher:
-    def __init__( self, topic=None, force_topic=False, timeout=5, maxmsgs=100,
-                  servers="kafka:9092", max_message_size=262144, batch_size=131072, lingerms=50,
+    def __init__( self, topic=None, force_topic=False, timeout=5, maxmsgs=100, maxbytes=1048576,
+                  adaptive=False, latency_target=1.0,
+                  servers="kafka:9092", max_message_size=262144, max_frame_size=67108864,
+                  batch_size=524288, lingerms=10, compression_type='lz4', compression_level=-1,
+                  delivery_timeout=30, max_retries=5, retry_backoff=0.5, partitioner='murmur2_random',
+                  max_buffered_bytes=268435456, max_batches_waiting=100,
                   sockpath=os.getenv( 'KAFKA_FLUSHER_SOCKET_PATH', "/tmp/flusher_socket" ),
-                  topiccache=os.getenv( 'KAFKA_FLUSHER_TOPIC_CACHE', "/kafka_topic_cache/topic" ) ):
+                  topiccache=os.getenv( 'KAFKA_FLUSHER_TOPIC_CACHE', "/kafka_topic_cache/topic" ),
+                  spooldir=os.getenv( 'KAFKA_FLUSHER_SPOOL_DIR' ), spool_segment_size=67108864,
+                  ringpath=os.getenv( 'KAFKA_FLUSHER_RING_PATH', "/dev/shm/kafka_flusher_ring" ),
+                  ring_size=int( os.getenv( 'KAFKA_FLUSHER_RING_SIZE', "0" ) ), allowed_topics=[],
+                  max_ack_wait=60, batchid_cache_size=100000, batchid_ttl=600, idempotence=True ):
         self.timeout = timeout
         self.maxmsgs = maxmsgs
+        self.maxbytes = maxbytes
         self.servers = servers
         self.max_message_size = max_message_size
+        self.max_frame_size = max_frame_size
         self.batch_size = batch_size
         self.lingerms = lingerms
+        self.compression_type = compression_type
+        self.compression_level = compression_level
+        self.delivery_timeout = delivery_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.partitioner = partitioner
+        self.idempotence = idempotence
+        self.max_retry_backoff = 30
+        self.max_buffered_bytes = max_buffered_bytes
+        self.max_batches_waiting = max_batches_waiting
         self.sockpath = pathlib.Path( sockpath )
 
-        self.msgs = []
+        # One producer for the life of the flusher; see get_producer()
+        self.producer = None
+        self.producer_dead = False
+        self.ndelivered = 0
+        self.nfailed = 0
+
+        # Double buffering: the event loop appends incoming messages to
+        #   the _TopicBuffer in self.buffers for their topic.  flush()
+        #   seals those into _Batches on self.sealed and starts new ones,
+        #   and the flush worker thread (see _flush_worker()) takes the
+        #   sealed batches and sends them to kafka; self.inflight is the
+        #   batches it's sending (or waiting to retry), which only it
+        #   touches.  self.flushcond protects self.sealed and
+        #   self.stopping.
+        self.buffers = {}
+        self.sealed = collections.deque()
+        self.flushcond = threading.Condition()
+        self.flushthread = None
+        self.stopping = False
+        self.inflight = []
+        # How long the flush worker thread waits for delivery reports
+        #   before looking for newly sealed batches
+        self.poll_interval = 0.02
+        self.nbatches = 0
+        self.nretries = 0
+        self.ndropped = 0
+
+        # Memory budget.  bytes_in is only touched by the event loop, and
+        #   bytes_out only by the flush worker thread, so neither needs a
+        #   lock; the difference is what we're holding on to.
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.nbusy = 0
+
+        # If we're spooling, every message is written to the spool before
+        #   we acknowledge it, and released from the spool once kafka has
+        #   it.
+        self.spool = None if spooldir is None else spool.Spool( spooldir, segment_size=spool_segment_size )
+
+        # If ring_size is more than 0, webserver workers can also hand us
+        #   messages through a shared-memory ring (see ring.py) instead of
+        #   the socket.  It's set up in __call__.
+        self.ringpath = ringpath
+        self.ring_size = ring_size
+        self.ring = None
+        self.ringpending = False
+
+        # Connections waiting to hear about the delivery of messages (see
+        #   _Ack), as a list of ( deadline, _Ack, conn, reply verb ).  Only
+        #   the event loop touches self.waits.  When the flush worker
+        #   thread finishes an _Ack, it writes a byte to self.ackpipe (set
+        #   up in __call__) to wake the event loop.  (It also does that
+        #   when it's ready for another batch, if flushing is adaptive.)
+        #   Batches that have no _Acks never touch any of this.
+        self.max_ack_wait = max_ack_wait
+        self.waits = []
+        self.acklock = threading.Lock()
+        self.ackpipe = None
+
+        # Batch IDs we've taken messages for (see batchids.py); a frame
+        #   with one of these isn't taken again.  Kept on disk too if
+        #   we're spooling.
+        self.batchids = batchids.BatchIdCache( maxsize=batchid_cache_size, ttl=batchid_ttl,
+                                               path=None if spooldir is None else self.spool.directory / "batchids" )
+        self.nduplicates = 0
+        # Topics to flush right away, because somebody is waiting
+        self.flushnow = set()
+        # When the next topic is due to be flushed (see _flush_limits)
+        self.nextflush = math.inf
+
+        # Adaptive flushing (see _flush_limits).  ack_latency is only
+        #   written by the flush worker thread; arrivals is topic ->
+        #   ( average seconds between messages, when the last ones came ),
+        #   only touched by the event loop.
+        self.adaptive = adaptive
+        self.latency_target = latency_target
+        self.ack_latency = 0.
+        self.arrivals = {}
+
+        # Metrics (see metrics.py) that the webserver gets with a STAT
+        #   frame.  The counts stats() keeps are copied into statmetrics
+        #   then; the histograms are updated as things happen, each by
+        #   only one thread (noted below).
+        self.metrics = metrics.Metrics()
+        self.statmetrics = {}
+        for key, kind, help in [ ( 'received', 'counter', "Messages received" ),
+                                 ( 'buffered', 'gauge', "Messages not yet sealed into a batch" ),
+                                 ( 'batches_waiting', 'gauge', "Sealed batches waiting to go to kafka" ),
+                                 ( 'batches_in_flight', 'gauge', "Batches being sent to kafka" ),
+                                 ( 'batches_sent', 'counter', "Batches completely delivered to kafka" ),
+                                 ( 'batch_retries', 'counter', "Retries of batches not completely delivered" ),
+                                 ( 'delivered', 'counter', "Messages delivered to kafka" ),
+                                 ( 'delivery_failures', 'counter', "Failed attempts to deliver a message" ),
+                                 ( 'dropped', 'counter', "Messages given up on after all retries" ),
+                                 ( 'buffered_bytes', 'gauge', "Bytes of messages held and not yet delivered" ),
+                                 ( 'busy_rejections', 'counter', "Frames refused with BUSY" ),
+                                 ( 'waiting_for_delivery', 'gauge', "Connections waiting to hear about delivery" ),
+                                 ( 'duplicate_batches', 'counter', "Frames not taken because of a seen batch ID" ),
+                                 ( 'ack_latency', 'gauge', "Recent average seconds for kafka to take a batch" ) ]:
+            name = f"kafka_flusher_{key}" + ( "_total" if kind == 'counter' else "" )
+            declare = self.metrics.counter if kind == 'counter' else self.metrics.gauge
+            self.statmetrics[ key ] = declare( name, help )
+        # Event loop
+        self.frame_seconds = self.metrics.histogram( 'kafka_flusher_frame_seconds',
+                                                     "Time to handle a MSGS frame" )
+        self.sync_seconds = self.metrics.histogram( 'kafka_flusher_sync_seconds',
+                                                    "Time to sync the spool to disk" )
+        self.batch_messages = self.metrics.histogram( 'kafka_flusher_batch_messages',
+                                                      "Messages in each sealed batch", metrics.COUNT_BUCKETS )
+        self.batch_bytes = self.metrics.histogram( 'kafka_flusher_batch_bytes',
+                                                   "Bytes of messages in each sealed batch", metrics.BYTE_BUCKETS )
+        # Flush worker thread
+        self.queue_seconds = self.metrics.histogram( 'kafka_flusher_batch_queue_seconds',
+                                                     "Time from sealing a batch to starting to send it" )
+        self.send_seconds = self.metrics.histogram( 'kafka_flusher_batch_send_seconds',
+                                                    "Time to send a batch to kafka, including retries" )
+
         self.tot = 0
         self.debugevery = 100
         self.infoevery = 10000
-        self.lastflush = time.monotonic()
+        self.nextinfo = 0
+        self.nextdebug = 0
 
+        # The topics we send to, and the default one (see topicmap.py),
+        #   are kept in the topic cache file so they survive restarts.  (If
+        #   the cache can't be written, e.g. because its directory isn't
+        #   there, the flusher runs without it.)
         self.topiccache = pathlib.Path( topiccache )
+        cached = topicmap.TopicMap.read( self.topiccache ) if self.topiccache.is_file() else None
+        self.topicmap = topicmap.TopicMap() if cached is None else cached.copy()
         if force_topic:
             if topic is None:
                 raise ValueError( "force_topic requires a topic!" )
-            self.topic = topic
+            self.topicmap.set_default( topic )
+        elif self.topicmap.default is None:
+            if topic is None:
+                raise ValueError( "No cached topic, need to specify a topic." )
+            self.topicmap.set_default( topic )
+        for t in allowed_topics:
+            self.topicmap.allow( t )
+        self.topiccache_mtime = None
+        if self.topicmap != cached:
+            self._save_topicmap( self.topicmap )
         else:
-            if self.topiccache.is_file():
-                with open( self.topiccache ) as ifp:
-                    self.topic = ifp.readline().strip()
-            else:
-                if topic is None:
-                    raise ValueError( "No cached topic, need to specify a topic." )
-                self.topic = topic
-
-
-    def flush( self ):
-        _logger.debug( f"Flushing {len(self.msgs)} messages..." )
-        producer = confluent_kafka.Producer( { 'bootstrap.servers': self.servers,
-                                               'batch.size': self.batch_size,
-                                               'linger.ms': self.lingerms } )
-        for msg in self.msgs:
-            producer.produce( self.topic, msg )
-        producer.flush()
-        self.msgs = []
-        self.lastflush = time.monotonic()
-        _logger.debug( "...done flushing." )
+            self.topiccache_mtime = self.topiccache.stat().st_mtime_ns
+        self.topiccache_lastcheck = time.monotonic()
+
+
+    def _delivery_report( self, batch, results, i, err, msg ):
+        # Called (from producer.poll() in the flush worker thread) once for
+        #   every message we've produced, after kafka has either accepted it
+        #   or librdkafka has given up on it.  results is that of the
+        #   attempt that produced it; if that attempt is already over, the
+        #   message has been (or will be) produced again, or given up on,
+        #   so the report doesn't count.
+        if results is not batch.results:
+            return
+        results[i] = err
+        if err is not None:
+            self.nfailed += 1
+            _logger.debug( f"Failed to deliver message to topic {msg.topic()}: {err}" )
+        else:
+            self.ndelivered += 1
+            self._release( batch, i )
+
+
+    def _release( self, batch, i ):
+        # Message i of batch is done with (delivered, or given up on), so
+        #   the spool doesn't need it any more
+        if ( batch.segs is None ) or ( i in batch.released ):
+            return
+        batch.released.add( i )
+        self.spool.release( batch.segs[i] )
+
+
+    def _producer_error( self, err ):
+        # Most errors that come here (brokers down, connection refused,
+        #   etc.) are transient, and librdkafka will keep reconnecting on
+        #   its own.  A fatal error means this producer instance is useless,
+        #   so mark it so that get_producer() will build a new one.
+        if err.fatal():
+            _logger.error( f"Fatal kafka producer error, will reconnect: {err}" )
+            self.producer_dead = True
+        else:
+            _logger.warning( f"Kafka producer error: {err}" )
+
+
+    def get_producer( self ):
+        # Return the flusher's long-lived kafka producer, creating a new one
+        #   if this is the first time or if the last one died.
+        if ( self.producer is not None ) and self.producer_dead:
+            nlost = len( self.producer )
+            if nlost > 0:
+                _logger.error( f"Discarding dead kafka producer with {nlost} undelivered messages." )
+            self.producer = None
+
+        if self.producer is None:
+            _logger.info( f"Creating kafka producer for {self.servers}" )
+            # The producer lives for as long as the flusher does, so let
+            #   librdkafka form large batches (we hand it a whole flush's
+            #   worth of messages at once), keep the broker connections
+            #   alive, and back off sanely when reconnecting.
+            self.producer = confluent_kafka.Producer( { 'bootstrap.servers': self.servers,
+                                                        'batch.size': self.batch_size,
+                                                        'linger.ms': self.lingerms,
+                                                        'socket.keepalive.enable': True,
+                                                        'reconnect.backoff.ms': 100,
+                                                        'reconnect.backoff.max.ms': 10000,
+                                                        'message.timeout.ms': int( self.delivery_timeout * 1000 ),
+                                                        'compression.type': self.compression_type,
+                                                        'compression.level': self.compression_level,
+                                                        'partitioner': self.partitioner,
+                                                        # So that librdkafka's own retries can't
+                                                        #   duplicate or reorder messages
+                                                        'enable.idempotence': self.idempotence,
+                                                        'error_cb': self._producer_error } )
+            self.producer_dead = False
+
+        return self.producer
+
+
+    def flush( self, topic=None ):
+        # Hand the messages accumulated so far for topic (or for every
+        #   topic, if topic is None) to the flush worker thread, and start
+        #   accumulating new batches.  This doesn't wait for anything to
+        #   happen with kafka.
+        topics = list( self.buffers.keys() ) if topic is None else [ topic ]
+        for topic in topics:
+            buf = self.buffers.pop( topic, None )
+            if ( buf is None ) or ( len( buf.msgs ) == 0 ):
+                continue
+            _logger.debug( f"Sealing a batch of {len(buf.msgs)} messages for topic {topic}..." )
+            self.batch_messages.observe( len( buf.msgs ) )
+            self.batch_bytes.observe( buf.nbytes )
+            with self.flushcond:
+                self.sealed.append( _Batch( topic, buf.msgs, buf.segs, buf.nbytes, buf.acks ) )
+                self.flushcond.notify()
+
+
+    def stats( self ):
+        return { 'received': self.tot,
+                 'buffered': sum( len( buf.msgs ) for buf in self.buffers.values() ),
+                 'batches_waiting': len( self.sealed ),
+                 'batches_in_flight': len( self.inflight ),
+                 'batches_sent': self.nbatches,
+                 'batch_retries': self.nretries,
+                 'delivered': self.ndelivered,
+                 'delivery_failures': self.nfailed,
+                 'dropped': self.ndropped,
+                 'buffered_bytes': self.bytes_in - self.bytes_out,
+                 'busy_rejections': self.nbusy,
+                 'waiting_for_delivery': len( self.waits ),
+                 'duplicate_batches': self.nduplicates,
+                 'ack_latency': self.ack_latency }
+
+
+    def metrics_snapshot( self ):
+        # What to send back for a STAT frame
+        stats = self.stats()
+        for key, metric in self.statmetrics.items():
+            metric.set( stats[ key ] )
+        return self.metrics.snapshot()
+
+
+    def _start_attempt( self, batch ):
+        # Produce the messages of batch whose indexes are in batch.todo.
+        #   This doesn't wait for their delivery reports; those come in
+        #   through poll() (see _delivery_report), and _attempt_over says
+        #   when they're all in.
+        batch.attempts += 1
+        batch.retryat = None
+        results = {}
+        batch.results = results
+        sent = []
+        batch.sent = sent
+        batch.attemptstart = time.monotonic()
+        # librdkafka gives up on a message after delivery_timeout, so every
+        #   message will get a delivery report by then unless the
+        #   producer itself dies.
+        batch.deadline = batch.attemptstart + self.delivery_timeout + 5
+        batch.producer = None
+        ondelivery = functools.partial( self._delivery_report, batch, results )
+        try:
+            producer = self.get_producer()
+            batch.producer = producer
+            for i in batch.todo:
+                msg = batch.msgs[i]
+                while True:
+                    try:
+                        if isinstance( msg, tuple ):
+                            value, key, headers, timestamp = msg
+                            producer.produce( batch.topic, value, key=key, headers=headers,
+                                              timestamp=0 if timestamp is None else timestamp,
+                                              on_delivery=functools.partial( ondelivery, i ) )
+                        else:
+                            producer.produce( batch.topic, msg, on_delivery=functools.partial( ondelivery, i ) )
+                        sent.append( i )
+                        break
+                    except BufferError:
+                        # librdkafka's local queue is full; wait for some
+                        #   deliveries to finish to make room.
+                        producer.poll( 0.1 )
+        except Exception as ex:
+            # Whatever didn't get produced counts as failed (and will be
+            #   retried); the messages that did still get their delivery
+            #   reports, and mustn't be produced again.
+            _logger.error( f"Exception producing to kafka after {len(sent)} of {len(batch.todo)} messages: {ex}" )
+
+
+    def _attempt_over( self, batch, now ):
+        # True if every message of batch's current attempt has a delivery
+        #   report, or never will
+        return ( ( len( batch.results ) >= len( batch.sent ) ) or ( now >= batch.deadline )
+                 or ( batch.producer is not self.producer ) or self.producer_dead )
+
+
+    def _finish_attempt( self, batch, now ):
+        # Called from the flush worker thread once batch's current attempt
+        #   is over.  Returns True if the batch is done with; otherwise,
+        #   the messages that weren't delivered are to be tried again at
+        #   batch.retryat.
+        todo = [ i for i in batch.todo if batch.results.get( i, True ) is not None ]
+        batch.todo = todo
+        batch.results = {}
+        self.ack_latency += 0.2 * ( now - batch.attemptstart - self.ack_latency )
+        final = batch.attempts > self.max_retries
+
+        if len( batch.acks ) > 0:
+            self._update_acks( batch, todo, final )
+
+        if len( todo ) == 0:
+            self.nbatches += 1
+            self.bytes_out += batch.nbytes
+            self.send_seconds.observe( now - batch.sentat )
+            return True
+
+        if final:
+            _logger.error( f"Giving up on {len(todo)} of {len(batch.msgs)} messages for topic {batch.topic} "
+                           f"after {batch.attempts} attempts." )
+            self.ndropped += len( todo )
+            for i in todo:
+                self._release( batch, i )
+            self.bytes_out += batch.nbytes
+            self.send_seconds.observe( now - batch.sentat )
+            return True
+
+        backoff = min( self.retry_backoff * 2 ** ( batch.attempts - 1 ), self.max_retry_backoff )
+        _logger.warning( f"Failed to deliver {len(todo)} of {len(batch.msgs)} messages to topic {batch.topic}, "
+                         f"retrying in {backoff:.1f} s." )
+        self.nretries += 1
+        batch.retryat = now + backoff
+        return False
+
+
+    def _update_acks( self, batch, notdone, final ):
+        # Called from the flush worker thread after each attempt at sending
+        #   batch.  notdone is the indexes of the messages that haven't been
+        #   delivered; if final is True, they never will be.
+        notdone = set( notdone )
+        wake = False
+        with self.acklock:
+            for start, ack in batch.acks:
+                if ack.npending == 0:
+                    continue
+                status = ack.status
+                for j in range( len( status ) ):
+                    if status[j] != flusherproto.ACK_PENDING:
+                        continue
+                    if start + j not in notdone:
+                        status[j] = flusherproto.ACK_DELIVERED
+                    elif final:
+                        status[j] = flusherproto.ACK_FAILED
+                    else:
+                        continue
+                    ack.npending -= 1
+                if ack.npending == 0:
+                    wake = True
+        if wake:
+            self._wake_loop()
+
+
+    def _wake_loop( self ):
+        # Called from the flush worker thread
+        try:
+            os.write( self.ackpipe[1], b'\0' )
+        except BlockingIOError:
+            # Pipe is full, so the event loop will wake up anyway
+            pass
+
+
+    def _finish_acks( self ):
+        # Queue up replies for the connections whose _Acks have nothing
+        #   pending any more, and for the ones that have waited as long as
+        #   they're going to.  Returns the connections that have replies to
+        #   send.
+        now = time.monotonic()
+        finished = []
+        with self.acklock:
+            waits = []
+            for wait in self.waits:
+                deadline, ack, conn, verb = wait
+                if ( ack.npending == 0 ) or ( now >= deadline ):
+                    finished.append( ( conn, verb, len( ack.status ), bytes( ack.status ) ) )
+                else:
+                    waits.append( wait )
+            self.waits = waits
+
+        toreply = []
+        for conn, verb, nmsgs, status in finished:
+            conn.waiting = None
+            if conn.sock.fileno() < 0:
+                continue
+            conn.wbuf += flusherproto.pack_frame( verb, flusherproto.MSGLEN.pack( nmsgs ) + status )
+            # We stopped reading frames from conn while it was waiting
+            try:
+                self._process_input( conn )
+            except Exception as ex:
+                _logger.error( f"Error talking to client, closing connection: {ex}" )
+                self._close( conn )
+                continue
+            toreply.append( conn )
+        return toreply
+
+
+    def _reply_msgs( self, conn, verb, nmsgs, ackwait, ack ):
+        # Return the reply (verb and payload) to a MSGS frame from conn
+        #   that had nmsgs messages, whose delivery ack (an _Ack, or None)
+        #   is keeping track of.  If the sender wants to wait for delivery
+        #   (ackwait isn't None), and some of the messages are still
+        #   pending, returns ( None, None ) and holds the reply for later
+        #   (see _finish_acks).
+        if ( ackwait is None ) or ( ack is None ):
+            return verb, flusherproto.MSGLEN.pack( nmsgs )
+        with self.acklock:
+            if ack.npending == 0:
+                return verb, flusherproto.MSGLEN.pack( nmsgs ) + bytes( ack.status )
+        self.waits.append( ( time.monotonic() + min( ackwait, self.max_ack_wait ), ack, conn, verb ) )
+        conn.waiting = ack
+        # Don't keep them waiting on the flush timeout
+        self.flushnow.add( ack.topic )
+        return None, None
+
+
+    def _buffer( self, topic, msgs, records=False, ack=None ):
+        # Add msgs (a list) to the batch we're accumulating for topic (None
+        #   means the default topic), writing them to the spool first if
+        #   we're spooling.  If records is True, each message is a record
+        #   with key, headers, and timestamp (see flusherproto.py).  If ack
+        #   (an _Ack) is given, it keeps track of these messages.
+        if topic is None:
+            topic = self.topicmap.default
+        # Unpack the records first, so that if one is bad, none get buffered
+        toproduce = [ flusherproto.unpack_record( m ) for m in msgs ] if records else msgs
+        buf = self.buffers.get( topic )
+        if buf is None:
+            buf = self.buffers[ topic ] = _TopicBuffer( self.spool is not None )
+        if self.spool is not None:
+            btopic = topic.encode( 'utf-8' )
+            prefix = SPOOLREC.pack( 2 if records else 1, len(btopic) ) + btopic
+            for msg in msgs:
+                buf.segs.append( self.spool.append( prefix + msg ) )
+        nbytes = sum( len(m) for m in msgs )
+        if ack is not None:
+            buf.acks.append( ( len( buf.msgs ), ack ) )
+            ack.topic = topic
+        buf.msgs.extend( toproduce )
+        buf.nbytes += nbytes
+        self.bytes_in += nbytes
+        if self.adaptive:
+            self._note_arrival( topic, len( msgs ) )
+
+
+    def _note_arrival( self, topic, nmsgs ):
+        # Keep a moving average of the time between messages for topic
+        now = time.monotonic()
+        interval, last = self.arrivals.get( topic, ( None, None ) )
+        if ( last is not None ) and ( nmsgs > 0 ):
+            sample = ( now - last ) / nmsgs
+            interval = sample if interval is None else interval + 0.2 * ( sample - interval )
+        self.arrivals[ topic ] = ( interval, now )
+
+
+    def _flush_limits( self, topic ):
+        # Returns ( maxmsgs, maxbytes, linger, timeout ): topic's messages
+        #   are flushed once there are maxmsgs of them, or they add up to
+        #   maxbytes, or the oldest has waited linger seconds.
+        #
+        # Normally, linger is just timeout.  With adaptive flushing, it's
+        #   however much of the latency target is left after the time kafka
+        #   has recently been taking to acknowledge a batch, and there's no
+        #   message count limit; so batches are as big as the arrival rate
+        #   makes them in that time.  If messages for the topic are coming
+        #   further apart than that, waiting wouldn't get any more into the
+        #   batch, so linger is 0.  (And see _loop for when the flush worker
+        #   thread is behind.)  The topic map can override any of these for
+        #   a topic.
+        settings = self.topicmap.settings( topic )
+        maxbytes = settings.get( 'maxbytes', self.maxbytes )
+        timeout = settings.get( 'timeout', self.timeout )
+        if not self.adaptive:
+            return settings.get( 'maxmsgs', self.maxmsgs ), maxbytes, timeout, timeout
+        target = settings.get( 'latency_target', self.latency_target )
+        linger = min( timeout, max( 0., target - self.ack_latency ) )
+        interval, _last = self.arrivals.get( topic, ( None, None ) )
+        if ( interval is None ) or ( interval > linger ):
+            linger = 0.
+        return settings.get( 'maxmsgs', math.inf ), maxbytes, linger, timeout
+
+
+    def _room( self ):
+        # How many more bytes of messages we're willing to hold right now
+        if len( self.sealed ) >= self.max_batches_waiting:
+            return 0
+        return self.max_buffered_bytes - ( self.bytes_in - self.bytes_out )
+
+
+    def _busy( self, nbytes ):
+        # Returns the number of seconds the client should wait before trying
+        #   again if taking on nbytes more would put us over our memory
+        #   budget or we're too far behind sending things to kafka, or 0
+        #   if we can take it.
+        if nbytes <= self._room():
+            return 0
+        self.nbusy += 1
+        if self.nbusy % 1000 == 1:
+            _logger.warning( f"Refusing messages: {self.bytes_in - self.bytes_out} bytes buffered, "
+                             f"{len(self.sealed)} batches waiting to go to kafka." )
+        return max( 1, math.ceil( self.timeout ) )
+
+
+    def _replay_spool( self ):
+        # Queue up everything left in the spool from the last time the
+        #   flusher ran.  They might have made it to kafka already if
+        #   we died at just the wrong moment, but better twice than never.
+        bytopic = {}
+        for segno, data in self.spool.replay():
+            version, topiclen = SPOOLREC.unpack_from( data )
+            topic = str( data[ SPOOLREC.size : SPOOLREC.size+topiclen ], 'utf-8' )
+            msg = data[ SPOOLREC.size+topiclen: ]
+            msgs, segs, sizes = bytopic.setdefault( topic, ( [], [], [] ) )
+            msgs.append( flusherproto.unpack_record( msg ) if version == 2 else msg )
+            segs.append( segno )
+            sizes.append( len( msg ) )
+
+        for topic, ( msgs, segs, sizes ) in bytopic.items():
+            _logger.info( f"Replaying {len(msgs)} messages for topic {topic} from spool {self.spool.directory}" )
+            for i in range( 0, len(msgs), self.maxmsgs ):
+                batch = _Batch( topic, msgs[ i:i+self.maxmsgs ], segs[ i:i+self.maxmsgs ],
+                                sum( sizes[ i:i+self.maxmsgs ] ) )
+                self.bytes_in += batch.nbytes
+                self.sealed.append( batch )
+
+
+    def _flush_worker( self ):
+        # Runs in a background thread, sending sealed batches to kafka.
+        #   Each batch is produced as soon as it's taken off self.sealed,
+        #   without waiting for the ones before it to be delivered, so
+        #   there can be many batches in flight at once, and the producer
+        #   (which keeps its connections to kafka busy) is never left idle
+        #   waiting for us.  Delivery reports come in as we poll the
+        #   producer; once every message of a batch has one, the ones that
+        #   failed (only those) are retried after a backoff, while the
+        #   batches after it carry on.  (So a retried message can reach
+        #   kafka after messages sealed later than it.)  Exits once
+        #   self.stopping is set and there's nothing left to send.
+        while True:
+            with self.flushcond:
+                while ( len( self.sealed ) == 0 ) and ( len( self.inflight ) == 0 ) and ( not self.stopping ):
+                    self.flushcond.wait()
+                if ( len( self.sealed ) == 0 ) and ( len( self.inflight ) == 0 ):
+                    return
+                if ( len( self.sealed ) == 0 ) and all( b.retryat is not None for b in self.inflight ):
+                    # Nothing to poll for; just wait for the next retry
+                    #   (or a new batch)
+                    self.flushcond.wait( max( 0, min( b.retryat for b in self.inflight ) - time.monotonic() ) )
+                taken = list( self.sealed )
+                self.sealed.clear()
+            if self.adaptive and ( len( taken ) > 0 ):
+                # The event loop may be holding on to messages until we're
+                #   ready for more
+                self._wake_loop()
+            try:
+                self._pump( taken )
+            except Exception as ex:
+                _logger.exception( f"Unexpected exception in flush worker: {ex}" )
+
+
+    def _pump( self, taken ):
+        # One time around the flush worker thread's loop: start sending
+        #   the newly sealed batches in taken, start any retries that are
+        #   due, wait a little for delivery reports, and finish the
+        #   attempts that are over.
+        now = time.monotonic()
+        for batch in taken:
+            self.queue_seconds.observe( now - batch.sealedat )
+            batch.sentat = now
+            self.inflight.append( batch )
+            self._start_attempt( batch )
+        for batch in self.inflight:
+            if ( batch.retryat is not None ) and ( now >= batch.retryat ):
+                self._start_attempt( batch )
+
+        if ( self.producer is not None ) and any( b.retryat is None for b in self.inflight ):
+            self.producer.poll( 0 if len( self.sealed ) > 0 else self.poll_interval )
+
+        now = time.monotonic()
+        inflight = []
+        for batch in self.inflight:
+            if ( batch.retryat is not None ) or ( not self._attempt_over( batch, now ) ):
+                inflight.append( batch )
+            elif not self._finish_attempt( batch, now ):
+                inflight.append( batch )
+        self.inflight = inflight
 
 
     def __call__( self ):
@@ -73,75 +774,398 @@ class Flusher:
             self.sockpath.unlink()
         sock.bind( str(self.sockpath) )
         sock.listen()
-        poller = select.poll()
-        poller.register( sock )
+        sock.setblocking( False )
+        self.selector = selectors.DefaultSelector()
+        self.selector.register( sock, selectors.EVENT_READ, None )
+
+        if self.ring_size > 0:
+            self.ring = ring.RingConsumer( self.ringpath, capacity=self.ring_size )
+            self.selector.register( self.ring, selectors.EVENT_READ, self.ring )
+            _logger.info( f"Also taking messages from shared-memory ring {self.ringpath} "
+                          f"({self.ring.capacity} bytes)" )
+
+        self.ackpipe = os.pipe()
+        for fd in self.ackpipe:
+            os.set_blocking( fd, False )
+        self.selector.register( self.ackpipe[0], selectors.EVENT_READ, self.ackpipe )
+
+        if self.spool is not None:
+            self._replay_spool()
+        self.flushthread = threading.Thread( target=self._flush_worker, name="flush-worker", daemon=True )
+        self.flushthread.start()
 
-        nextinfo = self.tot
-        nextdebug = self.tot
-        self.lastflush = time.monotonic()
         _logger.info( f"Listening on {self.sockpath} for messages..." )
+        try:
+            self._loop( sock )
+        finally:
+            # Send anything we've got before exiting
+            self.flush()
+            with self.flushcond:
+                self.stopping = True
+                self.flushcond.notify()
+            self.flushthread.join()
+            if self.producer is not None:
+                nleft = self.producer.flush( self.timeout )
+                if nleft > 0:
+                    _logger.error( f"Exiting with {nleft} messages not delivered to kafka." )
+            if self.spool is not None:
+                self.spool.close()
+            self.batchids.close()
+            if self.ring is not None:
+                # Anything still in the ring stays there for next time
+                self.ring.close()
+            for fd in self.ackpipe:
+                os.close( fd )
+
+
+    def _count_received( self, nmsgs ):
+        self.tot += nmsgs
+        if ( self.tot >= self.nextinfo ):
+            _logger.info( f"Have received {self.tot} messages; {len(self.sealed)} batches waiting to go "
+                          f"to kafka; {self.ndelivered} delivered, {self.nfailed} delivery failures, "
+                          f"{self.ndropped} dropped." )
+            self.nextinfo = self.tot + self.infoevery
+        if ( self.tot >= self.nextdebug ):
+            _logger.debug( f"Have received {self.tot} messages." )
+            self.nextdebug = self.tot + self.debugevery
+
+
+    def _take_from_ring( self, maxbytes=None ):
+        # Buffer messages that webserver workers have put in the ring, up
+        #   to about maxbytes of them.  The space in the ring isn't given
+        #   back until _loop has synced the spool.
+        for payload, nmsgs, flags in self.ring.records( maxbytes ):
+            try:
+                topic, msgpayload = flusherproto.unpack_topic( payload, flags )
+                msgs = flusherproto.split_messages( msgpayload, self.max_message_size )
+                if len( msgs ) != nmsgs:
+                    _logger.warning( f"Ring record claimed {nmsgs} messages, but had {len(msgs)}" )
+                self._buffer( topic, msgs, records=bool( flags & flusherproto.FLAG_RECORDS ) )
+            except flusherproto.ProtocolError as ex:
+                _logger.error( f"Discarding bad {len(payload)}-byte record from the ring: {ex}" )
+                continue
+            finally:
+                payload.release()
+            self._count_received( len(msgs) )
+
+
+    def _update_topicmap( self, change ):
+        # Apply change (a function that modifies a TopicMap) to the topic
+        #   map and save it.  Start from what's in the topic cache file, in
+        #   case another flusher shard has changed it.
+        self._check_topic_cache()
+        newmap = self.topicmap.copy()
+        change( newmap )
+        if newmap != self.topicmap:
+            self._save_topicmap( newmap )
+            self.topicmap = newmap
+
+
+    def _save_topicmap( self, newmap ):
+        # Write newmap to the topic cache file.  If that fails, carry on
+        #   with the map in memory; it just won't survive a restart (or
+        #   reach the other shards).
+        try:
+            newmap.write( self.topiccache )
+            self.topiccache_mtime = self.topiccache.stat().st_mtime_ns
+        except OSError as ex:
+            _logger.warning( f"Failed to write topic cache {self.topiccache}, topic changes won't "
+                             f"be remembered: {ex}" )
+
+
+    def _change_topic( self, topic ):
+        # Messages still in the ring were sent before the topic changed, so
+        #   if they don't say which topic they're for, they're for the old
+        #   default.
+        if self.ring is not None:
+            self._take_from_ring()
+        self._update_topicmap( lambda tm: tm.set_default( topic ) )
+
+
+    def _check_topic_cache( self ):
+        # If another flusher shard changed the topic map (e.g. because we
+        #   were down when the webserver told all the shards about a topic
+        #   change), follow it.
+        try:
+            mtime = self.topiccache.stat().st_mtime_ns
+        except OSError:
+            return
+        if mtime == self.topiccache_mtime:
+            return
+        try:
+            newmap = topicmap.TopicMap.read( self.topiccache )
+        except ( OSError, ValueError ) as ex:
+            _logger.error( f"Failed to read topic cache {self.topiccache}: {ex}" )
+            return
+        self.topiccache_mtime = mtime
+        if newmap.default is None:
+            return
+        if newmap.default != self.topicmap.default:
+            _logger.info( f"Default topic changed to {newmap.default} in {self.topiccache}" )
+            if self.ring is not None:
+                self._take_from_ring()
+        self.topicmap = newmap
+
+
+    def _handle_frame( self, conn, verb, flags, payload ):
+        # Handle one complete frame from conn; return the verb and payload
+        #   of the reply, or ( None, None ) if the reply has to wait (see
+        #   _Ack).
+        try:
+            if verb == b'MSGS':
+                if len( payload ) > self.max_buffered_bytes:
+                    raise ValueError( f"{len(payload)} bytes of messages is more than the flusher's "
+                                      f"limit of {self.max_buffered_bytes}" )
+                # Anything already in the ring was sent before this, so
+                #   should go first
+                if ( self.ring is not None ) and ( self._room() > 0 ):
+                    self._take_from_ring( self._room() )
+                ackwait, payload = flusherproto.unpack_ackwait( payload, flags )
+                batchid, payload = flusherproto.unpack_batchid( payload, flags )
+                if batchid is not None:
+                    seen = self.batchids.lookup( batchid )
+                    if seen is not None:
+                        _logger.debug( f"Not taking duplicate batch {batchid}" )
+                        self.nduplicates += 1
+                        nmsgs, ack = seen
+                        return self._reply_msgs( conn, b'DUPL', nmsgs, ackwait, ack )
+                retryafter = self._busy( len(payload) )
+                if retryafter > 0:
+                    return b'BUSY', flusherproto.MSGLEN.pack( retryafter )
+                topic, msgpayload = flusherproto.unpack_topic( payload, flags )
+                msgs = flusherproto.split_messages( msgpayload, self.max_message_size )
+                # Only keep track of delivery if somebody might ask about it
+                ack = _Ack( len(msgs) ) if ( ackwait is not None ) or ( batchid is not None ) else None
+                self._buffer( topic, msgs, records=bool( flags & flusherproto.FLAG_RECORDS ), ack=ack )
+                if batchid is not None:
+                    self.batchids.add( batchid, len(msgs), ack )
+                self._count_received( len(msgs) )
+                return self._reply_msgs( conn, b'OK  ', len(msgs), ackwait, ack )
+
+            elif verb == b'STAT':
+                return b'OK  ', json.dumps( self.metrics_snapshot() ).encode( 'utf-8' )
+
+            elif verb == b'TPIC':
+                self._change_topic( str( payload, 'utf-8' ) )
+                return b'OK  ', b''
+
+            elif verb == b'ALOW':
+                topic = str( payload, 'utf-8' )
+                self._update_topicmap( lambda tm: tm.allow( topic ) )
+                return b'OK  ', b''
+
+            elif verb == b'DENY':
+                topic = str( payload, 'utf-8' )
+                self._update_topicmap( lambda tm: tm.deny( topic ) )
+                return b'OK  ', b''
+
+            else:
+                raise flusherproto.ProtocolError( f"Unknown verb {verb}" )
+
+        except Exception as ex:
+            _logger.error( f"Failed to handle {verb} frame: {ex}" )
+            return b'ERR ', str(ex).encode( 'utf-8' )
+
+
+    def _handle_legacy( self, conn, bdata ):
+        # Old unframed protocol: bdata is one message, whatever a single
+        #   recv got.  Returns the reply.
+        if len( bdata ) < 4:
+            _logger.error( f"Too short message received: {bdata}" )
+            return b'error'
+
+        if bdata[0:4] == b'DONE':
+            conn.closing = True
+            return b'ok'
+
+        if bdata[0:4] == b'TPIC':
+            try:
+                self._change_topic( bdata[ 4: ].decode( 'utf-8' ) )
+                return b'ok'
+            except Exception as ex:
+                _logger.exception( f"Failed to write {self.topiccache}: {ex}" )
+                return b'error'
+
+        if bdata[0:4] != b'MESG':
+            _logger.error( f"Unknown message {bdata[0:4]}" )
+            return b'error'
+
+        if self._busy( len(bdata) - 4 ) > 0:
+            return b'error'
+
+        self._buffer( None, [ bytes( bdata[4:] ) ] )
+        self._count_received( 1 )
+        return b'ok'
+
+
+    def _process_input( self, conn ):
+        # Handle every complete frame (or legacy message) that's sitting
+        #   in conn's receive buffer, queueing up the replies.
+        hdrsize = flusherproto.HEADER.size
+        rbuf = conn.rbuf
+        while ( len( rbuf ) > 0 ) and ( not conn.closing ) and ( conn.waiting is None ):
+            if rbuf[0:4] != flusherproto.FRAME_MAGIC:
+                if ( len( rbuf ) < 4 ) and flusherproto.FRAME_MAGIC.startswith( rbuf ):
+                    # Might be the start of a frame, wait for more
+                    return
+                conn.wbuf += self._handle_legacy( conn, rbuf )
+                rbuf.clear()
+                return
+
+            if len( rbuf ) < hdrsize:
+                return
+            verb, flags, paylen = flusherproto.unpack_header( rbuf )
+            if paylen > self.max_frame_size:
+                raise flusherproto.ProtocolError( f"{paylen}-byte {verb} frame is bigger than the maximum "
+                                                  f"of {self.max_frame_size}" )
+            framelen = hdrsize + paylen
+            if len( rbuf ) < framelen:
+                return
+            t0 = time.perf_counter()
+            with memoryview( rbuf ) as view:
+                respverb, resp = self._handle_frame( conn, verb, flags, view[ hdrsize:framelen ] )
+            if verb == b'MSGS':
+                self.frame_seconds.observe( time.perf_counter() - t0 )
+            if respverb is not None:
+                conn.wbuf += flusherproto.pack_frame( respverb, resp )
+            del rbuf[ :framelen ]
+
+
+    def _close( self, conn ):
+        if conn.sock.fileno() < 0:
+            # Already closed
+            return
+        self.selector.unregister( conn.sock )
+        conn.sock.close()
+
+
+    def _send_pending( self, conn ):
+        # Send as much of conn's queued replies as the socket will take
+        #   right now, and only ask to hear about writability if some are
+        #   left over.
+        if conn.sock.fileno() < 0:
+            return
+        try:
+            if len( conn.wbuf ) > 0:
+                try:
+                    nsent = conn.sock.send( conn.wbuf )
+                except BlockingIOError:
+                    nsent = 0
+                del conn.wbuf[ :nsent ]
+            if len( conn.wbuf ) > 0:
+                self.selector.modify( conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn )
+            elif conn.closing:
+                self._close( conn )
+            else:
+                self.selector.modify( conn.sock, selectors.EVENT_READ, conn )
+        except Exception as ex:
+            _logger.error( f"Error sending to client, closing connection: {ex}" )
+            self._close( conn )
+
+
+    def _service( self, conn, mask ):
+        # Read whatever conn has for us and handle any complete frames.
+        #   Returns False if conn got closed.
+        if not ( mask & selectors.EVENT_READ ):
+            return True
+        try:
+            try:
+                bdata = conn.sock.recv( self.max_message_size )
+            except BlockingIOError:
+                return True
+            if len( bdata ) == 0:
+                # Client closed the connection
+                self._close( conn )
+                return False
+            conn.rbuf += bdata
+            self._process_input( conn )
+            return True
+        except Exception as ex:
+            _logger.error( f"Error talking to client, closing connection: {ex}" )
+            self._close( conn )
+            return False
+
+
+    def _loop( self, sock ):
         while True:
             try:
-                res = poller.poll( self.timeout * 1000 )
-                if len(res) > 0:
-                    conn, _ = sock.accept()
-                    try:
-                        # Even a 1-second timeout is probably excessive, since we poll
-                        #   was just told there were messages waiting in the socket.
-                        conn.settimeout( 1000 )
-                        done = False
-                        while not done:
-                            try:
-                                bdata = conn.recv( self.max_message_size )
-                            except TimeoutError:
-                                _logger.error( "Timeout trying to read from client, closing connection." )
-                                done = True
-                                continue
-
-                            if len( bdata ) < 4:
-                                _logger.error( f"Too short message received: {bdata}" )
-                                conn.send( b'error' )
-                                continue
-
-                            if bdata[0:4] == b'DONE':
-                                done = True
-                                conn.send( b'ok' )
-                                continue
-
-                            if bdata[0:4] == b'TPIC':
-                                try:
-                                    topic = bdata[ 4: ].decode( 'utf-8' )
-                                    with open( self.topiccache, "w" ) as ofp:
-                                        ofp.write( self.topic )
-                                    self.topic = topic
-                                    conn.send( b'ok' )
-                                except Exception as ex:
-                                    _logger.exception( f"Failed to write {self.topiccache}: {ex}" )
-                                    conn.send( b'error' )
-                                continue
-
-                            if bdata[0:4] != b'MESG':
-                                _logger.error( f"Unknown message {bdata[0:4]}" )
-                                conn.send( b'error' )
-                                continue
-
-                            self.msgs.append( bdata[4:] )
-                            conn.send( b'ok' )
-
-                            self.tot += 1
-                            if ( self.tot >= nextinfo ):
-                                _logger.info( f"Have received {self.tot} messages." )
-                                nextinfo += self.infoevery
-                            if ( self.tot >= nextdebug ):
-                                _logger.debug( f"Have received {self.tot} messages." )
-                                nextdebug += self.debugevery
-
-                    finally:
-                        conn.close()
+                toreply = []
+                # Wake up when the next topic is due to be flushed, not just
+                #   some time after that
+                timeout = min( self.timeout, max( 0, self.nextflush - time.monotonic() ) )
+                if self.ring is not None:
+                    # Wake up often enough to keep the heartbeat going, and
+                    #   right away if there's more in the ring to get to.
+                    timeout = min( timeout, 1 )
+                    if self.ringpending:
+                        timeout = 0 if self._room() > 0 else min( timeout, 0.1 )
+                if len( self.waits ) > 0:
+                    timeout = min( timeout, max( 0, min( w[0] for w in self.waits ) - time.monotonic() ) )
+                for key, mask in self.selector.select( timeout ):
+                    if key.data is None:
+                        try:
+                            clientsock, _ = sock.accept()
+                        except BlockingIOError:
+                            continue
+                        clientsock.setblocking( False )
+                        self.selector.register( clientsock, selectors.EVENT_READ, _Connection( clientsock ) )
+                    elif key.data is self.ring:
+                        self.ring.clear_wakeups()
+                    elif key.data is self.ackpipe:
+                        try:
+                            while len( os.read( self.ackpipe[0], 4096 ) ) > 0:
+                                pass
+                        except BlockingIOError:
+                            pass
+                    elif self._service( key.data, mask ):
+                        toreply.append( key.data )
+
+                if ( self.ring is not None ) and ( self._room() > 0 ):
+                    self._take_from_ring( self._room() )
+                if len( self.waits ) > 0:
+                    toreply.extend( self._finish_acks() )
 
+                # Group commit: everything received this time around has to
+                #   be on disk before we acknowledge any of it (or, for the
+                #   ring, let its space be reused).
+                if self.spool is not None:
+                    t0 = time.perf_counter()
+                    synced = self.spool.sync()
+                    self.batchids.sync()
+                    if synced:
+                        self.sync_seconds.observe( time.perf_counter() - t0 )
+                if self.ring is not None:
+                    self.ringpending = self.ring.release()
+                    self.ring.heartbeat()
+                for conn in toreply:
+                    self._send_pending( conn )
+
+                # Each topic's messages are flushed when there are enough
+                #   of them, or the oldest has waited long enough (see
+                #   _flush_limits), or somebody is waiting to hear that they
+                #   were delivered.  With adaptive flushing, while the flush
+                #   worker thread already has a batch waiting, a batch sealed
+                #   now would just wait behind it, so let the messages pile
+                #   up (to at most the size limits or timeout) instead; the
+                #   worker wakes us up when it takes the waiting batch.
                 t = time.monotonic()
-                if ( len( self.msgs ) >= self.maxmsgs ) or ( t - self.lastflush > self.timeout ):
-                    self.flush()
+                toflush = self.flushnow
+                self.flushnow = set()
+                behind = self.adaptive and ( len( self.sealed ) > 0 )
+                self.nextflush = math.inf
+                for topic, buf in self.buffers.items():
+                    maxmsgs, maxbytes, linger, timeout = self._flush_limits( topic )
+                    due = buf.started + ( timeout if behind else linger )
+                    if ( len( buf.msgs ) >= maxmsgs ) or ( buf.nbytes >= maxbytes ) or ( t >= due ):
+                        toflush.add( topic )
+                    elif len( buf.msgs ) > 0:
+                        self.nextflush = min( self.nextflush, due )
+                for topic in toflush:
+                    self.flush( topic )
+
+                if t - self.topiccache_lastcheck > 1:
+                    self._check_topic_cache()
+                    self.topiccache_lastcheck = t
 
             except Exception as ex:
                 _logger.exception( str(ex) )
@@ -150,7 +1174,7 @@ class Flusher:
 
 
 # ======================================================================
-def main():
+def main( argv=None ):
     parser = argparse.ArgumentParser( 'flusher.py', description='Adapter between webap and kafka server',
                                       formatter_class=argparse.ArgumentDefaultsHelpFormatter )
     parser.add_argument( "-s", "--servers",
@@ -160,32 +1184,113 @@ def main():
     parser.add_argument( "--force-topic", default=False, action='store_true',
                          help=( "Normally --topic is used only if there isn't a cached topic. "
                                 "Add --force-topic to use the topic in --topic instead of the cached one." ) )
+    parser.add_argument( "--allowed-topics", nargs='*',
+                         default=[ t for t in os.getenv( "KAFKA_FLUSHER_ALLOWED_TOPICS", "" ).split( ',' )
+                                   if len( t ) > 0 ],
+                         help=( "Topics that POSTs may send messages to, in addition to the default topic "
+                                "and any already allowed in the topic cache" ) )
     parser.add_argument( "-f", "--flush-timeout", type=float,
                          default=float( os.getenv( "KAFKA_FLUSHER_TIMEOUT", "5" ) ),
                          help="Flush after at least this often in seconds" )
     parser.add_argument( "-n", "--num-messages", type=int,
                          default=int( os.getenv( "KAFKA_FLUSHER_NUM_MESSAGES", "100" ) ),
                          help="Flush after receiving this many messages" )
+    parser.add_argument( "--num-bytes", type=int,
+                         default=int( os.getenv( "KAFKA_FLUSHER_NUM_BYTES", "1048576" ) ),
+                         help="Flush after receiving this many bytes of messages" )
+    parser.add_argument( "--adaptive", action='store_true',
+                         default=os.getenv( "KAFKA_FLUSHER_ADAPTIVE", "0" ) not in ( "", "0" ),
+                         help=( "Size batches from how fast messages are arriving and how fast kafka takes "
+                                "them, aiming for --latency-target, instead of flushing every --num-messages; "
+                                "--flush-timeout is still the longest a message waits" ) )
+    parser.add_argument( "--latency-target", type=float,
+                         default=float( os.getenv( "KAFKA_FLUSHER_LATENCY_TARGET", "1" ) ),
+                         help=( "With --adaptive, the seconds from receiving a message to kafka having it "
+                                "that the flusher aims for" ) )
     parser.add_argument( "-m", "--max-message-size", default=262144, type=int,
                          help="Maximum message size we'll get in bytes" )
-    parser.add_argument( "-b", "--batch-size", default=131072, type=int,
+    parser.add_argument( "--max-frame-size", default=67108864, type=int,
+                         help=( "Maximum size in bytes of a frame (e.g. all the messages from one POST) "
+                                "from the webserver" ) )
+    parser.add_argument( "-b", "--batch-size", default=524288, type=int,
                          help="Batch size for confluent kafka producer in bytes" )
-    parser.add_argument( "-l", "--linger-ms", default=50, type=int,
+    parser.add_argument( "-l", "--linger-ms", default=10, type=int,
                          help="Number of ms for confluent kafka producer to linger" )
+    parser.add_argument( "-c", "--compression-type",
+                         default=os.getenv( "KAFKA_FLUSHER_COMPRESSION_TYPE", "lz4" ),
+                         choices=[ 'none', 'gzip', 'snappy', 'lz4', 'zstd' ],
+                         help="Compression the kafka producer uses for message batches it sends to the server" )
+    parser.add_argument( "--compression-level", type=int,
+                         default=int( os.getenv( "KAFKA_FLUSHER_COMPRESSION_LEVEL", "-1" ) ),
+                         help="Compression level for --compression-type; -1 means the codec's default" )
+    parser.add_argument( "--partitioner", default=os.getenv( "KAFKA_FLUSHER_PARTITIONER", "murmur2_random" ),
+                         choices=[ 'random', 'consistent', 'consistent_random', 'murmur2', 'murmur2_random',
+                                   'fnv1a', 'fnv1a_random' ],
+                         help=( "How the kafka producer picks the partition for messages with keys.  The "
+                                "default, murmur2_random, puts a key on the same partition as the Java "
+                                "client would; messages without keys are spread randomly." ) )
+    parser.add_argument( "--delivery-timeout", default=30, type=float,
+                         help="Seconds the kafka producer will keep trying to deliver a message" )
+    parser.add_argument( "--max-retries", default=5, type=int,
+                         help="Number of times to retry messages that the kafka producer failed to deliver" )
+    parser.add_argument( "--max-ack-wait", type=float,
+                         default=float( os.getenv( "KAFKA_FLUSHER_MAX_ACK_WAIT", "60" ) ),
+                         help=( "Longest in seconds to hold the reply to messages sent by somebody waiting "
+                                "to hear that they were delivered" ) )
+    parser.add_argument( "--batch-id-cache-size", type=int,
+                         default=int( os.getenv( "KAFKA_FLUSHER_BATCH_ID_CACHE_SIZE", "100000" ) ),
+                         help="Number of recent batch IDs to remember, so resent batches aren't sent to kafka twice" )
+    parser.add_argument( "--batch-id-ttl", type=float,
+                         default=float( os.getenv( "KAFKA_FLUSHER_BATCH_ID_TTL", "600" ) ),
+                         help="Seconds to remember a batch ID for" )
+    parser.add_argument( "--no-idempotence", dest='idempotence', action='store_false', default=True,
+                         help=( "Don't make the kafka producer idempotent.  (An idempotent producer's "
+                                "retries can't duplicate messages, but the kafka server has to allow it.)" ) )
+    parser.add_argument( "--max-buffered-bytes", type=int,
+                         default=int( os.getenv( "KAFKA_FLUSHER_MAX_BUFFERED_BYTES", "268435456" ) ),
+                         help=( "Tell the webserver to have clients back off when the flusher is holding "
+                                "this many bytes of messages not yet delivered to kafka" ) )
+    parser.add_argument( "--max-batches-waiting", type=int,
+                         default=int( os.getenv( "KAFKA_FLUSHER_MAX_BATCHES_WAITING", "100" ) ),
+                         help=( "Tell the webserver to have clients back off when this many batches are "
+                                "waiting to be sent to kafka" ) )
+    parser.add_argument( "--spool-dir", default=os.getenv( "KAFKA_FLUSHER_SPOOL_DIR" ),
+                         help=( "Directory for an on-disk spool of messages not yet delivered to kafka; "
+                                "if not given, messages are only kept in memory" ) )
+    parser.add_argument( "--spool-segment-size", default=67108864, type=int,
+                         help="Size in bytes of each spool file" )
+    parser.add_argument( "--ring-size", type=int,
+                         default=int( os.getenv( "KAFKA_FLUSHER_RING_SIZE", "0" ) ),
+                         help=( "Size in bytes of the shared-memory ring the webserver can use to send "
+                                "messages; 0 means don't use one" ) )
+    parser.add_argument( "--ring-path",
+                         default=os.getenv( "KAFKA_FLUSHER_RING_PATH", "/dev/shm/kafka_flusher_ring" ),
+                         help="Location of the shared-memory ring" )
     parser.add_argument( "-p", "--socket-path",
                          default=os.getenv("KAFKA_FLUSHER_SOCKET_PATH","/tmp/flusher_socket"),
                          help="Location of socket to create and listen to" )
     parser.add_argument( "-v", "--verbose", action='store_true', default=False )
-    args = parser.parse_args()
+    args = parser.parse_args( argv )
 
     if args.verbose:
         _logger.setLevel( logging.DEBUG )
 
     flusher = Flusher( args.topic, force_topic=args.force_topic,
-                       timeout=args.flush_timeout, maxmsgs=args.num_messages,
+                       timeout=args.flush_timeout, maxmsgs=args.num_messages, maxbytes=args.num_bytes,
+                       adaptive=args.adaptive, latency_target=args.latency_target,
                        servers=args.servers, max_message_size=args.max_message_size,
+                       max_frame_size=args.max_frame_size,
                        batch_size=args.batch_size, lingerms=args.linger_ms,
-                       sockpath=args.socket_path )
+                       compression_type=args.compression_type, compression_level=args.compression_level,
+                       delivery_timeout=args.delivery_timeout, max_retries=args.max_retries,
+                       partitioner=args.partitioner, max_ack_wait=args.max_ack_wait,
+                       batchid_cache_size=args.batch_id_cache_size, batchid_ttl=args.batch_id_ttl,
+                       idempotence=args.idempotence,
+                       max_buffered_bytes=args.max_buffered_bytes, max_batches_waiting=args.max_batches_waiting,
+                       sockpath=args.socket_path, spooldir=args.spool_dir,
+                       spool_segment_size=args.spool_segment_size,
+                       ringpath=args.ring_path, ring_size=args.ring_size,
+                       allowed_topics=args.allowed_topics )
     flusher()
 
 
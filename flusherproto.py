@@ -0,0 +1,400 @@
+# The protocol spoken between the webserver and the flusher over the
+#   flusher's unix domain socket.
+#
+# Everything is sent in frames.  A frame is a 16-byte header followed by
+#   a payload:
+#
+#   bytes  0-3  : FRAME_MAGIC; b'KPF' followed by the protocol version byte
+#   bytes  4-7  : the verb (four ASCII characters)
+#   bytes  8-11 : flags (little-endian unsigned int)
+#   bytes 12-15 : length of the payload in bytes (little-endian unsigned int)
+#
+# Verbs the webserver sends to the flusher:
+#
+#   MSGS : the payload is one or more messages, each one a 4-byte
+#          little-endian length followed by that many bytes of message.
+#          (This is exactly the format of the body of a POST to the
+#          webserver, so a POST body can be forwarded as is.)  If flags
+#          has FLAG_TOPIC set, the messages are preceded by the topic they
+#          go to: a 2-byte little-endian length and then the utf-8 encoded
+#          topic.  Otherwise, they go to the default topic.  If flags has
+#          FLAG_RECORDS set, each message is a record (see below) rather
+#          than just the message value.  If flags has FLAG_ACK set, the
+#          sender wants to know when kafka has the messages: the payload
+#          starts (before any topic) with the most milliseconds to wait
+#          for that as a 4-byte little-endian integer, and the flusher
+#          holds its reply until every message has been delivered or
+#          given up on, or that long has passed.  (The flusher doesn't
+#          read any more frames from the connection in the meantime.)  If
+#          flags has FLAG_BATCHID set, the messages are a batch that the
+#          client may send more than once; the payload has (after any
+#          wait, before any topic) the batch ID, a 2-byte little-endian
+#          length and then the utf-8 encoded ID.  If the flusher has
+#          already taken a batch with that ID, it doesn't take the
+#          messages again, and replies DUPL instead of OK.
+#   TPIC : the payload is the utf-8 encoded topic to make the default.
+#          (This also allows the topic.)
+#   ALOW : the payload is the utf-8 encoded topic to allow.
+#   DENY : the payload is the utf-8 encoded topic to no longer allow.
+#   STAT : the payload is empty.  The flusher replies OK with its metrics
+#          (see metrics.py) as a utf-8 encoded JSON snapshot.
+#
+# The flusher replies to each frame with exactly one frame:
+#
+#   OK   : success.  For MSGS, the payload is the number of messages
+#          accepted as a 4-byte little-endian integer; for STAT, see
+#          above; otherwise empty.
+#          For MSGS with FLAG_ACK, the count is followed by one byte for
+#          each message: ACK_DELIVERED, ACK_FAILED (the flusher gave up on
+#          it), or ACK_PENDING (still being tried when the wait ran out).
+#   DUPL : the reply to a MSGS frame whose batch ID the flusher has seen
+#          before.  The payload is as for OK, for the earlier batch; the
+#          delivery status bytes may be missing if the flusher doesn't
+#          know (e.g. it has restarted since).
+#   ERR  : failure.  The payload is a utf-8 error message.
+#   BUSY : the flusher is holding as much as it's willing to, and didn't
+#          take the messages.  The payload is the number of seconds to
+#          wait before trying again as a 4-byte little-endian integer.
+#
+# A record carries a message's kafka key, headers, and timestamp along
+#   with its value.  (It's what clients POST with content type
+#   RECORDS_CONTENT_TYPE, each one with the usual 4-byte length prefix.)
+#
+#   1 byte  : RECORD_KEY if the record has a key, plus RECORD_TIMESTAMP if
+#             it has a timestamp
+#   8 bytes : timestamp, milliseconds since the epoch (little-endian signed)
+#   4 bytes : length of the key (little-endian unsigned int; 0 if no key)
+#   2 bytes : number of headers (little-endian unsigned)
+#   the key
+#   each header: a 2-byte little-endian length and then the utf-8 encoded
+#             header name, then a 4-byte little-endian length and then
+#             the header value
+#   the value, which is the rest of the record
+#
+# A connection may carry any number of frames.  The client just closes
+#   the connection when it's done.
+#
+# The flusher also still understands the old unframed protocol, where
+#   each send() was one b'MESG' (followed by one message), b'TPIC'
+#   (followed by the topic), or b'DONE', each answered with b'ok' or
+#   b'error'.  That will go away once nothing uses it any more.
+
+import struct
+
+PROTOCOL_VERSION = 1
+FRAME_MAGIC = b'KPF' + bytes( [ PROTOCOL_VERSION ] )
+HEADER = struct.Struct( '<4s4sII' )
+MSGLEN = struct.Struct( '<I' )
+TOPICLEN = struct.Struct( '<H' )
+
+FLAG_TOPIC = 0x1
+FLAG_RECORDS = 0x2
+FLAG_ACK = 0x4
+FLAG_BATCHID = 0x8
+
+ACKWAIT = struct.Struct( '<I' )
+ACK_DELIVERED = 0
+ACK_FAILED = 1
+ACK_PENDING = 2
+
+RECORDS_CONTENT_TYPE = "application/x-kafka-proxy-records"
+RECORD = struct.Struct( '<BqIH' )
+RECORD_KEY = 0x1
+RECORD_TIMESTAMP = 0x2
+
+
+class ProtocolError( Exception ):
+    pass
+
+
+def pack_header( verb, paylen, flags=0 ):
+    return HEADER.pack( FRAME_MAGIC, verb, flags, paylen )
+
+
+def unpack_header( buf ):
+    magic, verb, flags, paylen = HEADER.unpack_from( buf )
+    if magic != FRAME_MAGIC:
+        raise ProtocolError( f"Bad frame magic {magic}" )
+    return verb, flags, paylen
+
+
+def pack_frame( verb, payload=b'', flags=0 ):
+    return pack_header( verb, len(payload), flags ) + payload
+
+
+def pack_topic( topic ):
+    # The topic prefix of a MSGS payload with FLAG_TOPIC
+    topic = topic.encode( 'utf-8' )
+    return TOPICLEN.pack( len(topic) ) + topic
+
+
+def unpack_topic( payload, flags ):
+    # Returns ( topic, messages ) from a MSGS payload; topic is None if
+    #   the payload doesn't have one.
+    if not ( flags & FLAG_TOPIC ):
+        return None, payload
+    if len( payload ) < TOPICLEN.size:
+        raise ProtocolError( "Truncated topic" )
+    topiclen, = TOPICLEN.unpack_from( payload )
+    if TOPICLEN.size + topiclen > len( payload ):
+        raise ProtocolError( "Truncated topic" )
+    topic = str( payload[ TOPICLEN.size : TOPICLEN.size + topiclen ], 'utf-8' )
+    return topic, payload[ TOPICLEN.size + topiclen : ]
+
+
+def pack_ackwait( wait ):
+    # The prefix of a MSGS payload with FLAG_ACK; wait is in seconds
+    return ACKWAIT.pack( max( 0, int( wait * 1000 ) ) )
+
+
+def unpack_ackwait( payload, flags ):
+    # Returns ( wait, rest of payload ) from a MSGS payload; wait is in
+    #   seconds, or None if the payload doesn't have one.
+    if not ( flags & FLAG_ACK ):
+        return None, payload
+    if len( payload ) < ACKWAIT.size:
+        raise ProtocolError( "Truncated ack wait" )
+    waitms, = ACKWAIT.unpack_from( payload )
+    return waitms / 1000., payload[ ACKWAIT.size: ]
+
+
+def pack_batchid( batchid ):
+    # The batch ID prefix of a MSGS payload with FLAG_BATCHID
+    batchid = batchid.encode( 'utf-8' )
+    return TOPICLEN.pack( len(batchid) ) + batchid
+
+
+def unpack_batchid( payload, flags ):
+    # Returns ( batch ID, rest of payload ) from a MSGS payload; the batch
+    #   ID is None if the payload doesn't have one.
+    if not ( flags & FLAG_BATCHID ):
+        return None, payload
+    if len( payload ) < TOPICLEN.size:
+        raise ProtocolError( "Truncated batch ID" )
+    idlen, = TOPICLEN.unpack_from( payload )
+    if TOPICLEN.size + idlen > len( payload ):
+        raise ProtocolError( "Truncated batch ID" )
+    batchid = str( payload[ TOPICLEN.size : TOPICLEN.size + idlen ], 'utf-8' )
+    return batchid, payload[ TOPICLEN.size + idlen : ]
+
+
+def unpack_acks( payload ):
+    # Returns ( nmsgs, status ) from the payload of the OK (or DUPL) reply
+    #   to a MSGS frame; status is bytes with an ACK_* for each message, or None if
+    #   the reply doesn't have them (i.e. it isn't the reply to a frame
+    #   with FLAG_ACK).
+    nmsgs, = MSGLEN.unpack_from( payload )
+    status = bytes( payload[ MSGLEN.size: ] )
+    if ( len( status ) == 0 ) and ( nmsgs > 0 ):
+        return nmsgs, None
+    if len( status ) != nmsgs:
+        raise ProtocolError( f"Reply has {len(status)} delivery statuses for {nmsgs} messages" )
+    return nmsgs, status
+
+
+def pack_record( value, key=None, headers=[], timestamp=None ):
+    # headers is a list of ( name, value ); timestamp is in milliseconds
+    flags = ( RECORD_KEY if key is not None else 0 ) | ( RECORD_TIMESTAMP if timestamp is not None else 0 )
+    key = b'' if key is None else key
+    parts = [ RECORD.pack( flags, 0 if timestamp is None else timestamp, len(key), len(headers) ), key ]
+    for name, hval in headers:
+        name = name.encode( 'utf-8' )
+        parts.extend( [ TOPICLEN.pack( len(name) ), name, MSGLEN.pack( len(hval) ), hval ] )
+    parts.append( value )
+    return b''.join( parts )
+
+
+def unpack_record( record ):
+    # Returns ( value, key, headers, timestamp ), with key and timestamp
+    #   None if the record doesn't have them.
+    end = len( record )
+    if end < RECORD.size:
+        raise ProtocolError( f"{end}-byte record is too short" )
+    flags, timestamp, keylen, nheaders = RECORD.unpack_from( record )
+    ptr = RECORD.size
+    if ptr + keylen > end:
+        raise ProtocolError( f"{keylen}-byte key runs past the end of a {end}-byte record" )
+    key = bytes( record[ ptr : ptr+keylen ] ) if flags & RECORD_KEY else None
+    ptr += keylen
+    headers = []
+    try:
+        for _ in range( nheaders ):
+            namelen, = TOPICLEN.unpack_from( record, ptr )
+            name = str( record[ ptr+TOPICLEN.size : ptr+TOPICLEN.size+namelen ], 'utf-8' )
+            ptr += TOPICLEN.size + namelen
+            vallen, = MSGLEN.unpack_from( record, ptr )
+            ptr += MSGLEN.size
+            if ptr + vallen > end:
+                raise ProtocolError( "Header runs past the end of the record" )
+            headers.append( ( name, bytes( record[ ptr : ptr+vallen ] ) ) )
+            ptr += vallen
+    except ( struct.error, UnicodeDecodeError ) as ex:
+        raise ProtocolError( f"Bad record header: {ex}" )
+    return ( bytes( record[ ptr: ] ), key, headers,
+             timestamp if flags & RECORD_TIMESTAMP else None )
+
+
+def check_records( payload, index ):
+    # Make sure that every message in payload (with index from
+    #   index_messages) is a valid record.
+    for offset, size in index:
+        unpack_record( payload[ offset : offset+size ] )
+
+
+def index_messages( payload, max_message_size=None ):
+    # Find the messages in a MSGS payload (or a POST body, which is the
+    #   same thing), making sure that every length prefix is consistent
+    #   with the payload size.  Returns a list of ( offset, size ) of each
+    #   message's data; nothing gets copied.
+    index = []
+    ptr = 0
+    paylen = len( payload )
+    unpack_from = MSGLEN.unpack_from
+    while ptr < paylen:
+        if ptr + 4 > paylen:
+            raise ProtocolError( f"Truncated length prefix at byte {ptr} of a {paylen}-byte payload" )
+        msgsize, = unpack_from( payload, ptr )
+        ptr += 4
+        if ptr + msgsize > paylen:
+            raise ProtocolError( f"After {len(index)} messages, got a {msgsize}-byte message at byte {ptr} "
+                                 f"of a {paylen}-byte payload" )
+        if ( max_message_size is not None ) and ( msgsize > max_message_size ):
+            raise ProtocolError( f"Message {len(index)} is {msgsize} bytes, more than the "
+                                 f"maximum of {max_message_size}" )
+        index.append( ( ptr, msgsize ) )
+        ptr += msgsize
+    return index
+
+
+def split_messages( payload, max_message_size=None ):
+    # Like index_messages, but returns a list of the messages (as bytes)
+    return [ bytes( payload[ offset:offset+size ] )
+             for offset, size in index_messages( payload, max_message_size ) ]
+
+
+class MessageChunker:
+    # Splits length-prefixed messages (the POST body format) into chunks as
+    #   the data arrives.  feed() each piece of data, and iterate over what
+    #   it returns to get the chunks completed so far; at the end of the
+    #   data, iterate over end() to get the last one (it raises
+    #   ProtocolError, after the chunks before, if the data ended in the
+    #   middle of a message).  Each chunk is ( chunk, nmsgs ), where chunk
+    #   is a bytearray holding nmsgs whole messages (with their length
+    #   prefixes, so it's ready to be a MSGS payload).  Each chunk ends
+    #   with the first message that brings it to at least chunk_size bytes
+    #   (or at the end of the data), so where chunks end depends only on
+    #   the messages, not on how the data happened to arrive.
+    def __init__( self, chunk_size=1048576, max_message_size=None ):
+        self.chunk_size = chunk_size
+        self.max_message_size = max_message_size
+        self.buf = bytearray()
+        self.scanned = 0
+        self.nmsgs = 0
+        self.nbytes = 0
+
+    def feed( self, data ):
+        self.buf += data
+        return self._chunks( False )
+
+    def end( self ):
+        yield from self._chunks( True )
+        if len( self.buf ) > 0:
+            raise ProtocolError( f"Data ended with a partial message ({len(self.buf)} bytes) "
+                                 f"at byte {self.nbytes}" )
+
+    def _chunks( self, eof ):
+        unpack_from = MSGLEN.unpack_from
+        while True:
+            # Find the end of the last whole message we have, up to the end
+            #   of the chunk
+            buf = self.buf
+            while ( self.scanned + 4 <= len( buf ) ) and ( self.scanned < self.chunk_size ):
+                msgsize, = unpack_from( buf, self.scanned )
+                if ( self.max_message_size is not None ) and ( msgsize > self.max_message_size ):
+                    raise ProtocolError( f"Message at byte {self.nbytes + self.scanned} is {msgsize} bytes, "
+                                         f"more than the maximum of {self.max_message_size}" )
+                if self.scanned + 4 + msgsize > len( buf ):
+                    break
+                self.scanned += 4 + msgsize
+                self.nmsgs += 1
+
+            if ( self.scanned == 0 ) or not ( eof or ( self.scanned >= self.chunk_size ) ):
+                return
+
+            # Hand over buf itself (cut down to the whole messages) and
+            #   keep the partial message that follows in a new buffer.
+            #   There may be more whole messages in what's left.
+            chunk, nmsgs = buf, self.nmsgs
+            self.buf = bytearray( chunk[ self.scanned: ] )
+            del chunk[ self.scanned: ]
+            self.nbytes += self.scanned
+            self.scanned = 0
+            self.nmsgs = 0
+            yield chunk, nmsgs
+
+
+class MessageStreamReader:
+    # Reads length-prefixed messages from a file-like stream, without
+    #   needing to have the whole thing in memory.  Iterating gives the
+    #   chunks that a MessageChunker would.  So, the most memory this ever
+    #   needs is about chunk_size plus max_message_size plus readsize.
+    def __init__( self, stream, chunk_size=1048576, max_message_size=None, readsize=65536 ):
+        self.stream = stream
+        self.chunker = MessageChunker( chunk_size, max_message_size )
+        self.readsize = readsize
+
+    @property
+    def nbytes( self ):
+        return self.chunker.nbytes
+
+    def __iter__( self ):
+        while True:
+            data = self.stream.read( self.readsize )
+            if len( data ) == 0:
+                yield from self.chunker.end()
+                return
+            yield from self.chunker.feed( data )
+
+
+def recv_exactly( sock, nbytes ):
+    # Read exactly nbytes from a blocking socket, however many recv calls it
+    #   takes.  Raises ConnectionError if the other end closes first.
+    buf = bytearray( nbytes )
+    view = memoryview( buf )
+    got = 0
+    while got < nbytes:
+        n = sock.recv_into( view[got:], nbytes - got )
+        if n == 0:
+            raise ConnectionError( f"Connection closed after {got} of {nbytes} bytes" )
+        got += n
+    return buf
+
+
+def recv_frame( sock, max_payload=None ):
+    verb, flags, paylen = unpack_header( recv_exactly( sock, HEADER.size ) )
+    if ( max_payload is not None ) and ( paylen > max_payload ):
+        raise ProtocolError( f"{paylen}-byte {verb} frame is bigger than the maximum of {max_payload}" )
+    payload = recv_exactly( sock, paylen ) if paylen > 0 else b''
+    return verb, flags, payload
+
+
+def sendall_buffers( sock, bufs ):
+    # Like sock.sendall( b''.join( bufs ) ), but gathers the buffers with
+    #   sendmsg instead of joining them into a new bytes object.
+    bufs = [ memoryview( b ).cast( 'B' ) for b in bufs ]
+    while len( bufs ) > 0:
+        nsent = sock.sendmsg( bufs )
+        while ( len( bufs ) > 0 ) and ( nsent >= len( bufs[0] ) ):
+            nsent -= len( bufs[0] )
+            bufs.pop( 0 )
+        if nsent > 0:
+            bufs[0] = bufs[0][nsent:]
+
+
+def send_frame( sock, verb, payload=b'', flags=0 ):
+    # payload is a bytes-like object, or a list of them that together make
+    #   up the payload.  Either way, it isn't copied.
+    if not isinstance( payload, list ):
+        payload = [ payload ]
+    paylen = sum( memoryview( b ).nbytes for b in payload )
+    sendall_buffers( sock, [ pack_header( verb, paylen, flags ) ] + payload )
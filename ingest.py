@@ -0,0 +1,696 @@
+# The parts of the kafka proxy's HTTP API that don't depend on which web
+#   server is running it: webserver.py (flask under gunicorn + gevent) and
+#   asyncserver.py (asyncio) both use these, and only do their own I/O
+#   (reading requests, and talking to the flushers).  So the two answer
+#   the same requests with the same responses, and have the same metrics.
+#
+# A response is what a flask view returns: ( body, status ) or ( body,
+#   status, headers ), where body is a str or a dict (sent as JSON).
+#   Functions that check something return the response to send back if
+#   the check fails, or None.  headers are the request's headers; names
+#   are looked up in lower case (flask's are case-insensitive anyway).
+#   Functions that log do it to the logger they're given, so that their
+#   messages go wherever the server's own do.
+
+import os
+import hmac
+import json
+import time
+import zlib
+import datetime
+
+import flusherproto
+import compression
+import ring
+import topicmap
+import metrics
+import ratelimit
+import avroencode
+
+
+# Metrics (see metrics.py) for POSTs of messages.  Every worker process
+#   keeps its own in a file in KAFKA_PROXY_METRICS_DIR (see
+#   share_metrics), and /metrics adds them all up (and adds what each
+#   flusher has).
+registry = metrics.Metrics()
+requests = { code: registry.counter( 'kafka_proxy_requests_total', "POSTs of messages, by response status",
+                                     { 'code': code } )
+             for code in ( '200', '400', '403', '413', '415', '429', '500', '502', '503', '504', 'other' ) }
+messages = registry.counter( 'kafka_proxy_messages_total', "Messages passed on to a flusher" )
+message_bytes = registry.counter( 'kafka_proxy_message_bytes_total',
+                                  "Bytes of messages (with their length prefixes) passed on to a flusher" )
+duplicates = registry.counter( 'kafka_proxy_duplicate_messages_total',
+                               "Messages not passed on because the flusher already had their batch ID" )
+busy = registry.counter( 'kafka_proxy_flusher_busy_total', "Times a flusher said it was too busy to take messages" )
+sends = { path: registry.counter( 'kafka_proxy_flusher_sends_total', "Batches of messages sent to a flusher",
+                                  { 'path': path } )
+          for path in ( 'ring', 'socket' ) }
+request_seconds = registry.histogram( 'kafka_proxy_request_seconds', "Time to handle a POST of messages" )
+parse_seconds = registry.histogram( 'kafka_proxy_parse_seconds', "Time to check the messages in a POST body" )
+flusher_seconds = registry.histogram( 'kafka_proxy_flusher_seconds',
+                                      "Time from sending messages to a flusher to hearing back" )
+
+
+def share_metrics( logger ):
+    directory = os.getenv( "KAFKA_PROXY_METRICS_DIR", "/dev/shm/kafka_proxy_metrics" )
+    if len( directory ) == 0:
+        return
+    try:
+        registry.share( directory )
+    except OSError as ex:
+        logger.warning( f"Not sharing metrics in {directory}, so /metrics will only "
+                        f"show those of whichever worker process answers: {ex}" )
+
+
+class Config:
+    # Everything from the environment
+    def __init__( self ):
+        # Clients' tokens come from KAFKA_PROXY_TOKENS_FILE (see
+        #   ratelimit.py), and/or KAFKA_PROXY_TOKEN.  (Without a tokens
+        #   file, there's always a KAFKA_PROXY_TOKEN.)
+        self.tokens_file = os.getenv( "KAFKA_PROXY_TOKENS_FILE" )
+        self.token = os.getenv( "KAFKA_PROXY_TOKEN",
+                                "default-token-do-not-really-use-this" if self.tokens_file is None else None )
+        self.rate_limit_path = os.getenv( "KAFKA_PROXY_RATE_LIMIT_PATH", "/dev/shm/kafka_proxy_rate_limits" )
+        self.socket_file = os.getenv( "KAFKA_FLUSHER_SOCKET_PATH", "/tmp/flusher_socket" )
+        self.topiccache = os.getenv( "KAFKA_FLUSHER_TOPIC_CACHE", "/kafka_topic_cache/topic" )
+        self.nshards = int( os.getenv( "KAFKA_FLUSHER_SHARDS", "1" ) )
+        # If the flushers were started with a shared-memory ring, send
+        #   messages that way
+        self.ringpath = None
+        if int( os.getenv( "KAFKA_FLUSHER_RING_SIZE", "0" ) ) > 0:
+            self.ringpath = os.getenv( "KAFKA_FLUSHER_RING_PATH", "/dev/shm/kafka_flusher_ring" )
+        self.pool_size = int( os.getenv( "KAFKA_PROXY_FLUSHER_POOL_SIZE", "8" ) )
+        self.comm_timeout = 2
+        # Bodies bigger than this (or sent chunked, with no Content-Length)
+        #   are read and passed on to the flusher a chunk at a time
+        self.stream_threshold = int( os.getenv( "KAFKA_PROXY_STREAM_THRESHOLD", "16777216" ) )
+        self.stream_chunk_size = int( os.getenv( "KAFKA_PROXY_STREAM_CHUNK_SIZE", "1048576" ) )
+        self.max_message_size = int( os.getenv( "KAFKA_PROXY_MAX_MESSAGE_SIZE", "262144" ) )
+        self.max_decompressed_size = int( os.getenv( "KAFKA_PROXY_MAX_DECOMPRESSED_SIZE", "1073741824" ) )
+        self.max_delivery_wait = float( os.getenv( "KAFKA_PROXY_MAX_DELIVERY_WAIT", "60" ) )
+        self.max_batchid_length = 256
+        self.metrics_token = os.getenv( "KAFKA_PROXY_METRICS_TOKEN" )
+        # POSTs of JSON records to /avro/<schema> (see avroencode.py)
+        self.schema_dir = os.getenv( "KAFKA_PROXY_SCHEMA_DIR" )
+        self.max_json_size = int( os.getenv( "KAFKA_PROXY_MAX_JSON_SIZE", "67108864" ) )
+
+
+# ======================================================================
+# Things each worker process keeps one of
+
+_topic_maps = {}
+
+
+def topic_map( topiccache ):
+    # The topic map (see topicmap.py) that the flusher keeps in topiccache
+    if topiccache not in _topic_maps:
+        _topic_maps[ topiccache ] = topicmap.TopicMapFile( topiccache )
+    return _topic_maps[ topiccache ].get()
+
+
+_token_registries = {}
+
+
+def token_registry( tokens_file, default_token ):
+    # The clients (see ratelimit.py) listed in tokens_file, plus
+    #   default_token
+    if ( tokens_file, default_token ) not in _token_registries:
+        _token_registries[ ( tokens_file, default_token ) ] = ratelimit.TokenRegistryFile( tokens_file, default_token )
+    return _token_registries[ ( tokens_file, default_token ) ].get()
+
+
+_rate_limiters = {}
+
+
+def rate_limiter( path ):
+    if path not in _rate_limiters:
+        _rate_limiters[ path ] = ratelimit.RateLimiter( path )
+    return _rate_limiters[ path ]
+
+
+_schema_caches = {}
+
+
+def schema_cache( directory ):
+    # The Avro schemas (see avroencode.py) in directory
+    if directory not in _schema_caches:
+        _schema_caches[ directory ] = avroencode.SchemaCache( directory )
+    return _schema_caches[ directory ]
+
+
+class FlusherRing:
+    # This process' end of a flusher's shared-memory ring (see ring.py).
+    #   Opened the first time it's needed (and again after a fork, or if
+    #   the flusher made a new ring).  If the ring isn't there, or the
+    #   flusher hasn't shown signs of life in maxage seconds, put() says
+    #   so, and messages should go over the socket instead.  (Putting
+    #   messages in the ring never waits, so this is the same whichever
+    #   server is running.)
+    def __init__( self, ringpath, logger, maxage=5 ):
+        self.ringpath = ringpath
+        self.logger = logger
+        self.maxage = maxage
+        self.pid = os.getpid()
+        self.producer = None
+        self.nexttry = 0.
+
+    def put( self, payload, nmsgs, flags=0 ):
+        # Returns True if the messages went into the ring
+        if os.getpid() != self.pid:
+            # Forked; don't touch (or close) our parent's ring file
+            self.producer = None
+            self.pid = os.getpid()
+
+        now = time.monotonic()
+        if self.producer is None:
+            if now < self.nexttry:
+                return False
+            try:
+                self.producer = ring.RingProducer( self.ringpath )
+            except ( FileNotFoundError, ring.RingError ) as ex:
+                self.logger.debug( f"Not using ring {self.ringpath}: {ex}" )
+                self.nexttry = now + self.maxage
+                return False
+
+        if self.producer.consumer_age() > self.maxage:
+            if self.producer.replaced():
+                self.producer.close()
+                self.producer = None
+            return False
+
+        try:
+            self.producer.put( payload, nmsgs, flags )
+        except ring.RingFull:
+            return False
+        return True
+
+
+_flusher_rings = {}
+
+
+def flusher_ring( ringpath, logger ):
+    if ringpath not in _flusher_rings:
+        _flusher_rings[ ringpath ] = FlusherRing( ringpath, logger )
+    return _flusher_rings[ ringpath ]
+
+
+def shard_paths( socket_file, nshards, ringpath=None ):
+    # Returns ( socket files, ring paths ) of the flusher shards.  With
+    #   one flusher, it listens on socket_file (and has its ring at
+    #   ringpath); with more, shard i listens on socket_file.i (and has its
+    #   ring at ringpath.i).  See run-kafka-proxy.sh.  The ring paths are
+    #   None if there's no ring.
+    if nshards <= 1:
+        return [ socket_file ], None if ringpath is None else [ ringpath ]
+    return ( [ f"{socket_file}.{i}" for i in range( nshards ) ],
+             None if ringpath is None else [ f"{ringpath}.{i}" for i in range( nshards ) ] )
+
+
+class ShardRouting:
+    # Which flusher shard gets what.  Requests are spread across the
+    #   shards round-robin.  If a shard can't be reached, it's skipped for
+    #   a while (downtime seconds) and the request goes to the next one; if
+    #   a shard is busy, the next one is tried before giving up and passing
+    #   the BUSY back.  (Except for a batch with an ID: only the shard it
+    #   was sent to knows the ID, so if that one's busy, the client has to
+    #   try again later.)  The servers' FlusherShards are subclasses that
+    #   do the talking, like this:
+    #
+    #     reply, payload, flags, timeout, shard = self.route_messages( ... )
+    #     ...
+    #     for i in self.order( shard ):
+    #         try to send the frame to shard i; if that fails, self.unreachable( i, ex )
+    #         if self.settle( i, verb, flags ) is done, return the reply
+    def __init__( self, socket_files, timeout, rings, logger, downtime=5 ):
+        self.socket_files = socket_files
+        self.timeout = timeout
+        self.rings = rings
+        self.logger = logger
+        self.downtime = downtime
+        self.downuntil = [ 0. ] * len( socket_files )
+        self.next = 0
+
+    def order( self, shard=None ):
+        # The shards to try a request on, in order.  shard, if given, is the
+        #   one to try first instead of the next one round-robin.
+        nshards = len( self.socket_files )
+        if shard is None:
+            start = self.next
+            self.next = ( start + 1 ) % nshards
+        else:
+            start = shard
+        now = time.monotonic()
+        order = [ ( start + i ) % nshards for i in range( nshards ) ]
+        return ( [ i for i in order if self.downuntil[i] <= now ] +
+                 [ i for i in order if self.downuntil[i] > now ] )
+
+    def unreachable( self, i, ex ):
+        self.logger.warning( f"Failed to talk to flusher at {self.socket_files[i]}: {ex}" )
+        self.downuntil[i] = time.monotonic() + self.downtime
+
+    def settle( self, i, verb, flags ):
+        # Shard i replied verb to a frame with flags.  Returns True if
+        #   that's the reply, False if the next shard should be tried.
+        self.downuntil[i] = 0.
+        return ( verb != b'BUSY' ) or bool( flags & flusherproto.FLAG_BATCHID )
+
+    def route_messages( self, payload, nmsgs, topic=None, flags=0, wait=None, batchid=None ):
+        # Work out how to pass messages for topic (None for the default
+        #   topic) on to a flusher: through its shared-memory ring if we
+        #   can, otherwise in a MSGS frame over its socket.  flags are MSGS
+        #   frame flags (see flusherproto.py); FLAG_TOPIC is added here if
+        #   needed.  If wait is given, the flusher doesn't reply until kafka
+        #   has the messages, or wait seconds have passed (see FLAG_ACK).
+        #   If batchid is given, the flusher won't take the messages if it
+        #   already took a batch with that ID (see FLAG_BATCHID).  Returns
+        #   ( reply, payload, flags, timeout, shard ): if the messages went
+        #   into a ring, reply is the verb and payload of what the
+        #   flusher's reply would have been; otherwise it's None, and the
+        #   rest are what to send (shard is the one to try first, or None).
+        if not isinstance( payload, list ):
+            payload = [ payload ]
+        if topic is not None:
+            payload = [ flusherproto.pack_topic( topic ) ] + payload
+            flags |= flusherproto.FLAG_TOPIC
+
+        # Nothing comes back through the ring, so if the reply matters
+        #   beyond "got it", it has to go over the socket
+        if ( wait is None ) and ( batchid is None ) and ( self.rings is not None ):
+            nshards = len( self.rings )
+            now = time.monotonic()
+            for i in range( nshards ):
+                shard = ( self.next + i ) % nshards
+                if ( self.downuntil[shard] <= now ) and self.rings[shard].put( payload, nmsgs, flags ):
+                    self.next = ( shard + 1 ) % nshards
+                    sends['ring'].inc()
+                    return ( b'OK  ', flusherproto.MSGLEN.pack( nmsgs ) ), None, None, None, None
+
+        shard = None
+        if batchid is not None:
+            payload = [ flusherproto.pack_batchid( batchid ) ] + payload
+            flags |= flusherproto.FLAG_BATCHID
+            # Only the flusher that took a batch knows its ID, so always
+            #   send the same ID to the same one (unless it's down; if it's
+            #   busy, the client gets the BUSY)
+            shard = zlib.crc32( batchid.encode( 'utf-8' ) ) % len( self.socket_files )
+        timeout = None
+        if wait is not None:
+            payload = [ flusherproto.pack_ackwait( wait ) ] + payload
+            flags |= flusherproto.FLAG_ACK
+            timeout = wait + self.timeout
+        sends['socket'].inc()
+        return None, payload, flags, timeout, shard
+
+
+# ======================================================================
+# POSTs of messages
+
+def now():
+    return datetime.datetime.now( tz=datetime.UTC ).isoformat()
+
+
+def authenticate( config, headers ):
+    # The client whose token is in the x-kafka-proxy-token header, or
+    #   None if it's nobody's
+    return token_registry( config.tokens_file, config.token ).lookup( headers.get( "x-kafka-proxy-token" ) )
+
+
+class Post:
+    # What the URL and headers of a POST of messages say about it (see
+    #   check_post).  topic is None for the default topic; flags are MSGS
+    #   frame flags (see flusherproto.py); wait is how long to wait for
+    #   delivery, or None not to; batchid is None if there isn't one;
+    #   encoding is the Content-Encoding, or None if there isn't one.
+    def __init__( self, client, topic, flags, wait, batchid, encoding ):
+        self.client = client
+        self.topic = topic
+        self.flags = flags
+        self.wait = wait
+        self.batchid = batchid
+        self.encoding = encoding
+
+
+def check_post( config, headers, content_type, mimetype, topic=None, schema=None ):
+    # Look over the request line and headers of a POST to / or
+    #   /topics/<topic> (or, if schema isn't None, /avro/<schema> or
+    #   /topics/<topic>/avro/<schema>) before reading its body.  Returns
+    #   ( err, post ): err is the response to send back if the POST is no
+    #   good (and post is None), otherwise it's None and post is a Post.
+    client = authenticate( config, headers )
+    if client is None:
+        return ( "Error, wrong x-kafka-proxy-token in HTTP headers", 500 ), None
+    # A client that's over its rate limit is turned away before
+    #   anything else is done with the request
+    retryafter = rate_limiter( config.rate_limit_path ).admit( client )
+    if retryafter is not None:
+        return ( ( f"Error, client {client.name} is over its rate limit, retry after {retryafter} seconds", 429,
+                   { 'Retry-After': str( retryafter ) } ), None )
+    # application/octet-stream is just message values; the records
+    #   content type has keys, headers, and timestamps too (see
+    #   flusherproto.py).  Records for an Avro schema are JSON (see
+    #   check_avro).
+    if schema is not None:
+        if mimetype not in ( avroencode.JSON_CONTENT_TYPE, avroencode.NDJSON_CONTENT_TYPE ):
+            return ( ( f"Error, expected {avroencode.JSON_CONTENT_TYPE} or {avroencode.NDJSON_CONTENT_TYPE} data, "
+                       f"not {content_type}", 500 ), None )
+        flags = 0
+    elif content_type == "application/octet-stream":
+        flags = 0
+    elif content_type == flusherproto.RECORDS_CONTENT_TYPE:
+        flags = flusherproto.FLAG_RECORDS
+    else:
+        return ( ( f"Error, expected application/octet-stream or {flusherproto.RECORDS_CONTENT_TYPE} data, "
+                   f"not {content_type}", 500 ), None )
+
+    # The topic comes from the url (/topics/<topic>), or else from a
+    #   header; if neither, the messages go to the default topic.  The
+    #   flusher takes whatever topic it's given, so this is where the
+    #   allowlist is enforced.
+    if topic is None:
+        topic = headers.get( "x-kafka-proxy-topic" )
+    if ( topic is not None ) and ( not topic_map( config.topiccache ).allowed( topic ) ):
+        return ( f"Error, topic {topic} is not allowed", 403 ), None
+
+    # If the client wants to know that kafka has the messages, it says
+    #   how many seconds it's willing to wait for that
+    wait = headers.get( "x-kafka-proxy-wait-for-delivery" )
+    if wait is not None:
+        try:
+            wait = float( wait )
+            if not ( wait >= 0 ):
+                raise ValueError( "must be at least 0" )
+        except ValueError:
+            return ( f"Error, bad x-kafka-proxy-wait-for-delivery {wait}", 400 ), None
+        wait = min( wait, config.max_delivery_wait )
+
+    # A client that might resend the POST (e.g. if it times out before
+    #   hearing back) can give it a batch ID, so that the messages
+    #   don't go to kafka twice
+    batchid = headers.get( "x-kafka-proxy-batch-id" )
+    if ( batchid is not None ) and ( ( len( batchid ) == 0 ) or ( len( batchid ) > config.max_batchid_length ) ):
+        return ( f"Error, x-kafka-proxy-batch-id must be 1 to {config.max_batchid_length} characters", 400 ), None
+
+    encoding = headers.get( "content-encoding", "identity" )
+    if encoding.strip().lower() == "identity":
+        encoding = None
+    return None, Post( client, topic, flags, wait, batchid, encoding )
+
+
+def check_messages( data, flags, logger ):
+    # Check the binary data of a POST body that's all there.  The body is
+    #   already in the format of the payload of a MSGS frame to the
+    #   flusher (see flusherproto.py), so all we need to do is make sure
+    #   that the length prefixes are consistent with the data.  data
+    #   should be a memoryview of the body, so the messages never get
+    #   copied.  Returns ( err, number of messages ).
+    t0 = time.perf_counter()
+    try:
+        index = flusherproto.index_messages( data )
+        if flags & flusherproto.FLAG_RECORDS:
+            flusherproto.check_records( data, index )
+    except flusherproto.ProtocolError as ex:
+        logger.error( f"Mal-formed {len(data)}-byte POST: {ex}" )
+        return ( f"Error, mal-formed data at {now()}", 500 ), 0
+    parse_seconds.observe( time.perf_counter() - t0 )
+    return None, len( index )
+
+
+def check_avro( config, headers, schema, logger ):
+    # For POSTs to /avro/<schema>: the body is JSON records, which are
+    #   encoded with the named schema (see avroencode.py) by the web
+    #   server, so the flusher gets Avro.  The x-kafka-proxy-avro-format
+    #   header can be avro or confluent; the default is confluent if the
+    #   schema has an ID, otherwise avro.  Returns ( err, ( parsed schema,
+    #   schema ID ) ); the schema ID is None for plain avro.
+    if not avroencode.supported():
+        return ( "Error, Avro encoding isn't available on this server", 501 ), None
+    if config.schema_dir is None:
+        return ( f"Error, no schema {schema}", 404 ), None
+    try:
+        parsed, schema_id = schema_cache( config.schema_dir ).get( schema )
+    except avroencode.UnknownSchema as ex:
+        logger.error( str( ex ) )
+        return ( f"Error, no schema {schema}", 404 ), None
+    avroformat = headers.get( "x-kafka-proxy-avro-format", "avro" if schema_id is None else "confluent" )
+    if avroformat not in avroencode.FORMATS:
+        return ( f"Error, bad x-kafka-proxy-avro-format {avroformat}", 400 ), None
+    if ( avroformat == "confluent" ) and ( schema_id is None ):
+        return ( f"Error, schema {schema} has no schema ID, so can't be encoded for confluent", 400 ), None
+    return None, ( parsed, schema_id if avroformat == "confluent" else None )
+
+
+def encode_avro( config, body, mimetype, parsed, schema_id ):
+    # The chunks (see flusherproto.MessageChunker) of the JSON records in
+    #   body, encoded as Avro.  Every record is parsed before this returns,
+    #   so a bad one raises avroencode.BadRecords before any are encoded;
+    #   the same records always make the same chunks.
+    records = avroencode.parse_records( body, mimetype )
+    return avroencode.encode_records( records, parsed, schema_id, config.stream_chunk_size, config.max_message_size )
+
+
+def body_error( ex, logger ):
+    # The response to a POST whose (compressed, or Avro) body couldn't be
+    #   read because of ex
+    if isinstance( ex, compression.UnsupportedEncoding ):
+        return f"Error, {ex}", 415
+    if isinstance( ex, compression.BodyTooLarge ):
+        return f"Error, {ex}", 413
+    logger.error( f"Mal-formed compressed Avro POST: {ex}" )
+    return f"Error, mal-formed data at {now()}", 500
+
+
+def flusher_failure( ex, logger ):
+    # The response to send back if sending messages to the flusher raised
+    #   ex
+    if isinstance( ex, TimeoutError ):
+        logger.error( "Timeout waiting to hear from flusher" )
+        return f"Conection to updater timed out at {now()}.", 500
+    logger.exception( ex )
+    return f"Exception handling request at {now()}", 500
+
+
+def flusher_reply( verb, resp, nbytes, nmsgs, wait, status, batchid, logger ):
+    # The flusher replied verb and resp to nmsgs messages (nbytes of MSGS
+    #   payload).  Returns ( err, duplicate ): err is None if the flusher
+    #   took them, otherwise the response to send back to the client;
+    #   duplicate is True if the flusher didn't take them because it
+    #   already took batch batchid.  If wait isn't None, the delivery
+    #   status of each message (see flusherproto.ACK_*) is added to status
+    #   (a bytearray).
+    if verb == b'BUSY':
+        # The flusher is backed up; tell the client to back off
+        busy.inc()
+        retryafter = flusherproto.MSGLEN.unpack( resp )[0]
+        logger.warning( f"Flusher is busy, telling client to retry after {retryafter} s" )
+        return ( f"Server busy, retry after {retryafter} seconds", 503, { 'Retry-After': str(retryafter) } ), False
+    elif verb == b'ERR ':
+        logger.error( f"Error response from flusher: {resp}" )
+        return ( f"Error response from flusher at {now()}", 500 ), False
+    elif verb == b'DUPL':
+        logger.info( f"Flusher already had batch {batchid}, not sending {nmsgs} messages again" )
+        duplicates.inc( nmsgs )
+    elif verb != b'OK  ':
+        logger.error( f"Unexpected response from flusher: {verb}" )
+        return ( f"Unexpected response from flusher at {now()}", 500 ), False
+    else:
+        messages.inc( nmsgs )
+        message_bytes.inc( nbytes )
+
+    if wait is not None:
+        nacked, acks = flusherproto.unpack_acks( resp )
+        # No statuses means the flusher didn't wait, so we don't know
+        status += ( bytes( [ flusherproto.ACK_PENDING ] ) * nacked ) if acks is None else acks
+
+    return None, ( verb == b'DUPL' )
+
+
+def received_response( nmsgs, nduplicates ):
+    # The response to a POST that didn't wait for delivery
+    if nduplicates == 0:
+        return f"{nmsgs} messages received", 200
+    return ( f"{nmsgs} messages received ({nduplicates} of them already received before, not sent again)",
+             200, { 'x-kafka-proxy-duplicate-messages': str( nduplicates ) } )
+
+
+def delivery_response( status, wait, nduplicates, logger ):
+    # The response to a POST that waited for delivery.  The lists of
+    #   failed messages (that the flusher gave up on) and pending
+    #   messages (that it was still trying to deliver when wait ran out)
+    #   are indexes counting from the start of the POST; the client
+    #   should resend those.  (For a batch the flusher already had, the
+    #   status is that of the messages it took the first time.)
+    failed = [ i for i, s in enumerate( status ) if s == flusherproto.ACK_FAILED ]
+    pending = [ i for i, s in enumerate( status ) if s == flusherproto.ACK_PENDING ]
+    body = { 'messages': len( status ),
+             'delivered': len( status ) - len( failed ) - len( pending ),
+             'failed': failed,
+             'pending': pending,
+             'duplicates': nduplicates }
+    if len( failed ) > 0:
+        return body, 502
+    if len( pending ) > 0:
+        logger.warning( f"{len(pending)} of {len(status)} messages not delivered within {wait} s" )
+        return body, 504
+    return body, 200
+
+
+def post_response( post, nmsgs, status, duplicate, logger ):
+    # The response to a POST whose nmsgs messages all went to the flusher
+    #   at once
+    nduplicates = nmsgs if duplicate else 0
+    if post.wait is not None:
+        return delivery_response( status, post.wait, nduplicates, logger )
+    return received_response( nmsgs, nduplicates )
+
+
+class StreamedPost:
+    # For big (or chunked, or compressed) POSTs, the body is read a bit at
+    #   a time, and each chunk's worth of whole messages is sent to the
+    #   flusher as soon as we have it, so we never hold more than about a
+    #   chunk in memory.  That means that if something goes wrong partway
+    #   through, the messages before the bad chunk have already been
+    #   accepted.  In that case, the error response has a header
+    #   x-kafka-proxy-messages-accepted with how many messages (from the
+    #   start of the body) were accepted; the client should resend the
+    #   ones after that.  If post.wait is given, each chunk waits for
+    #   delivery in turn, all within that many seconds.  If post.batchid
+    #   is given, chunk n is sent as batch <batchid>/<n>, so if the client
+    #   resends the whole POST, the chunks that were accepted the first
+    #   time aren't sent to kafka again.  This keeps track of all that;
+    #   the server does:
+    #
+    #     streamed = StreamedPost( post, logger )
+    #     try:
+    #         for each ( chunk, nmsgs ):
+    #             wait, batchid = streamed.next_chunk( chunk )
+    #             err, duplicate = send chunk to the flusher with wait and batchid, status streamed.status
+    #             if err is not None: break
+    #             streamed.accepted( chunk, nmsgs, duplicate )
+    #     except Exception as ex:
+    #         err = streamed.failed( ex )
+    #     return streamed.response( err )
+    def __init__( self, post, logger ):
+        self.post = post
+        self.logger = logger
+        self.naccepted = 0
+        self.nduplicates = 0
+        self.nchunks = 0
+        self.nbytes = 0
+        self.status = bytearray()
+        self.deadline = None if post.wait is None else time.monotonic() + post.wait
+
+    def next_chunk( self, chunk ):
+        # Returns ( wait, batch ID ) to send chunk to the flusher with
+        if self.post.flags & flusherproto.FLAG_RECORDS:
+            flusherproto.check_records( chunk, flusherproto.index_messages( chunk ) )
+        chunkwait = None if self.deadline is None else max( 0, self.deadline - time.monotonic() )
+        chunkid = None if self.post.batchid is None else f"{self.post.batchid}/{self.nchunks}"
+        self.nchunks += 1
+        return chunkwait, chunkid
+
+    def accepted( self, chunk, nmsgs, duplicate ):
+        self.naccepted += nmsgs
+        self.nbytes += len( chunk )
+        if duplicate:
+            self.nduplicates += nmsgs
+
+    def malformed( self, ex ):
+        self.logger.error( f"Mal-formed streamed POST after {self.naccepted} messages: {ex}" )
+        return f"Error, mal-formed data at {now()}", 500
+
+    def failed( self, ex ):
+        # The error for reading the body, or sending it, raising ex
+        if isinstance( ex, compression.BodyTooLarge ):
+            self.logger.error( f"Refusing streamed POST after {self.naccepted} messages: {ex}" )
+            return f"Error, {ex}", 413
+        if isinstance( ex, ( flusherproto.ProtocolError, compression.CompressionError ) ):
+            return self.malformed( ex )
+        self.logger.exception( ex )
+        return f"Exception handling request at {now()}", 500
+
+    def response( self, err=None ):
+        if err is not None:
+            text, status, *headers = err
+            headers = dict( headers[0] ) if len( headers ) > 0 else {}
+            headers[ 'x-kafka-proxy-messages-accepted' ] = str( self.naccepted )
+            return f"{text} ({self.naccepted} messages accepted before the error)", status, headers
+
+        self.logger.debug( f"Streamed {self.naccepted} messages ({self.nbytes} bytes) to the flusher" )
+        if self.post.wait is not None:
+            return delivery_response( self.status, self.post.wait, self.nduplicates, self.logger )
+        return received_response( self.naccepted, self.nduplicates )
+
+
+# ======================================================================
+# Topic changes and metrics
+
+# POSTs to /<path>/<topic> change the topic map (see topicmap.py); this is
+#   the verb to send every flusher shard for each path, and the response
+#   text for success
+TOPIC_VERBS = { 'topic': b'TPIC', 'allowtopic': b'ALOW', 'disallowtopic': b'DENY' }
+_topic_done = { b'TPIC': "Topic changed to {}", b'ALOW': "Topic {} allowed", b'DENY': "Topic {} disallowed" }
+
+
+def check_topic_change( config, headers, verb, topic ):
+    if authenticate( config, headers ) is None:
+        return "Error, wrong x-kafka-proxy-token in HTTP headers", 500
+    if ( verb == b'DENY' ) and ( topic == topic_map( config.topiccache ).default ):
+        return f"Error, can't disallow the default topic {topic}", 400
+    return None
+
+
+def topic_change_response( verb, topic, replies, nshards, logger ):
+    # replies are the flushers' replies to verb (see
+    #   FlusherShards.broadcast).  Every flusher shard has to know about the
+    #   change.  (If a shard misses it, it will still notice the change in
+    #   the topic cache file, which the other shards write, within a second
+    #   or so.)
+    failed = []
+    for socket_file, respverb, resp in replies:
+        logger.debug( f"Got response to {verb} {topic} from {socket_file}: {respverb} {resp}" )
+        if respverb is None:
+            logger.error( f"Failed to send {verb} {topic} to flusher at {socket_file}: {resp}" )
+            failed.append( socket_file )
+        elif respverb != b'OK  ':
+            logger.error( f"Unexpected response from flusher at {socket_file} after {verb} {topic}: "
+                          f"{respverb} {resp}" )
+            failed.append( socket_file )
+    if len( failed ) > 0:
+        return f"{str(verb, 'utf-8')} {topic} failed for {len(failed)} of {nshards} flushers", 500
+    return _topic_done[ verb ].format( topic ), 200
+
+
+def check_metrics( config, headers ):
+    # If KAFKA_PROXY_METRICS_TOKEN is set, the scraper has to send it as a
+    #   bearer token
+    if ( ( config.metrics_token is not None )
+         and not hmac.compare_digest( headers.get( "authorization", "" ).encode( 'utf-8' ),
+                                      f"Bearer {config.metrics_token}".encode() ) ):
+        return "Error, wrong bearer token for /metrics", 401
+    return None
+
+
+def metrics_response( replies, logger ):
+    # Prometheus metrics for the web server (all of its worker processes)
+    #   and every flusher shard (labelled with the shard number), given the
+    #   shards' replies to STAT (see FlusherShards.broadcast)
+    snapshots = [ ( registry.collect(), {} ) ]
+    up = []
+    for shard, ( socket_file, verb, resp ) in enumerate( replies ):
+        labels = { 'shard': str( shard ) }
+        answered = False
+        if verb == b'OK  ':
+            try:
+                snapshots.append( ( json.loads( resp ), labels ) )
+                answered = True
+            except ValueError as ex:
+                logger.error( f"Bad STAT reply from flusher at {socket_file}: {ex}" )
+        else:
+            logger.warning( f"Failed to get metrics from flusher at {socket_file}: {verb} {resp}" )
+        up.append( { 'name': 'kafka_proxy_flusher_up', 'kind': 'gauge', 'labels': labels,
+                     'help': "Whether the flusher answered when asked for its metrics",
+                     'value': 1 if answered else 0 } )
+    snapshots.append( ( { 'metrics': up }, {} ) )
+
+    return metrics.render( snapshots ), 200, { 'Content-Type': metrics.CONTENT_TYPE }
@@ -0,0 +1,218 @@
+# Counters, gauges, and histograms, cheap enough to update on every
+#   request, that can be shown to Prometheus.
+#
+# A Metrics object holds a fixed set of metrics, all declared up front
+#   (e.g. at import time), so that the values are just an array of
+#   doubles: updating a metric is one or two array element updates.  A
+#   counter or gauge is one element; a histogram with n bucket bounds is
+#   n+3 (the number of observations in each bucket, including the +Inf
+#   one, then the sum and count of all observations).
+#
+# The webserver runs as several gunicorn worker processes, and a scrape
+#   of /metrics only reaches one of them.  So, share() puts a process'
+#   values in a memory-mapped file <directory>/<layout>.<pid>.metrics,
+#   and collect() adds up the files of every process that has the same
+#   metrics (layout is a hash of the declarations).  Files of processes
+#   that have exited are still counted, so that counters never go
+#   backwards; clear out the directory when the whole server restarts.
+#
+# Each metric should only be updated by one thread (an update isn't
+#   atomic); the gevent greenlets of a gunicorn worker don't count, since
+#   they never run at the same time.
+#
+# snapshot() and collect() give a JSON-serializable dict; that's what
+#   the flusher sends back for a STAT frame.  render() turns any number
+#   of those (e.g. one from the webserver workers and one from each
+#   flusher) into the Prometheus text exposition format.
+
+import os
+import mmap
+import array
+import bisect
+import hashlib
+import pathlib
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; from 100 microseconds to 10 seconds
+LATENCY_BUCKETS = ( 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1., 2.5, 5., 10. )
+# Counts of things (e.g. messages in a batch); 1 to about a million
+COUNT_BUCKETS = tuple( 4**i for i in range( 11 ) )
+# Bytes; 1 kiB to 64 MiB
+BYTE_BUCKETS = tuple( 1024 * 4**i for i in range( 9 ) )
+
+
+class _Metric:
+    def __init__( self, metrics, slot ):
+        self.metrics = metrics
+        self.slot = slot
+
+
+class Counter( _Metric ):
+    def inc( self, n=1 ):
+        self.metrics.values[ self.slot ] += n
+
+    def set( self, value ):
+        # For a count that's kept somewhere else
+        self.metrics.values[ self.slot ] = value
+
+
+class Gauge( _Metric ):
+    def set( self, value ):
+        self.metrics.values[ self.slot ] = value
+
+    def inc( self, n=1 ):
+        self.metrics.values[ self.slot ] += n
+
+
+class Histogram( _Metric ):
+    def __init__( self, metrics, slot, buckets ):
+        super().__init__( metrics, slot )
+        self.buckets = buckets
+        self.sumslot = slot + len( buckets ) + 1
+
+    def observe( self, value ):
+        values = self.metrics.values
+        values[ self.slot + bisect.bisect_left( self.buckets, value ) ] += 1
+        values[ self.sumslot ] += value
+        values[ self.sumslot + 1 ] += 1
+
+
+class Metrics:
+    def __init__( self ):
+        # ( name, kind, help, labels, buckets, slot ) for each metric, in
+        #   the order declared
+        self.defs = []
+        self.nslots = 0
+        self.values = array.array( 'd' )
+        self.directory = None
+        self.mm = None
+        self.pid = None
+
+    def _declare( self, name, kind, help, labels, buckets, nslots ):
+        if self.mm is not None:
+            raise RuntimeError( "Can't declare more metrics after share()" )
+        slot = self.nslots
+        self.defs.append( ( name, kind, help, dict( labels ), buckets, slot ) )
+        self.nslots += nslots
+        self.values.extend( [ 0. ] * nslots )
+        return slot
+
+    def counter( self, name, help, labels={} ):
+        return Counter( self, self._declare( name, 'counter', help, labels, None, 1 ) )
+
+    def gauge( self, name, help, labels={} ):
+        return Gauge( self, self._declare( name, 'gauge', help, labels, None, 1 ) )
+
+    def histogram( self, name, help, buckets=LATENCY_BUCKETS, labels={} ):
+        buckets = tuple( buckets )
+        return Histogram( self, self._declare( name, 'histogram', help, labels, buckets, len(buckets) + 3 ),
+                          buckets )
+
+    def layout( self ):
+        # A short hash of the declarations, so that files from processes
+        #   with different metrics don't get added together
+        desc = repr( [ d[:5] for d in self.defs ] ).encode( 'utf-8' )
+        return hashlib.sha1( desc ).hexdigest()[:12]
+
+    def share( self, directory ):
+        # Move this process' values into a file in directory (see above).
+        #   Call this after declaring all the metrics, and again in a
+        #   child process after a fork (with the same directory, which
+        #   starts the child's values over at zero).
+        self.directory = pathlib.Path( directory )
+        self.directory.mkdir( parents=True, exist_ok=True )
+        path = self.directory / f"{self.layout()}.{os.getpid()}.metrics"
+        size = max( 8, 8 * self.nslots )
+        fd = os.open( path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666 )
+        try:
+            os.ftruncate( fd, size )
+            mm = mmap.mmap( fd, size )
+        finally:
+            os.close( fd )
+        values = memoryview( mm ).cast( 'd' )
+        if self.mm is None:
+            values[ 0 : self.nslots ] = self.values
+        self.values = values
+        self.mm = mm
+        self.pid = os.getpid()
+
+    def snapshot( self ):
+        return self._snapshot( self.values )
+
+    def collect( self ):
+        # Like snapshot(), but adds up every process sharing the directory
+        if self.directory is None:
+            return self.snapshot()
+        totals = array.array( 'd', [ 0. ] ) * self.nslots
+        for path in self.directory.glob( f"{self.layout()}.*.metrics" ):
+            try:
+                with open( path, 'rb' ) as ifp:
+                    data = ifp.read()
+            except FileNotFoundError:
+                continue
+            if len( data ) < 8 * self.nslots:
+                continue
+            values = array.array( 'd', data[ 0 : 8 * self.nslots ] )
+            for i in range( self.nslots ):
+                totals[i] += values[i]
+        return self._snapshot( totals )
+
+    def _snapshot( self, values ):
+        metrics = []
+        for name, kind, help, labels, buckets, slot in self.defs:
+            if kind == 'histogram':
+                n = len( buckets )
+                metrics.append( { 'name': name, 'kind': kind, 'help': help, 'labels': labels,
+                                  'buckets': list( buckets ),
+                                  'counts': list( values[ slot : slot + n + 1 ] ),
+                                  'sum': values[ slot + n + 1 ], 'count': values[ slot + n + 2 ] } )
+            else:
+                metrics.append( { 'name': name, 'kind': kind, 'help': help, 'labels': labels,
+                                  'value': values[ slot ] } )
+        return { 'metrics': metrics }
+
+
+def _format_labels( labels ):
+    if len( labels ) == 0:
+        return ''
+    escaped = ( ( k, str( v ).replace( '\\', '\\\\' ).replace( '"', '\\"' ).replace( '\n', '\\n' ) )
+                for k, v in labels.items() )
+    return '{' + ','.join( f'{k}="{v}"' for k, v in escaped ) + '}'
+
+
+def _format_value( value ):
+    if value == int( value ):
+        return str( int( value ) )
+    return repr( value )
+
+
+def render( snapshots ):
+    # snapshots is a list of ( snapshot, labels ), where labels (a dict)
+    #   are added to every metric in the snapshot (e.g. which flusher it
+    #   came from).  Returns the Prometheus text exposition format, with
+    #   each metric's HELP and TYPE once, followed by all of its series.
+    families = {}
+    for snapshot, extralabels in snapshots:
+        for metric in snapshot['metrics']:
+            family = families.setdefault( metric['name'], ( metric['kind'], metric['help'], [] ) )
+            family[2].append( ( metric, { **metric['labels'], **extralabels } ) )
+
+    lines = []
+    for name, ( kind, help, series ) in families.items():
+        lines.append( f"# HELP {name} {help}" )
+        lines.append( f"# TYPE {name} {kind}" )
+        for metric, labels in series:
+            if kind == 'histogram':
+                cumulative = 0
+                for bound, count in zip( metric['buckets'] + [ '+Inf' ], metric['counts'] ):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else _format_value( bound )
+                    lines.append( f"{name}_bucket{_format_labels( { **labels, 'le': le } )} "
+                                  f"{_format_value( cumulative )}" )
+                lines.append( f"{name}_sum{_format_labels( labels )} {_format_value( metric['sum'] )}" )
+                lines.append( f"{name}_count{_format_labels( labels )} {_format_value( metric['count'] )}" )
+            else:
+                lines.append( f"{name}{_format_labels( labels )} {_format_value( metric['value'] )}" )
+    return '\n'.join( lines ) + '\n'
@@ -0,0 +1,263 @@
+# Client tokens and per-client rate limits.
+#
+# Clients are listed, as JSON, in the tokens file (KAFKA_PROXY_TOKENS_FILE):
+#
+#   { "clients": { "alice": { "token": "...", "messages_per_second": 5000,
+#                             "bytes_per_second": 10485760, "burst": 2 },
+#                  "bob": { "token": "..." } } }
+#
+# A POST's x-kafka-proxy-token header says which client it's from.  A
+#   client without messages_per_second or bytes_per_second has no limit
+#   on that.  The webservers notice changes to the file within a second or
+#   so.  If the file isn't there (or can't be read), no token in it is
+#   accepted.  KAFKA_PROXY_TOKEN, if set, is also accepted, as a client
+#   named "default" with no limits.
+#
+# Each limit is a token bucket that holds up to burst seconds' worth of
+#   the rate, and fills up at the rate.  A POST is refused (429) without
+#   reading its body if either of its client's buckets is empty; otherwise
+#   the messages and bytes it passes on to the flusher are taken out of
+#   the buckets, which can leave them below empty, so that a big POST
+#   holds back the client's next ones until the buckets have filled back
+#   up.  That way the limits hold over time however the client sizes its
+#   POSTs.
+#
+# The buckets have to be shared by all of the webserver's worker
+#   processes, so they live in a file (normally under /dev/shm, so it's
+#   just memory) that every process memory maps: BUCKETS_HEADER, and then
+#   nslots slots of BUCKET, each one
+#
+#   8 bytes : key; a hash of the client name (0 for an unused slot)
+#   8 bytes : messages in the bucket (double)
+#   8 bytes : bytes in the bucket (double)
+#   8 bytes : time.monotonic() of the last update (double)
+#
+# Slots are found by open addressing on the key.  Like the ring (see
+#   ring.py), the slots are protected by an flock on the file.
+
+import os
+import hmac
+import json
+import math
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import pathlib
+import contextlib
+
+BUCKETS_VERSION = 1
+BUCKETS_MAGIC = b'KPB' + bytes( [ BUCKETS_VERSION ] )
+BUCKETS_HEADER = struct.Struct( '<4sI8x' )
+BUCKET = struct.Struct( '<Qddd' )
+
+
+class Client:
+    def __init__( self, name, token, messages_per_second=None, bytes_per_second=None, burst=1. ):
+        self.name = name
+        self.token = token.encode( 'utf-8' )
+        self.messages_per_second = messages_per_second
+        self.bytes_per_second = bytes_per_second
+        self.burst = burst
+        self.key = int.from_bytes( hashlib.blake2b( name.encode( 'utf-8' ), digest_size=8 ).digest(), 'little' ) | 1
+
+    @property
+    def limited( self ):
+        return ( self.messages_per_second is not None ) or ( self.bytes_per_second is not None )
+
+    @classmethod
+    def parse( cls, name, settings ):
+        token = settings.get( 'token' )
+        if ( not isinstance( token, str ) ) or ( len( token ) == 0 ):
+            raise ValueError( f"Client {name} has no token" )
+        limits = {}
+        for what in ( 'messages_per_second', 'bytes_per_second', 'burst' ):
+            value = settings.get( what )
+            if value is None:
+                continue
+            if isinstance( value, bool ) or ( not isinstance( value, ( int, float ) ) ) or ( not value > 0 ):
+                raise ValueError( f"Client {name} {what} must be a number more than 0" )
+            limits[ what ] = float( value )
+        return cls( name, token, **limits )
+
+
+class TokenRegistry:
+    def __init__( self, clients=None ):
+        self.clients = [] if clients is None else list( clients )
+
+    def lookup( self, token ):
+        # The client with token, or None.  Every client's token is
+        #   compared (in constant time), so how long this takes doesn't
+        #   say which one matched, or how much of a wrong token was right.
+        if token is None:
+            return None
+        token = token.encode( 'utf-8' )
+        found = None
+        for client in self.clients:
+            if hmac.compare_digest( token, client.token ):
+                found = client
+        return found
+
+    @classmethod
+    def parse( cls, text ):
+        data = json.loads( text )
+        if ( not isinstance( data, dict ) ) or ( not isinstance( data.get( 'clients' ), dict ) ):
+            raise ValueError( "Tokens file must have a \"clients\" object" )
+        return cls( Client.parse( name, settings ) for name, settings in data['clients'].items() )
+
+    @classmethod
+    def read( cls, path ):
+        with open( path ) as ifp:
+            return cls.parse( ifp.read() )
+
+
+class TokenRegistryFile:
+    # Like topicmap.TopicMapFile: keeps a TokenRegistry read from path (if
+    #   it's not None) up to date, looking to see if the file has changed
+    #   at most every checkevery seconds.  default_token (if not None) is
+    #   added as client "default".
+    def __init__( self, path, default_token=None, checkevery=1 ):
+        self.path = None if path is None else pathlib.Path( path )
+        self.default = None if default_token is None else Client( "default", default_token )
+        self.checkevery = checkevery
+        self.mtime = None
+        self.lastcheck = None
+        self.registry = self._with_default( TokenRegistry() )
+
+    def _with_default( self, registry ):
+        if self.default is not None:
+            registry.clients.append( self.default )
+        return registry
+
+    def get( self ):
+        if self.path is None:
+            return self.registry
+        now = time.monotonic()
+        if ( self.lastcheck is None ) or ( now - self.lastcheck >= self.checkevery ):
+            self.lastcheck = now
+            try:
+                mtime = self.path.stat().st_mtime_ns
+                if mtime != self.mtime:
+                    self.registry = self._with_default( TokenRegistry.read( self.path ) )
+                    self.mtime = mtime
+            except ( OSError, ValueError ):
+                self.registry = self._with_default( TokenRegistry() )
+                self.mtime = None
+        return self.registry
+
+
+class RateLimiter:
+    # The token buckets of every client, shared through the file at path
+    #   by every process that uses the same path.  (If path is None, or
+    #   the file can't be made, the buckets are only this process'.)  The
+    #   file is opened the first time it's needed, and again after a fork,
+    #   because an flock is shared with a forked child and wouldn't keep
+    #   it out.
+    def __init__( self, path, nslots=4096 ):
+        self.path = path
+        self.nslots = nslots
+        self.pid = None
+        self.fd = None
+        self.mm = None
+
+    def _open( self ):
+        # (Closing what we had, e.g. our parent's, only affects us)
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.fd is not None:
+            os.close( self.fd )
+            self.fd = None
+        self.pid = os.getpid()
+        size = BUCKETS_HEADER.size + self.nslots * BUCKET.size
+        if self.path is not None:
+            try:
+                fd = os.open( self.path, os.O_RDWR | os.O_CREAT, 0o600 )
+                try:
+                    fcntl.flock( fd, fcntl.LOCK_EX )
+                    try:
+                        if os.fstat( fd ).st_size == 0:
+                            os.ftruncate( fd, size )
+                            os.pwrite( fd, BUCKETS_HEADER.pack( BUCKETS_MAGIC, self.nslots ), 0 )
+                        magic, nslots = BUCKETS_HEADER.unpack( os.pread( fd, BUCKETS_HEADER.size, 0 ) )
+                        if ( ( magic != BUCKETS_MAGIC ) or ( nslots != self.nslots )
+                             or ( os.fstat( fd ).st_size != size ) ):
+                            raise ValueError( f"{self.path} is not a rate limit file with {self.nslots} slots" )
+                    finally:
+                        fcntl.flock( fd, fcntl.LOCK_UN )
+                    self.mm = mmap.mmap( fd, size )
+                    self.fd = fd
+                    return
+                except BaseException:
+                    os.close( fd )
+                    raise
+            except ( OSError, ValueError ):
+                pass
+        self.mm = mmap.mmap( -1, size )
+
+    @contextlib.contextmanager
+    def _locked( self ):
+        if os.getpid() != self.pid:
+            self._open()
+        if self.fd is None:
+            yield
+            return
+        fcntl.flock( self.fd, fcntl.LOCK_EX )
+        try:
+            yield
+        finally:
+            fcntl.flock( self.fd, fcntl.LOCK_UN )
+
+    def _slot( self, client, now ):
+        # The offset of client's slot, and its buckets brought up to now.
+        #   Must be called with the lock held.
+        mm = self.mm
+        for i in range( self.nslots ):
+            offset = BUCKETS_HEADER.size + ( ( client.key + i ) % self.nslots ) * BUCKET.size
+            key, msgs, nbytes, last = BUCKET.unpack_from( mm, offset )
+            if key == client.key:
+                break
+            if key == 0:
+                # A new client starts with full buckets
+                msgs, nbytes, last = math.inf, math.inf, now
+                break
+        else:
+            return None, 0., 0.
+
+        elapsed = max( 0., now - last )
+        if client.messages_per_second is not None:
+            msgs = min( msgs + elapsed * client.messages_per_second, client.burst * client.messages_per_second )
+        if client.bytes_per_second is not None:
+            nbytes = min( nbytes + elapsed * client.bytes_per_second, client.burst * client.bytes_per_second )
+        return offset, msgs, nbytes
+
+    def admit( self, client, now=None ):
+        # None if client may send more now, otherwise how many seconds it
+        #   should wait before trying again
+        if not client.limited:
+            return None
+        now = time.monotonic() if now is None else now
+        with self._locked():
+            offset, msgs, nbytes = self._slot( client, now )
+            if offset is None:
+                # Every slot is taken; don't hold anybody up over that
+                return None
+            BUCKET.pack_into( self.mm, offset, client.key, msgs, nbytes, now )
+        wait = 0.
+        if ( client.messages_per_second is not None ) and ( msgs <= 0 ):
+            wait = max( wait, ( 1 - msgs ) / client.messages_per_second )
+        if ( client.bytes_per_second is not None ) and ( nbytes <= 0 ):
+            wait = max( wait, ( 1 - nbytes ) / client.bytes_per_second )
+        return None if wait == 0. else max( 1, math.ceil( wait ) )
+
+    def charge( self, client, nmsgs, nbytes, now=None ):
+        # Take nmsgs messages and nbytes bytes out of client's buckets
+        if not client.limited:
+            return
+        now = time.monotonic() if now is None else now
+        with self._locked():
+            offset, msgs, bucketbytes = self._slot( client, now )
+            if offset is None:
+                return
+            BUCKET.pack_into( self.mm, offset, client.key, msgs - nmsgs, bucketbytes - nbytes, now )
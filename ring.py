@@ -0,0 +1,299 @@
+# A shared-memory ring buffer that the webserver's worker processes can
+#   use to hand messages to the flusher without sending them through the
+#   flusher's socket.  (The socket is still used for everything else, e.g.
+#   TPIC, and for messages when the ring is full.)
+#
+# The ring is a file, normally under /dev/shm so that it's just memory,
+#   that the flusher creates and that every process memory maps.  It
+#   starts with a HEADER.size-byte header:
+#
+#   bytes  0-3  : RING_MAGIC; b'KPR' followed by the format version byte
+#   bytes  4-7  : size of the header (little-endian unsigned int)
+#   bytes  8-15 : capacity of the data area in bytes
+#   bytes 16-23 : head; how many bytes the consumer has finished with
+#   bytes 24-31 : tail; how many bytes producers have written
+#   bytes 32-39 : time.time() of the consumer's last heartbeat (double)
+#
+# followed by the data area.  head and tail only ever go up; position p
+#   is at byte p % capacity of the data area.  Each record starts on a
+#   16-byte boundary, and is
+#
+#   4 bytes : length of the payload (little-endian unsigned int), or WRAP,
+#             meaning the rest of the data area is unused and the next
+#             record is at the start of it
+#   4 bytes : the number of messages in the payload
+#   4 bytes : flags, as in a MSGS frame
+#   4 bytes : unused
+#   payload : a MSGS payload (see flusherproto.py)
+#
+# Any number of processes may write (producers); one process (the
+#   flusher) reads (the consumer).  There's no atomic compare-and-swap on
+#   shared memory in python, so head and tail are protected by an flock
+#   on the ring file.  A producer copies its record in while holding the
+#   lock, so the record is all there before anyone can see the new tail.
+#   The consumer holds the lock just long enough to read tail or write
+#   head; nobody writes between head and tail, so it can read the records
+#   without it.
+#
+# The consumer sleeps in select(), so producers wake it up by writing a
+#   byte to a named pipe next to the ring file (<ring>.wake).  They only
+#   do that if the ring was empty; if it wasn't, the consumer hasn't
+#   caught up yet, and will find the new record when it does.
+
+import os
+import mmap
+import time
+import fcntl
+import errno
+import struct
+import pathlib
+import threading
+import contextlib
+
+RING_VERSION = 2
+RING_MAGIC = b'KPR' + bytes( [ RING_VERSION ] )
+HEADER = struct.Struct( '<4sIQQQd' )
+RECHDR = struct.Struct( '<IIII' )
+HEADPOS = 16
+TAILPOS = 24
+HEARTBEATPOS = 32
+POSITION = struct.Struct( '<Q' )
+HEARTBEAT = struct.Struct( '<d' )
+WRAP = 0xffffffff
+
+
+class RingError( Exception ):
+    pass
+
+
+class RingFull( RingError ):
+    pass
+
+
+def _recsize( paylen ):
+    return ( RECHDR.size + paylen + 15 ) & ~15
+
+
+class _Ring:
+    # What producers and the consumer have in common
+    def _map( self, fd ):
+        self.fd = fd
+        size = os.fstat( fd ).st_size
+        if size < HEADER.size:
+            raise RingError( f"{self.path} is too small to be a ring" )
+        self.mm = mmap.mmap( fd, size )
+        magic, hdrsize, capacity, _head, _tail, _heartbeat = HEADER.unpack_from( self.mm )
+        if ( magic != RING_MAGIC ) or ( hdrsize != HEADER.size ) or ( hdrsize + capacity != size ):
+            self.close()
+            raise RingError( f"{self.path} is not a valid ring" )
+        self.capacity = capacity
+
+    @contextlib.contextmanager
+    def _locked( self ):
+        fcntl.flock( self.fd, fcntl.LOCK_EX )
+        try:
+            yield
+        finally:
+            fcntl.flock( self.fd, fcntl.LOCK_UN )
+
+    def _positions( self ):
+        return ( POSITION.unpack_from( self.mm, HEADPOS )[0], POSITION.unpack_from( self.mm, TAILPOS )[0] )
+
+    def close( self ):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.fd is not None:
+            os.close( self.fd )
+            self.fd = None
+
+
+class RingConsumer( _Ring ):
+    # The flusher's end.  Creates the ring (and wake pipe) if there isn't
+    #   one already; if there is, keeps using it, capacity and all, so that
+    #   anything producers wrote while the flusher was down isn't lost.
+    def __init__( self, path, capacity=67108864 ):
+        self.path = pathlib.Path( path )
+        self.wakepath = self.path.parent / f"{self.path.name}.wake"
+        self.fd = None
+        self.mm = None
+
+        try:
+            self._map( os.open( self.path, os.O_RDWR ) )
+        except ( FileNotFoundError, RingError ):
+            self._create( ( capacity + 15 ) & ~15 )
+
+        # Records before taken have been handed out by records(), but head
+        #   isn't moved up to it until release().
+        self.taken, _tail = self._positions()
+        self.view = memoryview( self.mm )
+        self.lastheartbeat = 0.
+
+        if self.wakepath.exists() and ( not self.wakepath.is_fifo() ):
+            self.wakepath.unlink()
+        if not self.wakepath.exists():
+            os.mkfifo( self.wakepath, 0o666 )
+        self.wakefd = os.open( self.wakepath, os.O_RDONLY | os.O_NONBLOCK )
+        # Keep the pipe open for writing ourselves too, so that it never
+        #   looks closed (readable, with nothing to read) when there are no
+        #   producers.
+        self.wakewfd = os.open( self.wakepath, os.O_WRONLY | os.O_NONBLOCK )
+        self.heartbeat()
+
+    def _create( self, capacity ):
+        # Build the new ring off to the side and move it into place, so
+        #   that a producer can never map a half-made one.
+        tmppath = self.path.parent / f".{self.path.name}.{os.getpid()}"
+        fd = os.open( tmppath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666 )
+        try:
+            os.ftruncate( fd, HEADER.size + capacity )
+            os.pwrite( fd, HEADER.pack( RING_MAGIC, HEADER.size, capacity, 0, 0, time.time() ), 0 )
+            os.replace( tmppath, self.path )
+        except Exception:
+            os.close( fd )
+            tmppath.unlink( missing_ok=True )
+            raise
+        self._map( fd )
+
+    def fileno( self ):
+        # For select(); readable when a producer has woken us up
+        return self.wakefd
+
+    def clear_wakeups( self ):
+        try:
+            while len( os.read( self.wakefd, 4096 ) ) > 0:
+                pass
+        except BlockingIOError:
+            pass
+
+    def heartbeat( self ):
+        # Let producers know we're alive; they stop using a ring whose
+        #   consumer hasn't done this for a while.
+        now = time.time()
+        if now - self.lastheartbeat >= 0.5:
+            HEARTBEAT.pack_into( self.mm, HEARTBEATPOS, now )
+            self.lastheartbeat = now
+
+    def records( self, maxbytes=None ):
+        # Yield ( payload, nmsgs, flags ) for the records after the last ones
+        #   handed out, stopping before the payloads would add up to more
+        #   than maxbytes (but always giving at least one record).  payload
+        #   is a memoryview into the ring; it's only good until release()
+        #   is called.
+        with self._locked():
+            _head, tail = self._positions()
+        base = HEADER.size
+        nbytes = 0
+        while self.taken < tail:
+            offset = self.taken % self.capacity
+            paylen, nmsgs, flags, _ = RECHDR.unpack_from( self.mm, base + offset )
+            if paylen == WRAP:
+                self.taken += self.capacity - offset
+                continue
+            if ( maxbytes is not None ) and ( nbytes > 0 ) and ( nbytes + paylen > maxbytes ):
+                return
+            start = base + offset + RECHDR.size
+            self.taken += _recsize( paylen )
+            nbytes += paylen
+            yield self.view[ start : start + paylen ], nmsgs, flags
+
+    def release( self ):
+        # Give back the space of everything records() has handed out.
+        #   Returns True if there are more records waiting.
+        with self._locked():
+            head, tail = self._positions()
+            if self.taken != head:
+                POSITION.pack_into( self.mm, HEADPOS, self.taken )
+        return tail != self.taken
+
+    def close( self ):
+        for fd in ( self.wakefd, self.wakewfd ):
+            os.close( fd )
+        self.wakefd = None
+        self.wakewfd = None
+        self.view.release()
+        super().close()
+
+
+class RingProducer( _Ring ):
+    # A webserver worker's end.  The ring has to exist already.  Don't
+    #   use one of these across a fork: flocks belong to the open file,
+    #   which parent and child would share, so they wouldn't lock each
+    #   other out.
+    def __init__( self, path ):
+        self.path = pathlib.Path( path )
+        self.wakepath = self.path.parent / f"{self.path.name}.wake"
+        self.fd = None
+        self.mm = None
+        self._map( os.open( self.path, os.O_RDWR ) )
+        self.ino = os.fstat( self.fd ).st_ino
+        self.wakefd = None
+        # flock doesn't keep threads (sharing our file) out of each other's way
+        self.lock = threading.Lock()
+
+    def consumer_age( self ):
+        # Seconds since the consumer's last heartbeat
+        return time.time() - HEARTBEAT.unpack_from( self.mm, HEARTBEATPOS )[0]
+
+    def replaced( self ):
+        # True if the ring file we have mapped isn't the one at path any more
+        try:
+            return os.stat( self.path ).st_ino != self.ino
+        except FileNotFoundError:
+            return True
+
+    def put( self, payload, nmsgs, flags=0 ):
+        # Write one record.  payload is a bytes-like object, or a list of
+        #   them that together make up the payload.  Raises RingFull if
+        #   there isn't room for it right now.
+        if not isinstance( payload, list ):
+            payload = [ payload ]
+        payload = [ memoryview( b ).cast( 'B' ) for b in payload ]
+        paylen = sum( len( b ) for b in payload )
+        size = _recsize( paylen )
+        if size > self.capacity:
+            raise RingFull( f"{paylen}-byte record won't fit in a {self.capacity}-byte ring" )
+
+        base = HEADER.size
+        with self.lock, self._locked():
+            head, tail = self._positions()
+            offset = tail % self.capacity
+            pad = self.capacity - offset if offset + size > self.capacity else 0
+            if tail + pad + size - head > self.capacity:
+                raise RingFull( f"No room for a {paylen}-byte record" )
+            if pad > 0:
+                RECHDR.pack_into( self.mm, base + offset, WRAP, 0, 0, 0 )
+                offset = 0
+            RECHDR.pack_into( self.mm, base + offset, paylen, nmsgs, flags, 0 )
+            pos = base + offset + RECHDR.size
+            for b in payload:
+                self.mm[ pos : pos + len( b ) ] = b
+                pos += len( b )
+            POSITION.pack_into( self.mm, TAILPOS, tail + pad + size )
+            wake = ( head == tail )
+        if wake:
+            self._wake()
+
+    def _wake( self ):
+        try:
+            if self.wakefd is None:
+                self.wakefd = os.open( self.wakepath, os.O_WRONLY | os.O_NONBLOCK )
+            os.write( self.wakefd, b'\0' )
+        except BlockingIOError:
+            # Pipe is full, so there are wakeups pending anyway
+            pass
+        except OSError as ex:
+            # ENXIO or EPIPE: nobody has the pipe open for reading.  The
+            #   record is in the ring, and the consumer will get it when it
+            #   comes back.
+            if ex.errno not in ( errno.ENXIO, errno.EPIPE, errno.ENOENT ):
+                raise
+            if self.wakefd is not None:
+                os.close( self.wakefd )
+                self.wakefd = None
+
+    def close( self ):
+        if self.wakefd is not None:
+            os.close( self.wakefd )
+            self.wakefd = None
+        super().close()
@@ -19,14 +19,49 @@ fi
 
 echo "Going to listen on port ${port}"
 
-python /webap_code/flusher.py -t $topic &
-# python /webap_code/flusher.py -t $topic -v &
+# With KAFKA_FLUSHER_SHARDS > 1, run that many flushers, each on its own
+#   socket (and, if there's a spool or shared-memory ring, with its own
+#   spool directory and ring).  The webserver spreads POSTs across them.
+shards=${KAFKA_FLUSHER_SHARDS:-1}
+sockpath=${KAFKA_FLUSHER_SOCKET_PATH:-/tmp/flusher_socket}
+ringpath=${KAFKA_FLUSHER_RING_PATH:-/dev/shm/kafka_flusher_ring}
+if [ $shards -gt 1 ]; then
+    for (( i=0; i<$shards; i++ )); do
+        shardargs=( -p "${sockpath}.${i}" --ring-path "${ringpath}.${i}" )
+        if [ -n "${KAFKA_FLUSHER_SPOOL_DIR}" ]; then
+            shardargs+=( --spool-dir "${KAFKA_FLUSHER_SPOOL_DIR}/shard${i}" )
+        fi
+        python /webap_code/flusher.py -t $topic "${shardargs[@]}" &
+    done
+else
+    python /webap_code/flusher.py -t $topic &
+    # python /webap_code/flusher.py -t $topic -v &
+fi
+
+# Each webserver worker process keeps its metrics in a file here; start
+#   the counts over
+metricsdir=${KAFKA_PROXY_METRICS_DIR-/dev/shm/kafka_proxy_metrics}
+if [ -n "${metricsdir}" ]; then
+    rm -rf "${metricsdir}"
+fi
+# ... and they share clients' rate limit buckets here; start them full
+rm -f "${KAFKA_PROXY_RATE_LIMIT_PATH:-/dev/shm/kafka_proxy_rate_limits}"
 
+# KAFKA_PROXY_SERVER picks the webserver: gunicorn (webserver.py, the
+#   default) or asyncio (asyncserver.py).  Either way there are
+#   KAFKA_PROXY_WORKERS worker processes.
+server=${KAFKA_PROXY_SERVER:-gunicorn}
+workers=${KAFKA_PROXY_WORKERS:-4}
+sslargs=()
 if [ $bogus -ne 0 ]; then
     echo "WARNING : running with bogus self-signed certificate (OK for tests, not for anything public)"
-    exec gunicorn -w 4 -b 0.0.0.0:${port} -k gevent --timeout 0 --certfile /usr/src/bogus_cert.pem --keyfile /usr/src/bogus_key.pem webserver:app
+    sslargs=( --certfile /usr/src/bogus_cert.pem --keyfile /usr/src/bogus_key.pem )
+fi
+
+if [ "${server}" = "asyncio" ]; then
+    exec python /webap_code/asyncserver.py -w ${workers} -b 0.0.0.0 -p ${port} "${sslargs[@]}"
 else
-    exec gunicorn -w 4 -b 0.0.0.0:${port} -k gevent --timeout 0 webserver:app
+    exec gunicorn -w ${workers} -b 0.0.0.0:${port} -k gevent --timeout 0 "${sslargs[@]}" webserver:app
 fi
 
 echo "You should never see this."
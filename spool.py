@@ -0,0 +1,171 @@
+# An append-only on-disk spool (write-ahead log) that the flusher can use
+#   so that messages it has acknowledged to the webserver survive the
+#   flusher crashing or being restarted before they get to kafka.
+#
+# The spool is a directory of segment files named <segno>.seg.  Each
+#   segment is a fixed-size file that's memory mapped while it's being
+#   written.  A segment holds a sequence of records, each one
+#
+#     4 bytes : 1 + length of the record data (little-endian unsigned int)
+#     4 bytes : crc32 of the record data (little-endian unsigned int)
+#     data
+#
+# A zero where a record length should be marks the end of the segment.
+#   (The files are created zero-filled, so that's where the last write
+#   stopped.)  A record whose crc doesn't match was torn by a crash, and
+#   is treated the same way.
+#
+# The spool doesn't know what the records mean; it just counts, for each
+#   segment, how many records haven't been released yet.  Once every
+#   record in a segment has been released, and the spool has moved on to
+#   writing another segment, the segment file is deleted.
+#
+# Writes go into the mmap, which is cheap; sync() then msyncs everything
+#   written since the last sync() in one go, so that a caller can write a
+#   lot of records and make them all durable with a single sync.
+
+import os
+import mmap
+import zlib
+import struct
+import pathlib
+import threading
+
+RECHDR = struct.Struct( '<II' )
+
+
+class Spool:
+    def __init__( self, directory, segment_size=67108864 ):
+        self.directory = pathlib.Path( directory )
+        self.directory.mkdir( parents=True, exist_ok=True )
+        self.segment_size = segment_size
+
+        self.lock = threading.Lock()
+        self.outstanding = {}
+        self.segno = None
+        self.mm = None
+        self.fd = None
+        self.writepos = 0
+        self.syncpos = 0
+
+        existing = sorted( int( f.stem ) for f in self.directory.glob( '*.seg' ) if f.stem.isdigit() )
+        self.replayable = existing
+        self.nextsegno = existing[-1] + 1 if len( existing ) > 0 else 0
+
+
+    def _segpath( self, segno ):
+        return self.directory / f"{segno:012d}.seg"
+
+
+    def replay( self ):
+        # Yield ( segno, data ) for every record found in the segments that
+        #   were in the spool directory when the spool was opened.  Each of
+        #   those records is outstanding until it is released.  Call this
+        #   (and finish iterating) before writing anything.
+        for segno in self.replayable:
+            path = self._segpath( segno )
+            n = 0
+            with open( path, 'rb' ) as ifp:
+                size = os.fstat( ifp.fileno() ).st_size
+                if size > 0:
+                    with mmap.mmap( ifp.fileno(), 0, access=mmap.ACCESS_READ ) as mm:
+                        pos = 0
+                        while pos + RECHDR.size <= size:
+                            lenplus1, crc = RECHDR.unpack_from( mm, pos )
+                            if ( lenplus1 == 0 ) or ( pos + RECHDR.size + lenplus1 - 1 > size ):
+                                break
+                            start = pos + RECHDR.size
+                            data = mm[ start : start + lenplus1 - 1 ]
+                            if zlib.crc32( data ) != crc:
+                                break
+                            with self.lock:
+                                self.outstanding[ segno ] = self.outstanding.get( segno, 0 ) + 1
+                            n += 1
+                            yield segno, data
+                            pos = start + lenplus1 - 1
+            if n == 0:
+                path.unlink()
+        self.replayable = []
+
+
+    def _roll( self, minsize ):
+        # Finish off the current segment and start a new one big enough to
+        #   hold at least minsize bytes.
+        self._close_segment()
+        segno = self.nextsegno
+        self.nextsegno += 1
+        size = max( self.segment_size, minsize + RECHDR.size )
+        fd = os.open( self._segpath( segno ), os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644 )
+        os.ftruncate( fd, size )
+        dirfd = os.open( self.directory, os.O_RDONLY )
+        try:
+            os.fsync( dirfd )
+        finally:
+            os.close( dirfd )
+        self.fd = fd
+        self.mm = mmap.mmap( fd, size )
+        self.segno = segno
+        self.writepos = 0
+        self.syncpos = 0
+        with self.lock:
+            self.outstanding.setdefault( segno, 0 )
+
+
+    def _close_segment( self ):
+        if self.mm is None:
+            return
+        self.sync()
+        self.mm.close()
+        os.close( self.fd )
+        self.mm = None
+        self.fd = None
+        with self.lock:
+            segno = self.segno
+            self.segno = None
+            if self.outstanding.get( segno ) == 0:
+                del self.outstanding[ segno ]
+                self._segpath( segno ).unlink()
+
+
+    def append( self, data ):
+        # Write one record; returns the number of the segment it went into,
+        #   which is what needs to be passed to release() later.  The
+        #   record isn't durable until the next sync().
+        reclen = RECHDR.size + len( data )
+        if ( self.mm is None ) or ( self.writepos + reclen > len( self.mm ) ):
+            self._roll( len( data ) )
+        pos = self.writepos
+        self.mm[ pos + RECHDR.size : pos + reclen ] = data
+        RECHDR.pack_into( self.mm, pos, len( data ) + 1, zlib.crc32( data ) )
+        self.writepos = pos + reclen
+        with self.lock:
+            self.outstanding[ self.segno ] += 1
+        return self.segno
+
+
+    def sync( self ):
+        # Make everything appended so far durable.  Returns False if there
+        #   wasn't anything to do.
+        if ( self.mm is None ) or ( self.syncpos == self.writepos ):
+            return False
+        start = self.syncpos - ( self.syncpos % mmap.PAGESIZE )
+        self.mm.flush( start, self.writepos - start )
+        self.syncpos = self.writepos
+        return True
+
+
+    def release( self, segno, n=1 ):
+        # n records in segment segno are no longer needed.  Safe to call
+        #   from a different thread than the one doing appends.  (Releasing
+        #   from a segment that's already gone does nothing.)
+        with self.lock:
+            if segno not in self.outstanding:
+                return
+            self.outstanding[ segno ] -= n
+            if ( self.outstanding[ segno ] <= 0 ) and ( segno != self.segno ):
+                del self.outstanding[ segno ]
+                self._segpath( segno ).unlink( missing_ok=True )
+
+
+    def close( self ):
+        self._close_segment()
@@ -0,0 +1,5 @@
+import sys
+import pathlib
+
+# The unit tests import the proxy's modules directly from the top of the checkout
+sys.path.insert( 0, str( pathlib.Path( __file__ ).resolve().parent.parent ) )
@@ -0,0 +1,190 @@
+import io
+import gzip
+import json
+import shutil
+import socket
+import asyncio
+import pathlib
+
+import fastavro
+
+import flusherproto
+import topicmap
+import asyncserver
+
+
+def _msgs_payload( msgs ):
+    return b''.join( len(m).to_bytes( 4, byteorder='little' ) + m for m in msgs )
+
+
+def _post( body, token=b'tok', extra=b'' ):
+    return ( b'POST /topics/t HTTP/1.1\r\nHost: test\r\nContent-Type: application/octet-stream\r\n'
+             b'x-kafka-proxy-token: ' + token + b'\r\n' + extra
+             + b'Content-Length: ' + str( len( body ) ).encode() + b'\r\n\r\n' + body )
+
+
+async def _read_response( reader ):
+    head = ( await reader.readuntil( b'\r\n\r\n' ) ).decode( 'latin-1' ).split( '\r\n' )
+    headers = { k.lower(): v.strip() for k, _, v in ( line.partition( ':' ) for line in head[1:] if line ) }
+    body = await reader.readexactly( int( headers['content-length'] ) )
+    return int( head[0].split()[1] ), headers, body.decode( 'utf-8' )
+
+
+async def _with_server( tmp_path, monkeypatch, client ):
+    # Run the server against a fake flusher that takes every MSGS frame,
+    #   and then run client( reader, writer ) on a connection to it
+    received = []
+
+    async def flusher( reader, writer ):
+        try:
+            while True:
+                verb, flags, paylen = flusherproto.unpack_header( await reader.readexactly( flusherproto.HEADER.size ) )
+                payload = await reader.readexactly( paylen )
+                _batchid, payload = flusherproto.unpack_batchid( payload, flags )
+                topic, payload = flusherproto.unpack_topic( payload, flags )
+                msgs = flusherproto.split_messages( payload )
+                received.append( ( topic, msgs ) )
+                writer.write( flusherproto.pack_frame( b'OK  ', flusherproto.MSGLEN.pack( len( msgs ) ) ) )
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+    monkeypatch.setenv( "KAFKA_PROXY_TOKEN", "tok" )
+    monkeypatch.setenv( "KAFKA_FLUSHER_SOCKET_PATH", str( tmp_path / "sock" ) )
+    monkeypatch.setenv( "KAFKA_FLUSHER_TOPIC_CACHE", str( tmp_path / "topics" ) )
+    monkeypatch.setenv( "KAFKA_PROXY_STREAM_THRESHOLD", "100" )
+    monkeypatch.setenv( "KAFKA_PROXY_STREAM_CHUNK_SIZE", "20" )
+    topicmap.TopicMap( default='t' ).write( tmp_path / "topics" )
+
+    flusherserver = await asyncio.start_unix_server( flusher, str( tmp_path / "sock" ) )
+    sock = socket.create_server( ( '127.0.0.1', 0 ) )
+    task = asyncio.create_task( asyncserver.serve( sock ) )
+    try:
+        reader, writer = await asyncio.open_connection( *sock.getsockname() )
+        await client( reader, writer )
+        writer.close()
+    finally:
+        task.cancel()
+        flusherserver.close()
+    return received
+
+
+def test_pipelining( tmp_path, monkeypatch ):
+    async def client( reader, writer ):
+        # Everything sent at once; the answers come back in order
+        big = _msgs_payload( [ b'x' * 30 ] * 5 )
+        writer.write( _post( _msgs_payload( [ b'a', b'b' ] ) )
+                      + _post( b'ignored', token=b'wrong' )
+                      + _post( big )
+                      + b'POST /topics/t HTTP/1.1\r\nContent-Type: application/octet-stream\r\n'
+                      + b'x-kafka-proxy-token: tok\r\nTransfer-Encoding: chunked\r\n\r\n'
+                      + b'3\r\n\x01\x00\x00\r\n2\r\n\x00c\r\n0\r\n\r\n'
+                      + b'GET /nowhere HTTP/1.1\r\n\r\n' )
+        status, headers, text = await _read_response( reader )
+        assert ( status, text ) == ( 200, "2 messages received" )
+        assert headers['connection'] == 'keep-alive'
+        assert headers['content-type'] == 'text/html; charset=utf-8'
+        status, _headers, text = await _read_response( reader )
+        assert ( status, text ) == ( 500, "Error, wrong x-kafka-proxy-token in HTTP headers" )
+        assert ( await _read_response( reader ) )[2] == "5 messages received"
+        assert ( await _read_response( reader ) )[2] == "1 messages received"
+        assert ( await _read_response( reader ) )[0] == 404
+
+        # The connection is still good after all that
+        writer.write( _post( _msgs_payload( [ b'd' ] ), extra=b'Connection: close\r\n' ) )
+        status, headers, _text = await _read_response( reader )
+        assert ( status, headers['connection'] ) == ( 200, 'close' )
+        assert await reader.read() == b''
+
+    received = asyncio.run( _with_server( tmp_path, monkeypatch, client ) )
+    assert [ m for _topic, msgs in received for m in msgs ] == [ b'a', b'b' ] + [ b'x' * 30 ] * 5 + [ b'c', b'd' ]
+    # The big POST was streamed, a chunk at a time
+    assert [ len( msgs ) for _topic, msgs in received ] == [ 2, 1, 1, 1, 1, 1, 1, 1 ]
+    assert all( topic == 't' for topic, _msgs in received )
+
+
+def test_bad_requests( tmp_path, monkeypatch ):
+    async def client( reader, writer ):
+        writer.write( _post( _msgs_payload( [ b'a' ] )[:-1] ) )
+        status, _headers, text = await _read_response( reader )
+        assert ( status, text.split( ' at ' )[0] ) == ( 500, "Error, mal-formed data" )
+
+        writer.write( b'POST / HTTP/1.1\r\nContent-Length: nope\r\n\r\n' )
+        status, headers, _text = await _read_response( reader )
+        assert ( status, headers['connection'] ) == ( 400, 'close' )
+        assert await reader.read() == b''
+
+    assert asyncio.run( _with_server( tmp_path, monkeypatch, client ) ) == []
+
+
+def test_rate_limit( tmp_path, monkeypatch ):
+    ( tmp_path / "tokens" ).write_text( json.dumps( { 'clients': { 'slow': { 'token': 'slow-token',
+                                                                             'messages_per_second': 2 } } } ) )
+    monkeypatch.setenv( "KAFKA_PROXY_TOKENS_FILE", str( tmp_path / "tokens" ) )
+    monkeypatch.setenv( "KAFKA_PROXY_RATE_LIMIT_PATH", str( tmp_path / "buckets" ) )
+
+    async def client( reader, writer ):
+        writer.write( _post( _msgs_payload( [ b'a', b'b', b'c' ] ), token=b'slow-token' )
+                      + _post( _msgs_payload( [ b'd' ] ), token=b'slow-token' )
+                      + _post( _msgs_payload( [ b'e' ] ) ) )
+        assert ( await _read_response( reader ) )[0] == 200
+        status, headers, text = await _read_response( reader )
+        assert ( status, headers['retry-after'] ) == ( 429, '1' )
+        assert text == "Error, client slow is over its rate limit, retry after 1 seconds"
+        # Other clients aren't held up
+        assert ( await _read_response( reader ) )[0] == 200
+
+    received = asyncio.run( _with_server( tmp_path, monkeypatch, client ) )
+    assert [ msgs for _topic, msgs in received ] == [ [ b'a', b'b', b'c' ], [ b'e' ] ]
+
+
+def test_compressed( tmp_path, monkeypatch ):
+    monkeypatch.setenv( "KAFKA_PROXY_MAX_DECOMPRESSED_SIZE", "1000" )
+
+    async def client( reader, writer ):
+        body = gzip.compress( _msgs_payload( [ b'a', b'b', b'c' ] ) )
+        writer.write( _post( body, extra=b'Content-Encoding: gzip\r\n' ) )
+        assert ( await _read_response( reader ) )[2] == "3 messages received"
+
+        # The body is decompressed as it comes in, so a body that
+        #   decompresses to too much is turned away before it's all sent
+        bomb = gzip.compress( _msgs_payload( [ b'x' * 100 ] * 100 ) )
+        writer.write( b'POST /topics/t HTTP/1.1\r\nContent-Type: application/octet-stream\r\n'
+                      b'x-kafka-proxy-token: tok\r\nContent-Encoding: gzip\r\nTransfer-Encoding: chunked\r\n\r\n'
+                      + f"{len(bomb):x}\r\n".encode() + bomb + b'\r\n' )
+        status, headers, _text = await asyncio.wait_for( _read_response( reader ), 5 )
+        assert ( status, headers['connection'] ) == ( 413, 'close' )
+        assert int( headers['x-kafka-proxy-messages-accepted'] ) < 10
+
+    received = asyncio.run( _with_server( tmp_path, monkeypatch, client ) )
+    assert received[0] == ( 't', [ b'a', b'b', b'c' ] )
+
+
+def test_avro( tmp_path, monkeypatch ):
+    ( tmp_path / "schemas" ).mkdir()
+    shutil.copy( pathlib.Path( __file__ ).parent / "testschema.avsc", tmp_path / "schemas" / "testschema.avsc" )
+    monkeypatch.setenv( "KAFKA_PROXY_SCHEMA_DIR", str( tmp_path / "schemas" ) )
+    records = [ { 'string': f'record {i}', 'int': i } for i in range( 5 ) ]
+
+    def post( path, body, content_type=b'application/json' ):
+        return ( b'POST ' + path + b' HTTP/1.1\r\nContent-Type: ' + content_type + b'\r\n'
+                 b'x-kafka-proxy-token: tok\r\nx-kafka-proxy-batch-id: b\r\n'
+                 b'Content-Length: ' + str( len( body ) ).encode() + b'\r\n\r\n' + body )
+
+    async def client( reader, writer ):
+        writer.write( post( b'/topics/t/avro/testschema', json.dumps( records ).encode() )
+                      + post( b'/avro/testschema', b'{"int": 5}\n', b'application/x-ndjson' )
+                      + post( b'/avro/testschema', b'[ {"int": "six"} ]' )
+                      + post( b'/avro/nosuchschema', b'{}' )
+                      + post( b'/avro/testschema', b'{}', b'application/octet-stream' ) )
+        # Encoded in 20-byte chunks, each its own batch
+        assert ( await _read_response( reader ) )[:3:2] == ( 200, "5 messages received" )
+        assert ( await _read_response( reader ) )[:3:2] == ( 200, "1 messages received" )
+        assert ( await _read_response( reader ) )[0] == 400
+        assert ( await _read_response( reader ) )[0] == 404
+        assert ( await _read_response( reader ) )[0] == 500
+
+    received = asyncio.run( _with_server( tmp_path, monkeypatch, client ) )
+    parsed = fastavro.parse_schema( json.loads( ( tmp_path / "schemas" / "testschema.avsc" ).read_text() ) )
+    msgs = [ fastavro.schemaless_reader( io.BytesIO( m ), parsed ) for _topic, msgs in received for m in msgs ]
+    assert msgs == records + [ { 'string': None, 'int': 5 } ]
+    assert len( received ) > 2
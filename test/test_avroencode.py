@@ -0,0 +1,82 @@
+import io
+import os
+import json
+import shutil
+import pathlib
+
+import pytest
+import fastavro
+
+import flusherproto
+import avroencode
+
+
+@pytest.fixture
+def schemadir( tmp_path ):
+    shutil.copy( pathlib.Path( __file__ ).parent / "testschema.avsc", tmp_path / "testschema.avsc" )
+    return tmp_path
+
+
+def test_schema_cache( schemadir ):
+    cache = avroencode.SchemaCache( schemadir, checkevery=0 )
+    parsed, schema_id = cache.get( 'testschema' )
+    assert parsed['name'] == 'test.Test'
+    assert schema_id is None
+    # Parsed once, and kept while the files don't change
+    assert cache.get( 'testschema' )[0] is parsed
+
+    ( schemadir / "testschema.id" ).write_text( "42\n" )
+    assert cache.get( 'testschema' )[1] == 42
+
+    for name in ( 'nope', '../testschema', '.hidden', '' ):
+        with pytest.raises( avroencode.UnknownSchema ):
+            cache.get( name )
+    ( schemadir / "broken.avsc" ).write_text( "{ not json" )
+    with pytest.raises( avroencode.UnknownSchema ):
+        cache.get( 'broken' )
+
+    os.unlink( schemadir / "testschema.avsc" )
+    with pytest.raises( avroencode.UnknownSchema ):
+        cache.get( 'testschema' )
+
+
+def test_parse_records():
+    records = [ { 'string': 'a', 'int': 1 }, { 'string': None, 'int': None } ]
+    assert avroencode.parse_records( json.dumps( records ).encode(), avroencode.JSON_CONTENT_TYPE ) == records
+    assert avroencode.parse_records( json.dumps( records[0] ).encode(), avroencode.JSON_CONTENT_TYPE ) == records[:1]
+    ndjson = ( "\n".join( json.dumps( r ) for r in records ) + "\n\n" ).encode()
+    assert avroencode.parse_records( ndjson, avroencode.NDJSON_CONTENT_TYPE ) == records
+    with pytest.raises( avroencode.BadRecords ):
+        avroencode.parse_records( b'[ {', avroencode.JSON_CONTENT_TYPE )
+    with pytest.raises( avroencode.BadRecords ):
+        avroencode.parse_records( b'{}\n{\n', avroencode.NDJSON_CONTENT_TYPE )
+
+
+def test_encode_records( schemadir ):
+    parsed, _schema_id = avroencode.SchemaCache( schemadir ).get( 'testschema' )
+    records = [ { 'string': f'record {i}', 'int': i } for i in range( 100 ) ]
+
+    chunks = list( avroencode.encode_records( records, parsed, chunk_size=200 ) )
+    assert len( chunks ) > 1
+    assert sum( nmsgs for _chunk, nmsgs in chunks ) == 100
+    msgs = []
+    for chunk, nmsgs in chunks:
+        assert len( flusherproto.index_messages( chunk ) ) == nmsgs
+        msgs += flusherproto.split_messages( chunk )
+    assert [ fastavro.schemaless_reader( io.BytesIO( m ), parsed ) for m in msgs ] == records
+
+    # The Confluent wire format: magic byte and big-endian schema ID first
+    ( chunk, nmsgs ), = avroencode.encode_records( records[:1], parsed, schema_id=42 )
+    msg = flusherproto.split_messages( chunk )[0]
+    assert msg[:5] == b'\x00\x00\x00\x00\x2a'
+    assert fastavro.schemaless_reader( io.BytesIO( msg[5:] ), parsed ) == records[0]
+
+    # Missing fields get their defaults
+    ( chunk, nmsgs ), = avroencode.encode_records( [ { 'int': 3 } ], parsed )
+    assert ( fastavro.schemaless_reader( io.BytesIO( flusherproto.split_messages( chunk )[0] ), parsed )
+             == { 'string': None, 'int': 3 } )
+
+    with pytest.raises( avroencode.BadRecords, match="Record 1 " ):
+        list( avroencode.encode_records( [ records[0], { 'int': 'three' } ], parsed ) )
+    with pytest.raises( avroencode.BadRecords ):
+        list( avroencode.encode_records( [ { 'string': 'x' * 100 } ], parsed, max_message_size=50 ) )
@@ -0,0 +1,50 @@
+import time
+
+import batchids
+
+
+def test_lookup_and_expire():
+    cache = batchids.BatchIdCache( maxsize=3, ttl=0.5 )
+    assert cache.lookup( 'a' ) is None
+    cache.add( 'a', 5, ack='tracker' )
+    cache.add( 'b', 6 )
+    cache.add( 'c', 7 )
+    assert cache.lookup( 'a' ) == ( 5, 'tracker' )
+
+    # 'b' is now the least recently seen, so it goes first
+    cache.add( 'd', 8 )
+    assert len( cache ) == 3
+    assert cache.lookup( 'b' ) is None
+    assert cache.lookup( 'a' ) == ( 5, 'tracker' )
+
+    time.sleep( 0.6 )
+    assert cache.lookup( 'a' ) is None
+    cache.add( 'e', 1 )
+    assert len( cache ) == 1
+
+
+def test_persist( tmp_path ):
+    path = tmp_path / "batchids"
+    cache = batchids.BatchIdCache( ttl=60, path=path )
+    cache.add( 'one', 1, ack='not saved' )
+    cache.add( 'two', 2 )
+    cache.sync()
+    # A record torn by a crash is ignored
+    cache.fp.write( batchids.RECORD.pack( time.time() + 60, 3, 5 ) + b'th' )
+    cache.fp.flush()
+
+    cache = batchids.BatchIdCache( ttl=60, path=path )
+    assert cache.lookup( 'one' ) == ( 1, None )
+    assert cache.lookup( 'two' ) == ( 2, None )
+    assert len( cache ) == 2
+
+    # Lots of writes of the same few batch IDs get compacted
+    for i in range( 5000 ):
+        cache.add( f"id{i % 10}", i )
+        cache.sync()
+    cache.close()
+    assert path.stat().st_size < 2100 * ( batchids.RECORD.size + 5 )
+    cache = batchids.BatchIdCache( ttl=60, path=path )
+    assert len( cache ) == 12
+    assert cache.lookup( 'id3' ) == ( 4993, None )
+    cache.close()
@@ -0,0 +1,58 @@
+import time
+import argparse
+
+import fakekafka
+import flusherproto
+import benchmark
+
+
+def test_fake_producer():
+    fakekafka.reset()
+    fakekafka.configure( latency=0.2, failure_rate=0., timestamped=True )
+    producer = fakekafka.Producer( {} )
+    reports = []
+    sent = time.time()
+    for i in range( 3 ):
+        producer.produce( 't', fakekafka.SENT.pack( sent ) + b'msg',
+                          on_delivery=lambda err, msg: reports.append( ( err, msg.value() ) ) )
+    assert producer.poll( 0 ) == 0
+    assert len( producer ) == 3
+    assert producer.flush( 5 ) == 0
+    assert len( reports ) == 3
+    assert all( err is None for err, _value in reports )
+    results = fakekafka.results()
+    assert results['delivered'] == 3
+    assert min( results['latencies'] ) >= 0.2
+
+    fakekafka.configure( latency=0., failure_rate=1. )
+    producer.produce( 't', b'doomed', on_delivery=lambda err, msg: reports.append( ( err, msg.value() ) ) )
+    producer.poll( 0 )
+    assert str( reports[-1][0] ) == "Fake delivery failure"
+    assert fakekafka.results()['failed'] == 1
+    fakekafka.configure( failure_rate=0., timestamped=False )
+
+
+def test_payloads():
+    args = argparse.Namespace( records=True, message_size=( 20, 40 ), messages_per_post=( 1, 10 ) )
+    payloads = benchmark._Payloads( args, seed=1, nbodies=4 )
+    for _ in range( 4 ):
+        before = time.time()
+        body, nmsgs = payloads.stamp()
+        index = flusherproto.index_messages( body )
+        assert len( index ) == nmsgs
+        flusherproto.check_records( body, index )
+        for offset, size in index:
+            value, key, _headers, _timestamp = flusherproto.unpack_record( body[ offset : offset+size ] )
+            assert 20 <= len( value ) <= 40
+            assert key.startswith( b'key-' )
+            assert fakekafka.SENT.unpack_from( value )[0] >= before
+
+
+def test_compare():
+    old = { 'commit': 'aaa', 'messages_per_second': 1000., 'post_latency_ms': { 'p50': 2., 'p99': 10. } }
+    new = { 'commit': 'bbb', 'messages_per_second': 1500., 'post_latency_ms': { 'p50': 4., 'p99': 10. } }
+    lines = benchmark.compare( old, new ).splitlines()
+    assert 'aaa' in lines[0] and 'bbb' in lines[0]
+    assert [ line for line in lines if line.startswith( 'messages_per_second' ) ][0].endswith( '+50.0%  better' )
+    assert [ line for line in lines if line.startswith( 'post_latency_ms.p50' ) ][0].endswith( '+100.0%  WORSE' )
+    assert [ line for line in lines if line.startswith( 'post_latency_ms.p99' ) ][0].endswith( '+0.0%' )
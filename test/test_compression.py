@@ -0,0 +1,103 @@
+import io
+import gzip
+import zlib
+
+import pytest
+
+import compression
+
+
+def _readall( reader, n=1000 ):
+    chunks = []
+    while True:
+        data = reader.read( n )
+        if len( data ) == 0:
+            return b''.join( chunks )
+        assert len( data ) <= n
+        chunks.append( data )
+
+
+def test_gzip():
+    body = b''.join( f"message {i}\n".encode() for i in range( 10000 ) )
+    reader = compression.DecompressingReader( io.BytesIO( gzip.compress( body ) ), 'gzip', 10 * len( body ) )
+    assert _readall( reader ) == body
+
+    # Concatenated gzip members are one body
+    reader = compression.DecompressingReader( io.BytesIO( gzip.compress( body ) + gzip.compress( body ) ),
+                                              'gzip', 10 * len( body ) )
+    assert _readall( reader ) == body + body
+
+    reader = compression.DecompressingReader( io.BytesIO( zlib.compress( body ) ), 'deflate', len( body ) )
+    assert _readall( reader ) == body
+
+
+def test_bomb():
+    bomb = gzip.compress( bytes( 100 * 1024 * 1024 ) )
+    assert len( bomb ) < 1024 * 1024
+    reader = compression.DecompressingReader( io.BytesIO( bomb ), 'gzip', 1024 * 1024 )
+    with pytest.raises( compression.BodyTooLarge ):
+        _readall( reader, 65536 )
+    # It should have given up right after the limit, not decompressed everything
+    assert reader.nbytes < 2 * 1024 * 1024
+
+
+def test_truncated_and_unsupported():
+    data = gzip.compress( b'x' * 100000 )
+    reader = compression.DecompressingReader( io.BytesIO( data[:len(data)//2] ), 'gzip', 1000000 )
+    with pytest.raises( compression.CompressionError ):
+        _readall( reader )
+
+    with pytest.raises( compression.UnsupportedEncoding ):
+        compression.DecompressingReader( io.BytesIO( data ), 'br', 1000000 )
+
+
+@pytest.mark.parametrize( 'encoding', [ 'zstd', 'lz4' ] )
+def test_optional_encodings( encoding ):
+    body = b''.join( f"message {i}\n".encode() for i in range( 10000 ) )
+    if encoding == 'zstd':
+        zstandard = pytest.importorskip( 'zstandard' )
+        data = zstandard.ZstdCompressor().compress( body )
+    else:
+        lz4frame = pytest.importorskip( 'lz4.frame' )
+        data = lz4frame.compress( body )
+    reader = compression.DecompressingReader( io.BytesIO( data ), encoding, len( body ) )
+    assert _readall( reader ) == body
+    reader = compression.DecompressingReader( io.BytesIO( data ), encoding, len( body ) - 1 )
+    with pytest.raises( compression.BodyTooLarge ):
+        _readall( reader )
+
+
+@pytest.mark.parametrize( 'encoding', [ 'gzip', 'zstd', 'lz4' ] )
+def test_decompressor( encoding ):
+    body = b''.join( f"message {i}\n".encode() for i in range( 10000 ) )
+    if encoding == 'zstd':
+        zstandard = pytest.importorskip( 'zstandard' )
+        compress = zstandard.ZstdCompressor().compress
+    elif encoding == 'lz4':
+        compress = pytest.importorskip( 'lz4.frame' ).compress
+    else:
+        compress = gzip.compress
+    data = compress( body ) + compress( body )
+
+    # Fed the compressed body a bit at a time, it gives back the
+    #   decompressed body a bounded bit at a time
+    decompressor = compression.Decompressor( encoding, 2 * len( body ), outsize=1000 )
+    pieces = []
+    for i in range( 0, len( data ), 777 ):
+        pieces.extend( decompressor.feed( data[ i : i+777 ] ) )
+    decompressor.end()
+    assert b''.join( pieces ) == body + body
+    assert max( len( p ) for p in pieces ) <= 1000
+
+    decompressor = compression.Decompressor( encoding, 2 * len( body ) )
+    list( decompressor.feed( data[:len(data)//4] ) )
+    with pytest.raises( compression.CompressionError ):
+        decompressor.end()
+
+    # A bomb is stopped soon after the limit, even if it arrives all at once
+    bomb = compress( bytes( 100 * 1024 * 1024 ) )
+    decompressor = compression.Decompressor( encoding, 1024 * 1024 )
+    with pytest.raises( compression.BodyTooLarge ):
+        for _ in decompressor.feed( bomb ):
+            pass
+    assert decompressor.nbytes < 2 * 1024 * 1024
@@ -0,0 +1,351 @@
+import time
+import random
+import socket
+import threading
+
+import fakekafka
+import flusherproto
+import flusher
+
+
+def _msgs_payload( msgs ):
+    return b''.join( flusherproto.MSGLEN.pack( len(m) ) + m for m in msgs )
+
+
+def _start_flusher( tmp_path, monkeypatch, **kwargs ):
+    # Run a Flusher (sending to fakekafka, configured by the caller) in a
+    #   background thread; returns it once it's listening
+    monkeypatch.setattr( flusher, 'confluent_kafka', fakekafka )
+    fakekafka.reset()
+    kwargs.setdefault( 'topic', 't' )
+    kwargs.setdefault( 'sockpath', str( tmp_path / "sock" ) )
+    kwargs.setdefault( 'topiccache', str( tmp_path / "topic" ) )
+    kwargs.setdefault( 'spooldir', None )
+    fl = flusher.Flusher( ringpath=str( tmp_path / "ring" ), **kwargs )
+    threading.Thread( target=fl, daemon=True ).start()
+    deadline = time.monotonic() + 5
+    while fl.flushthread is None:
+        assert time.monotonic() < deadline
+        time.sleep( 0.01 )
+    return fl
+
+
+def _connect( fl ):
+    sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    sock.connect( str( fl.sockpath ) )
+    return sock
+
+
+def _wait_for( cond, timeout=5 ):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline
+        time.sleep( 0.005 )
+
+
+def test_batches_in_flight( tmp_path, monkeypatch ):
+    fakekafka.configure( latency=0.3, failure_rate=0. )
+    fl = _start_flusher( tmp_path, monkeypatch, maxmsgs=10 )
+    sock = _connect( fl )
+
+    # Five batches, each sealed as soon as it's received, all go to kafka
+    #   without waiting for the ones before them to be delivered
+    t0 = time.monotonic()
+    for i in range( 5 ):
+        flusherproto.send_frame( sock, b'MSGS', _msgs_payload( [ f"{i}.{j}".encode() for j in range( 10 ) ] ) )
+        assert flusherproto.recv_frame( sock )[0] == b'OK  '
+    mostinflight = 0
+    while fl.stats()['delivered'] < 50:
+        assert time.monotonic() - t0 < 1.2
+        mostinflight = max( mostinflight, fl.stats()['batches_in_flight'] )
+        time.sleep( 0.005 )
+    assert mostinflight > 1
+    assert fl.stats()['batches_sent'] == 5
+    _wait_for( lambda: fl.stats()['batches_in_flight'] == 0 )
+    sock.close()
+
+
+def test_retry_failed_only( tmp_path, monkeypatch ):
+    random.seed( 42 )
+    fakekafka.configure( latency=0.05, failure_rate=0.3 )
+    fl = _start_flusher( tmp_path, monkeypatch, maxmsgs=20, retry_backoff=0.01, max_retries=20 )
+    sock = _connect( fl )
+    flusherproto.send_frame( sock, b'MSGS', _msgs_payload( [ f"{j}".encode() for j in range( 20 ) ] ) )
+    assert flusherproto.recv_frame( sock )[0] == b'OK  '
+    _wait_for( lambda: fl.stats()['delivered'] == 20 )
+
+    # Every message made it exactly once; only the ones that failed were
+    #   produced again
+    results = fakekafka.results()
+    assert results['failed'] > 0
+    assert results['delivered'] == 20
+    assert results['produced'] == 20 + results['failed']
+    assert fl.stats()['batch_retries'] > 0
+    assert fl.stats()['dropped'] == 0
+    fakekafka.configure( failure_rate=0. )
+    sock.close()
+
+
+def test_produce_exception( tmp_path, monkeypatch ):
+    nproduced = [ 0 ]
+
+    class FlakyProducer( fakekafka.Producer ):
+        def produce( self, *args, **kwargs ):
+            nproduced[0] += 1
+            if nproduced[0] == 3:
+                raise fakekafka.KafkaException( "Fake produce failure" )
+            super().produce( *args, **kwargs )
+
+    monkeypatch.setattr( fakekafka, 'Producer', FlakyProducer )
+    fakekafka.configure( latency=0.05, failure_rate=0. )
+    fl = _start_flusher( tmp_path, monkeypatch, maxmsgs=5, retry_backoff=0.01 )
+    sock = _connect( fl )
+    flusherproto.send_frame( sock, b'MSGS', _msgs_payload( [ f"{j}".encode() for j in range( 5 ) ] ) )
+    assert flusherproto.recv_frame( sock )[0] == b'OK  '
+    _wait_for( lambda: fl.stats()['batches_in_flight'] + fl.stats()['batches_waiting'] == 0 )
+    time.sleep( 0.2 )
+
+    # The two messages produced before the exception weren't produced again
+    results = fakekafka.results()
+    assert results['produced'] == 5
+    assert results['delivered'] == 5
+    assert fl.stats()['received'] == 5
+    assert fl.stats()['delivered'] == 5
+    assert fl.stats()['batch_retries'] == 1
+    sock.close()
+
+
+def test_spool_release_after_produce_exception( tmp_path, monkeypatch ):
+    nproduced = [ 0 ]
+
+    class FlakyProducer( fakekafka.Producer ):
+        def produce( self, *args, **kwargs ):
+            nproduced[0] += 1
+            if nproduced[0] == 3:
+                raise fakekafka.KafkaException( "Fake produce failure" )
+            super().produce( *args, **kwargs )
+
+    monkeypatch.setattr( fakekafka, 'Producer', FlakyProducer )
+    fakekafka.configure( latency=0.2, failure_rate=0. )
+    spooldir = tmp_path / "spool"
+    fl = _start_flusher( tmp_path, monkeypatch, maxmsgs=40, retry_backoff=0.01, spooldir=str( spooldir ),
+                         spool_segment_size=4096 )
+    sock = _connect( fl )
+
+    # A batch that spans two spool segments fails part way through
+    #   producing; until it's all delivered, every segment it's in stays
+    flusherproto.send_frame( sock, b'MSGS', _msgs_payload( [ b'%03d' % j * 34 for j in range( 40 ) ] ) )
+    assert flusherproto.recv_frame( sock )[0] == b'OK  '
+    segs = sorted( spooldir.glob( '*.seg' ) )
+    assert len( segs ) == 2
+    time.sleep( 0.1 )
+    assert all( seg.exists() for seg in segs )
+    _wait_for( lambda: fl.stats()['delivered'] == 40 )
+    assert fl.stats()['batch_retries'] == 1
+
+    # Once the spool has moved on to another segment, the old ones go, and
+    #   every message was released exactly once
+    _delivered_after( fl, sock, [ b'x' * 100 ] * 40, 80 )
+    _wait_for( lambda: not segs[0].exists() and not segs[1].exists() )
+    assert all( n >= 0 for n in fl.spool.outstanding.values() )
+    assert fl.stats()['delivered'] == fl.stats()['received'] == 80
+    assert fakekafka.results()['produced'] == 80
+    sock.close()
+
+
+def _delivered_after( fl, sock, msgs, n ):
+    # Send msgs in one frame; returns how long it took for n messages in
+    #   all to be delivered
+    t0 = time.monotonic()
+    flusherproto.send_frame( sock, b'MSGS', _msgs_payload( msgs ) )
+    assert flusherproto.recv_frame( sock )[0] == b'OK  '
+    _wait_for( lambda: fl.stats()['delivered'] >= n )
+    return time.monotonic() - t0
+
+
+def test_byte_size_trigger( tmp_path, monkeypatch ):
+    fakekafka.configure( latency=0., failure_rate=0. )
+    fl = _start_flusher( tmp_path, monkeypatch, maxmsgs=1000, maxbytes=100, timeout=5 )
+    sock = _connect( fl )
+
+    # Under maxbytes, the messages wait for more
+    flusherproto.send_frame( sock, b'MSGS', _msgs_payload( [ b'x' * 30 ] * 2 ) )
+    assert flusherproto.recv_frame( sock )[0] == b'OK  '
+    time.sleep( 0.3 )
+    assert fl.stats()['buffered'] == 2
+    assert fl.stats()['delivered'] == 0
+
+    # Going over it seals the batch right away
+    assert _delivered_after( fl, sock, [ b'x' * 30 ] * 2, 4 ) < 0.5
+    assert fl.stats()['batches_sent'] == 1
+    sock.close()
+
+
+def test_deadline_trigger( tmp_path, monkeypatch ):
+    fakekafka.configure( latency=0., failure_rate=0. )
+    fl = _start_flusher( tmp_path, monkeypatch, maxmsgs=1000, timeout=0.5 )
+    sock = _connect( fl )
+
+    # A lone message is sealed when its timeout is up, not up to another
+    #   timeout later
+    for n in range( 1, 4 ):
+        assert 0.45 < _delivered_after( fl, sock, [ b'lonely' ], n ) < 0.75
+    assert fl.stats()['batches_sent'] == 3
+    sock.close()
+
+
+def test_adaptive_trigger( tmp_path, monkeypatch ):
+    fakekafka.configure( latency=0., failure_rate=0. )
+    fl = _start_flusher( tmp_path, monkeypatch, adaptive=True, latency_target=0.3, timeout=5 )
+    sock = _connect( fl )
+
+    # Waiting wouldn't get a sparse message any company, so it goes at once
+    assert _delivered_after( fl, sock, [ b'first' ], 1 ) < 0.2
+
+    # Messages arriving close together are held for (at most) the latency
+    #   target, so they share a few batches instead of one each
+    t0 = time.monotonic()
+    for i in range( 50 ):
+        flusherproto.send_frame( sock, b'MSGS', _msgs_payload( [ f"{i}".encode() ] ) )
+        assert flusherproto.recv_frame( sock )[0] == b'OK  '
+        time.sleep( 0.005 )
+    _wait_for( lambda: fl.stats()['delivered'] == 51 )
+    assert time.monotonic() - t0 < 50 * 0.005 + 0.3 + 0.5
+    assert fl.stats()['batches_sent'] <= 10
+    sock.close()
+
+
+def test_long_lived_producer( tmp_path, monkeypatch ):
+    producers = []
+
+    class CountingProducer( fakekafka.Producer ):
+        def __init__( self, config ):
+            super().__init__( config )
+            producers.append( self )
+
+    monkeypatch.setattr( fakekafka, 'Producer', CountingProducer )
+    fakekafka.configure( latency=0., failure_rate=0. )
+    fl = _start_flusher( tmp_path, monkeypatch, maxmsgs=5, lingerms=20 )
+    sock = _connect( fl )
+
+    # Every flush goes through the same producer
+    for i in range( 1, 4 ):
+        _delivered_after( fl, sock, [ b'm' ] * 5, 5 * i )
+    assert fl.stats()['batches_sent'] == 3
+    assert len( producers ) == 1
+    assert producers[0].config['linger.ms'] == 20
+    assert producers[0].config['error_cb'] == fl._producer_error
+
+    # Until it has a fatal error; then there's a new one
+    fl._producer_error( fakekafka.KafkaError( "Fake fatal error", fatal=True ) )
+    _delivered_after( fl, sock, [ b'm' ] * 5, 20 )
+    assert len( producers ) == 2
+    assert fl.producer is producers[1]
+    sock.close()
+
+
+def test_max_frame_size( tmp_path, monkeypatch ):
+    fakekafka.configure( latency=0., failure_rate=0. )
+    fl = _start_flusher( tmp_path, monkeypatch, maxmsgs=1, max_frame_size=1000 )
+
+    # A client stuck part way through a frame doesn't hold up anybody else
+    stuck = _connect( fl )
+    frame = flusherproto.pack_frame( b'MSGS', _msgs_payload( [ b'slow' ] ) )
+    stuck.sendall( frame[:20] )
+    sock = _connect( fl )
+    _delivered_after( fl, sock, [ b'fast' ], 1 )
+    stuck.sendall( frame[20:] )
+    assert flusherproto.recv_frame( stuck )[0] == b'OK  '
+    _wait_for( lambda: fl.stats()['delivered'] == 2 )
+
+    # A frame bigger than max_frame_size gets its connection closed as
+    #   soon as the header is in, without waiting for the payload
+    big = _connect( fl )
+    big.settimeout( 2 )
+    big.sendall( flusherproto.pack_header( b'MSGS', 2000 ) )
+    assert big.recv( 100 ) == b''
+    big.close()
+
+    # Others carry on
+    _delivered_after( fl, sock, [ b'after' ], 3 )
+    stuck.close()
+    sock.close()
+
+
+def test_double_buffering_and_budget( tmp_path, monkeypatch ):
+    fakekafka.configure( latency=0.5, failure_rate=0. )
+    fl = _start_flusher( tmp_path, monkeypatch, maxmsgs=10, timeout=1, max_buffered_bytes=200 )
+    sock = _connect( fl )
+
+    # While a sealed batch is on its way to kafka, new messages go into
+    #   the next one
+    flusherproto.send_frame( sock, b'MSGS', _msgs_payload( [ b'12345678' ] * 10 ) )
+    assert flusherproto.recv_frame( sock )[0] == b'OK  '
+    flusherproto.send_frame( sock, b'MSGS', _msgs_payload( [ b'12345678' ] ) )
+    assert flusherproto.recv_frame( sock )[0] == b'OK  '
+    stats = fl.stats()
+    assert stats['batches_in_flight'] + stats['batches_waiting'] == 1
+    assert stats['buffered'] == 1
+    assert stats['delivered'] == 0
+
+    # More than the memory budget has room for gets BUSY, with how long to
+    #   wait before trying again
+    flusherproto.send_frame( sock, b'MSGS', _msgs_payload( [ b'12345678' ] * 10 ) )
+    verb, _flags, payload = flusherproto.recv_frame( sock )
+    assert verb == b'BUSY'
+    assert flusherproto.MSGLEN.unpack( payload )[0] == 1
+    assert fl.stats()['busy_rejections'] == 1
+
+    # Until kafka has taken the first batch
+    _wait_for( lambda: fl.stats()['delivered'] == 10 )
+    _delivered_after( fl, sock, [ b'12345678' ] * 10, 21 )
+    sock.close()
+
+
+def test_shared_topic_cache( tmp_path, monkeypatch ):
+    topics = []
+
+    class RecordingProducer( fakekafka.Producer ):
+        def produce( self, topic, *args, **kwargs ):
+            topics.append( topic )
+            super().produce( topic, *args, **kwargs )
+
+    monkeypatch.setattr( fakekafka, 'Producer', RecordingProducer )
+    fakekafka.configure( latency=0., failure_rate=0. )
+    shards = [ _start_flusher( tmp_path, monkeypatch, sockpath=str( tmp_path / f"sock.{i}" ), maxmsgs=1,
+                               timeout=0.1 )
+               for i in range( 2 ) ]
+    socks = [ _connect( fl ) for fl in shards ]
+
+    # A topic change sent to one shard is saved in the topic cache, and
+    #   the other shard follows it
+    flusherproto.send_frame( socks[0], b'TPIC', b'newtopic' )
+    assert flusherproto.recv_frame( socks[0] )[0] == b'OK  '
+    flusherproto.send_frame( socks[0], b'ALOW', b'other' )
+    assert flusherproto.recv_frame( socks[0] )[0] == b'OK  '
+    _wait_for( lambda: shards[1].topicmap.default == 'newtopic' )
+    assert shards[1].topicmap.allowed( 'other' )
+    _delivered_after( shards[1], socks[1], [ b'm' ], 1 )
+    assert topics == [ 'newtopic' ]
+
+    # So does a flusher started later, without being told a topic
+    later = _start_flusher( tmp_path, monkeypatch, sockpath=str( tmp_path / "sock.2" ), topic=None )
+    assert later.topicmap.default == 'newtopic'
+    assert later.topicmap.allowed( 'other' )
+    for sock in socks:
+        sock.close()
+
+
+def test_no_topic_cache( tmp_path, monkeypatch ):
+    # Without a directory for the topic cache, the flusher still runs; it
+    #   just doesn't remember topic changes
+    fakekafka.configure( latency=0., failure_rate=0. )
+    fl = _start_flusher( tmp_path, monkeypatch, topiccache=str( tmp_path / "nowhere" / "topic" ), maxmsgs=1 )
+    sock = _connect( fl )
+    _delivered_after( fl, sock, [ b'm' ], 1 )
+    flusherproto.send_frame( sock, b'TPIC', b'newtopic' )
+    assert flusherproto.recv_frame( sock )[0] == b'OK  '
+    assert fl.topicmap.default == 'newtopic'
+    _delivered_after( fl, sock, [ b'm' ], 2 )
+    assert not ( tmp_path / "nowhere" ).exists()
+    sock.close()
@@ -0,0 +1,193 @@
+import io
+import socket
+import threading
+
+import pytest
+
+import flusherproto
+
+
+def _msgs_payload( msgs ):
+    return b''.join( len(m).to_bytes( 4, byteorder='little' ) + m for m in msgs )
+
+
+def test_split_messages():
+    msgs = [ b'This is a test', b'', b'This is not a test' ]
+    assert flusherproto.split_messages( _msgs_payload( msgs ) ) == msgs
+    assert flusherproto.split_messages( b'' ) == []
+
+    # Length prefix runs past the end
+    with pytest.raises( flusherproto.ProtocolError ):
+        flusherproto.split_messages( _msgs_payload( msgs )[:-1] )
+    # Truncated length prefix
+    with pytest.raises( flusherproto.ProtocolError ):
+        flusherproto.split_messages( _msgs_payload( msgs ) + b'\x01\x00' )
+    # Message too big
+    with pytest.raises( flusherproto.ProtocolError ):
+        flusherproto.split_messages( _msgs_payload( msgs ), max_message_size=16 )
+
+
+def test_frame_roundtrip():
+    payload = _msgs_payload( [ b'x' * 1000 ] * 1000 )
+    frame = flusherproto.pack_frame( b'MSGS', payload, flags=3 )
+    assert frame[0:4] == flusherproto.FRAME_MAGIC
+    assert len( frame ) == flusherproto.HEADER.size + len( payload )
+
+    a, b = socket.socketpair()
+    try:
+        # Dribble the frame out in small pieces so the reader has to reassemble it
+        def writer():
+            for i in range( 0, len(frame), 777 ):
+                a.sendall( frame[i:i+777] )
+        thread = threading.Thread( target=writer )
+        thread.start()
+        verb, flags, got = flusherproto.recv_frame( b )
+        thread.join()
+        assert verb == b'MSGS'
+        assert flags == 3
+        assert got == payload
+
+        # Header claims more than the reader will accept
+        a.sendall( flusherproto.pack_header( b'MSGS', 2048 ) )
+        with pytest.raises( flusherproto.ProtocolError ):
+            flusherproto.recv_frame( b, max_payload=1024 )
+    finally:
+        a.close()
+        b.close()
+
+
+def test_bad_magic():
+    with pytest.raises( flusherproto.ProtocolError ):
+        flusherproto.unpack_header( b'MESG' + bytes( 12 ) )
+
+
+def test_index_messages():
+    msgs = [ b'This is a test', b'', b'This is not a test' ]
+    payload = memoryview( _msgs_payload( msgs ) )
+    index = flusherproto.index_messages( payload )
+    assert [ bytes( payload[ o:o+n ] ) for o, n in index ] == msgs
+
+
+def test_topic_prefix():
+    msgs = _msgs_payload( [ b'one', b'two' ] )
+    payload = flusherproto.pack_topic( 'a-t\u00f6pic' ) + msgs
+    topic, rest = flusherproto.unpack_topic( memoryview( payload ), flusherproto.FLAG_TOPIC )
+    assert topic == 'a-t\u00f6pic'
+    assert flusherproto.split_messages( rest ) == [ b'one', b'two' ]
+
+    assert flusherproto.unpack_topic( msgs, 0 ) == ( None, msgs )
+    with pytest.raises( flusherproto.ProtocolError ):
+        flusherproto.unpack_topic( payload[:4], flusherproto.FLAG_TOPIC )
+
+
+def test_ack_wait():
+    payload = flusherproto.pack_ackwait( 2.5 ) + flusherproto.pack_topic( 'topic' ) + _msgs_payload( [ b'one' ] )
+    flags = flusherproto.FLAG_ACK | flusherproto.FLAG_TOPIC
+    wait, rest = flusherproto.unpack_ackwait( memoryview( payload ), flags )
+    assert wait == 2.5
+    assert flusherproto.unpack_topic( rest, flags )[0] == 'topic'
+    assert flusherproto.unpack_ackwait( payload, flusherproto.FLAG_TOPIC ) == ( None, payload )
+    with pytest.raises( flusherproto.ProtocolError ):
+        flusherproto.unpack_ackwait( b'\x01', flusherproto.FLAG_ACK )
+
+    status = bytes( [ flusherproto.ACK_DELIVERED, flusherproto.ACK_FAILED, flusherproto.ACK_PENDING ] )
+    assert flusherproto.unpack_acks( flusherproto.MSGLEN.pack( 3 ) + status ) == ( 3, status )
+    assert flusherproto.unpack_acks( flusherproto.MSGLEN.pack( 3 ) ) == ( 3, None )
+    assert flusherproto.unpack_acks( flusherproto.MSGLEN.pack( 0 ) ) == ( 0, b'' )
+    with pytest.raises( flusherproto.ProtocolError ):
+        flusherproto.unpack_acks( flusherproto.MSGLEN.pack( 3 ) + status[:2] )
+
+
+def test_batch_id():
+    payload = flusherproto.pack_batchid( 'client-7/123' ) + _msgs_payload( [ b'one' ] )
+    batchid, rest = flusherproto.unpack_batchid( memoryview( payload ), flusherproto.FLAG_BATCHID )
+    assert batchid == 'client-7/123'
+    assert flusherproto.split_messages( rest ) == [ b'one' ]
+    assert flusherproto.unpack_batchid( payload, 0 ) == ( None, payload )
+    with pytest.raises( flusherproto.ProtocolError ):
+        flusherproto.unpack_batchid( payload[:5], flusherproto.FLAG_BATCHID )
+
+
+def test_records():
+    rec = flusherproto.pack_record( b'value', key=b'key', headers=[ ( 'schema', b'7' ), ( 'src', b'' ) ],
+                                    timestamp=1700000000123 )
+    assert ( flusherproto.unpack_record( memoryview( rec ) )
+             == ( b'value', b'key', [ ( 'schema', b'7' ), ( 'src', b'' ) ], 1700000000123 ) )
+    assert flusherproto.unpack_record( flusherproto.pack_record( b'' ) ) == ( b'', None, [], None )
+    # An empty key isn't the same as no key
+    assert flusherproto.unpack_record( flusherproto.pack_record( b'x', key=b'' ) )[1] == b''
+
+    payload = _msgs_payload( [ rec, flusherproto.pack_record( b'v' ) ] )
+    flusherproto.check_records( payload, flusherproto.index_messages( payload ) )
+
+    for bad in [ rec[:10], rec[:flusherproto.RECORD.size + 2], rec[:flusherproto.RECORD.size + 8] ]:
+        with pytest.raises( flusherproto.ProtocolError ):
+            flusherproto.unpack_record( bad )
+        payload = _msgs_payload( [ bad ] )
+        with pytest.raises( flusherproto.ProtocolError ):
+            flusherproto.check_records( payload, flusherproto.index_messages( payload ) )
+
+
+def test_send_scattered():
+    parts = [ b'abc', memoryview( b'defgh' ), bytearray( b'ij' ) ]
+    a, b = socket.socketpair()
+    try:
+        flusherproto.send_frame( a, b'MSGS', parts )
+        verb, _flags, got = flusherproto.recv_frame( b )
+        assert verb == b'MSGS'
+        assert got == b'abcdefghij'
+    finally:
+        a.close()
+        b.close()
+
+
+def test_message_stream_reader():
+    msgs = [ bytes( [i % 256] ) * ( i * 37 % 500 ) for i in range( 1000 ) ]
+    body = _msgs_payload( msgs )
+
+    reader = flusherproto.MessageStreamReader( io.BytesIO( body ), chunk_size=4096, readsize=1000 )
+    chunks = list( reader )
+    assert len( chunks ) > 1
+    assert all( len( chunk ) <= 4096 + 1000 + 504 for chunk, _ in chunks )
+    assert sum( n for _, n in chunks ) == len( msgs )
+    assert b''.join( chunk for chunk, _ in chunks ) == body
+
+    # Where chunks end doesn't depend on how the data was read
+    other = list( flusherproto.MessageStreamReader( io.BytesIO( body ), chunk_size=4096, readsize=77 ) )
+    assert [ ( bytes( c ), n ) for c, n in other ] == [ ( bytes( c ), n ) for c, n in chunks ]
+
+    # Truncated data only fails at the end, after the whole messages before it
+    reader = flusherproto.MessageStreamReader( io.BytesIO( body[:-1] ), chunk_size=4096 )
+    got = 0
+    with pytest.raises( flusherproto.ProtocolError ):
+        for _, n in reader:
+            got += n
+    assert got == len( msgs ) - 1
+
+    with pytest.raises( flusherproto.ProtocolError ):
+        list( flusherproto.MessageStreamReader( io.BytesIO( body ), max_message_size=100 ) )
+
+
+def test_message_chunker():
+    msgs = [ bytes( [i % 256] ) * ( i * 37 % 500 ) for i in range( 1000 ) ]
+    body = _msgs_payload( msgs )
+    expected = [ ( bytes( c ), n )
+                 for c, n in flusherproto.MessageStreamReader( io.BytesIO( body ), chunk_size=4096 ) ]
+
+    # Fed in uneven pieces, the chunks are the same as MessageStreamReader's
+    chunker = flusherproto.MessageChunker( chunk_size=4096 )
+    chunks = []
+    pos = 0
+    i = 0
+    while pos < len( body ):
+        piece = body[ pos : pos + ( i * 131 % 3000 ) + 1 ]
+        pos += len( piece )
+        i += 1
+        chunks += [ ( bytes( c ), n ) for c, n in chunker.feed( piece ) ]
+    chunks += [ ( bytes( c ), n ) for c, n in chunker.end() ]
+    assert chunks == expected
+
+    chunker = flusherproto.MessageChunker( chunk_size=4096 )
+    assert len( list( chunker.feed( body[:10] ) ) ) == 0
+    with pytest.raises( flusherproto.ProtocolError ):
+        list( chunker.end() )
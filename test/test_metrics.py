@@ -0,0 +1,62 @@
+import os
+
+import metrics
+
+
+def test_render():
+    m = metrics.Metrics()
+    ok = m.counter( 'requests_total', "Requests", { 'code': '200' } )
+    bad = m.counter( 'requests_total', "Requests", { 'code': '500' } )
+    queued = m.gauge( 'queued', "Things queued" )
+    seconds = m.histogram( 'seconds', "How long", buckets=( 0.1, 1. ) )
+    ok.inc( 3 )
+    bad.inc()
+    queued.set( 7 )
+    for t in ( 0.05, 0.5, 0.5, 5. ):
+        seconds.observe( t )
+
+    text = metrics.render( [ ( m.snapshot(), {} ), ( m.snapshot(), { 'shard': '1' } ) ] )
+    lines = text.splitlines()
+    assert lines.count( '# TYPE requests_total counter' ) == 1
+    assert 'requests_total{code="200"} 3' in lines
+    assert 'requests_total{code="500",shard="1"} 1' in lines
+    assert 'queued 7' in lines
+    assert 'seconds_bucket{le="0.1"} 1' in lines
+    assert 'seconds_bucket{le="1"} 3' in lines
+    assert 'seconds_bucket{le="+Inf"} 4' in lines
+    assert 'seconds_count{shard="1"} 4' in lines
+    assert 'seconds_sum 6.05' in lines
+
+
+def test_share( tmp_path ):
+    def make():
+        m = metrics.Metrics()
+        return m, m.counter( 'n_total', "Things" ), m.histogram( 'size', "Sizes", buckets=( 10, ) )
+
+    m, n, size = make()
+    n.inc( 2 )
+    m.share( tmp_path )
+    n.inc()
+    size.observe( 20 )
+
+    # Another process with the same metrics, as if it were a forked worker
+    pid = os.fork()
+    if pid == 0:
+        try:
+            m.share( tmp_path )
+            n.inc( 10 )
+            size.observe( 5 )
+        finally:
+            os._exit( 0 )
+    os.waitpid( pid, 0 )
+
+    # Different metrics don't get mixed in
+    other = metrics.Metrics()
+    other.counter( 'n_total', "Something else" ).inc( 100 )
+    other.share( tmp_path )
+
+    assert m.snapshot()['metrics'][0]['value'] == 3
+    total = { metric['name']: metric for metric in m.collect()['metrics'] }
+    assert total['n_total']['value'] == 13
+    assert total['size']['counts'] == [ 1, 1 ]
+    assert total['size']['count'] == 2
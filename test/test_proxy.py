@@ -1,5 +1,6 @@
 import pytest
 import io
+import gzip
 import time
 import random
 import requests
@@ -12,6 +13,8 @@ urllib3.disable_warnings()
 import fastavro
 import confluent_kafka
 
+import flusherproto
+
 
 @pytest.fixture( scope='session' )
 def server():
@@ -116,3 +119,201 @@ def test_send_several_messages( server, reqheaders, schema, kafka_server, topic,
     data = [ fastavro.schemaless_reader( io.BytesIO(m.value()), schema ) for m in msgs ]
     assert set( d['string'] for d in data ) == set( strings )
     assert set( d['int'] for d in data ) == set( numbers )
+
+
+def test_send_chunked( server, reqheaders, schema, kafka_server, topic, barf ):
+    # Passing a generator makes requests send the body with chunked
+    #   transfer encoding, which makes the server stream it to the flusher
+    def body():
+        for i in range( 1000 ):
+            bio = io.BytesIO()
+            fastavro.write.schemaless_writer( bio, schema, { 'string': f'chunk{i}', 'int': i } )
+            yield int( len( bio.getvalue() ) ).to_bytes( 4, byteorder='little' ) + bio.getvalue()
+
+    res = requests.post( server, headers=reqheaders, data=body(), verify=False )
+    assert res.status_code == 200
+    assert res.text == "1000 messages received"
+
+    consumer = confluent_kafka.Consumer( { 'bootstrap.servers': kafka_server,
+                                           'auto.offset.reset': 'earliest',
+                                           'group.id': f'test-send-chunked-{barf}' } )
+    time.sleep( 12 )
+    consumer.subscribe( [ topic ] )
+    msgs = []
+    while len( msgs ) < 1000:
+        newmsgs = consumer.consume( 1000, timeout=5 )
+        if len( newmsgs ) == 0:
+            break
+        msgs.extend( newmsgs )
+    assert len( msgs ) == 1000
+    data = [ fastavro.schemaless_reader( io.BytesIO(m.value()), schema ) for m in msgs ]
+    assert set( d['int'] for d in data ) == set( range( 1000 ) )
+
+
+def test_chunked_truncated( server, reqheaders, topic ):
+    def body():
+        yield b'\x0e\x00\x00\x00This is a test'
+        yield b'\x12\x00\x00\x00This is not'
+
+    res = requests.post( server, headers=reqheaders, data=body(), verify=False )
+    assert res.status_code == 500
+    assert res.headers['x-kafka-proxy-messages-accepted'] == '1'
+
+
+def test_send_gzipped( server, reqheaders, schema, kafka_server, topic, barf ):
+    reqbody = io.BytesIO()
+    for i in range( 100 ):
+        bio = io.BytesIO()
+        fastavro.write.schemaless_writer( bio, schema, { 'string': 'compressed', 'int': i } )
+        reqbody.write( int( len( bio.getvalue() ) ).to_bytes( 4, byteorder='little' ) )
+        reqbody.write( bio.getvalue() )
+    headers = dict( reqheaders )
+    headers['content-encoding'] = 'gzip'
+    res = requests.post( server, headers=headers, data=gzip.compress( reqbody.getvalue() ), verify=False )
+    assert res.status_code == 200
+    assert res.text == "100 messages received"
+
+    consumer = confluent_kafka.Consumer( { 'bootstrap.servers': kafka_server,
+                                           'auto.offset.reset': 'earliest',
+                                           'group.id': f'test-send-gzipped-{barf}' } )
+    time.sleep( 12 )
+    consumer.subscribe( [ topic ] )
+    msgs = consumer.consume( 200, timeout=5 )
+    assert len( msgs ) == 100
+    data = [ fastavro.schemaless_reader( io.BytesIO(m.value()), schema ) for m in msgs ]
+    assert set( d['int'] for d in data ) == set( range( 100 ) )
+
+    headers['content-encoding'] = 'br'
+    res = requests.post( server, headers=headers, data=b'', verify=False )
+    assert res.status_code == 415
+
+
+def test_send_to_topics( server, reqheaders, kafka_server, topic, barf ):
+    other = 'test-' + ''.join( random.choices( 'abcdefghijklmnopqrstuvwxyz', k=6 ) )
+
+    res = requests.post( server + f"/topics/{other}", headers=reqheaders, data=b'\x03\x00\x00\x00one',
+                         verify=False )
+    assert res.status_code == 403
+
+    res = requests.post( server + f"/allowtopic/{other}", headers=reqheaders, verify=False )
+    assert res.status_code == 200
+    # The webserver checks the topic map at most once a second
+    time.sleep( 1.5 )
+
+    res = requests.post( server + f"/topics/{other}", headers=reqheaders, data=b'\x03\x00\x00\x00one',
+                         verify=False )
+    assert res.status_code == 200
+    res = requests.post( server, headers={ **reqheaders, 'x-kafka-proxy-topic': other },
+                         data=b'\x03\x00\x00\x00two', verify=False )
+    assert res.status_code == 200
+    res = requests.post( server, headers=reqheaders, data=b'\x05\x00\x00\x00three', verify=False )
+    assert res.status_code == 200
+
+    time.sleep( 12 )
+    for t, expected in [ ( other, [ b'one', b'two' ] ), ( topic, [ b'three' ] ) ]:
+        consumer = confluent_kafka.Consumer( { 'bootstrap.servers': kafka_server,
+                                               'auto.offset.reset': 'earliest',
+                                               'group.id': f'test-send-to-topics-{barf}-{t}' } )
+        consumer.subscribe( [ t ] )
+        msgs = consumer.consume( len(expected) + 1, timeout=5 )
+        assert sorted( m.value() for m in msgs ) == expected
+        consumer.close()
+
+    res = requests.post( server + f"/disallowtopic/{other}", headers=reqheaders, verify=False )
+    assert res.status_code == 200
+
+
+def test_send_records( server, reqheaders, kafka_server, topic, barf ):
+    records = [ flusherproto.pack_record( b'one', key=b'object-1', headers=[ ( 'source', b'test' ) ],
+                                          timestamp=1700000000000 ),
+                flusherproto.pack_record( b'two' ) ]
+    reqbody = b''.join( len(r).to_bytes( 4, byteorder='little' ) + r for r in records )
+    res = requests.post( server, headers={ **reqheaders, 'content-type': flusherproto.RECORDS_CONTENT_TYPE },
+                         data=reqbody, verify=False )
+    assert res.status_code == 200
+    assert res.text == "2 messages received"
+
+    consumer = confluent_kafka.Consumer( { 'bootstrap.servers': kafka_server,
+                                           'auto.offset.reset': 'earliest',
+                                           'group.id': f'test-send-records-{barf}' } )
+    time.sleep( 12 )
+    consumer.subscribe( [ topic ] )
+    msgs = consumer.consume( 3, timeout=5 )
+    assert len( msgs ) == 2
+    msgs = { m.value(): m for m in msgs }
+    assert msgs[b'one'].key() == b'object-1'
+    assert msgs[b'one'].headers() == [ ( 'source', b'test' ) ]
+    assert msgs[b'one'].timestamp()[1] == 1700000000000
+    assert msgs[b'two'].key() is None
+
+
+def test_send_avro( server, reqheaders, schema, kafka_server, topic, barf ):
+    # The server encodes JSON records with test/testschema.avsc (see
+    #   docker-compose.yaml)
+    headers = { **reqheaders, 'content-type': 'application/x-ndjson' }
+    res = requests.post( server + "/avro/testschema", headers=headers,
+                         data=b'{"string": "json", "int": 1}\n{"string": null, "int": 2}\n', verify=False )
+    assert res.status_code == 200
+    assert res.text == "2 messages received"
+
+    res = requests.post( server + "/avro/testschema", headers=headers, data=b'{"int": "one"}', verify=False )
+    assert res.status_code == 400
+    res = requests.post( server + "/avro/nosuchschema", headers=headers, data=b'{}', verify=False )
+    assert res.status_code == 404
+
+    consumer = confluent_kafka.Consumer( { 'bootstrap.servers': kafka_server,
+                                           'auto.offset.reset': 'earliest',
+                                           'group.id': f'test-send-avro-{barf}' } )
+    time.sleep( 12 )
+    consumer.subscribe( [ topic ] )
+    msgs = consumer.consume( 3, timeout=5 )
+    data = [ fastavro.schemaless_reader( io.BytesIO(m.value()), schema ) for m in msgs ]
+    assert sorted( d['int'] for d in data ) == [ 1, 2 ]
+    assert set( d['string'] for d in data ) == { 'json', None }
+
+
+def test_wait_for_delivery( server, reqheaders, topic ):
+    res = requests.post( server, headers={ **reqheaders, 'x-kafka-proxy-wait-for-delivery': '20' },
+                         data=b'\x03\x00\x00\x00one\x03\x00\x00\x00two', verify=False )
+    assert res.status_code == 200
+    assert res.json() == { 'messages': 2, 'delivered': 2, 'failed': [], 'pending': [], 'duplicates': 0 }
+
+    res = requests.post( server, headers={ **reqheaders, 'x-kafka-proxy-wait-for-delivery': 'soon' },
+                         data=b'\x03\x00\x00\x00one', verify=False )
+    assert res.status_code == 400
+
+
+def test_batch_id( server, reqheaders, kafka_server, topic, barf ):
+    headers = { **reqheaders, 'x-kafka-proxy-batch-id': f'test-batch-id-{barf}' }
+    res = requests.post( server, headers=headers, data=b'\x04\x00\x00\x00once', verify=False )
+    assert res.status_code == 200
+    assert 'x-kafka-proxy-duplicate-messages' not in res.headers
+    res = requests.post( server, headers=headers, data=b'\x04\x00\x00\x00once', verify=False )
+    assert res.status_code == 200
+    assert res.headers['x-kafka-proxy-duplicate-messages'] == '1'
+
+    consumer = confluent_kafka.Consumer( { 'bootstrap.servers': kafka_server,
+                                           'auto.offset.reset': 'earliest',
+                                           'group.id': f'test-batch-id-{barf}' } )
+    time.sleep( 12 )
+    consumer.subscribe( [ topic ] )
+    msgs = consumer.consume( 2, timeout=5 )
+    assert [ m.value() for m in msgs ] == [ b'once' ]
+
+
+def test_metrics( server, reqheaders, topic ):
+    res = requests.post( server, headers=reqheaders, data=b'\x03\x00\x00\x00one', verify=False )
+    assert res.status_code == 200
+
+    res = requests.get( server + "/metrics", verify=False )
+    assert res.status_code == 200
+    assert res.headers['content-type'].startswith( 'text/plain' )
+    values = {}
+    for line in res.text.splitlines():
+        if not line.startswith( '#' ):
+            name, value = line.rsplit( ' ', 1 )
+            values[ name ] = float( value )
+    assert values[ 'kafka_proxy_requests_total{code="200"}' ] >= 1
+    assert values[ 'kafka_proxy_messages_total' ] >= 1
+    assert values[ 'kafka_proxy_flusher_up{shard="0"}' ] == 1
+    assert values[ 'kafka_flusher_received_total{shard="0"}' ] >= 1
@@ -0,0 +1,64 @@
+import os
+import json
+
+import pytest
+
+import ratelimit
+
+
+def test_registry( tmp_path ):
+    path = tmp_path / "tokens"
+    path.write_text( json.dumps( { 'clients': { 'alice': { 'token': 'a-token', 'messages_per_second': 10 },
+                                                'bob': { 'token': 'b-token' } } } ) )
+    tokens = ratelimit.TokenRegistryFile( path, default_token='d-token', checkevery=0 )
+    assert tokens.get().lookup( 'a-token' ).name == 'alice'
+    assert tokens.get().lookup( 'a-token' ).limited
+    assert not tokens.get().lookup( 'b-token' ).limited
+    assert tokens.get().lookup( 'd-token' ).name == 'default'
+    assert tokens.get().lookup( 'a-toke' ) is None
+    assert tokens.get().lookup( None ) is None
+
+    # A broken file lets nobody in but the default token
+    path.write_text( json.dumps( { 'clients': { 'alice': { 'token': 'a-token', 'bytes_per_second': -1 } } } ) )
+    assert tokens.get().lookup( 'a-token' ) is None
+    assert tokens.get().lookup( 'd-token' ).name == 'default'
+
+    with pytest.raises( ValueError ):
+        ratelimit.TokenRegistry.parse( json.dumps( { 'clients': { 'carol': {} } } ) )
+
+    assert ratelimit.TokenRegistryFile( None ).get().lookup( 'a-token' ) is None
+
+
+def test_buckets( tmp_path ):
+    limiter = ratelimit.RateLimiter( tmp_path / "buckets" )
+    client = ratelimit.Client( 'alice', 'a-token', messages_per_second=100, bytes_per_second=1000, burst=2 )
+    unlimited = ratelimit.Client( 'bob', 'b-token' )
+
+    # Starts full (2 s worth), and can go below empty
+    assert limiter.admit( client, now=10. ) is None
+    limiter.charge( client, 150, 500, now=10. )
+    assert limiter.admit( client, now=10. ) is None
+    limiter.charge( client, 150, 500, now=10. )
+    # 100 messages short, at 100/s
+    assert limiter.admit( client, now=10. ) == 2
+    assert limiter.admit( client, now=10.5 ) == 1
+    assert limiter.admit( client, now=11.1 ) is None
+    # Never more than 2 s worth
+    limiter.charge( client, 0, 0, now=100. )
+    limiter.charge( client, 250, 0, now=100. )
+    assert limiter.admit( client, now=100. ) == 1
+
+    limiter.charge( unlimited, 1000000, 1000000 )
+    assert limiter.admit( unlimited ) is None
+
+    # Another process (e.g. another worker) shares the buckets
+    pid = os.fork()
+    if pid == 0:
+        try:
+            limiter.charge( client, 0, 100000, now=100. )
+        finally:
+            os._exit( 0 )
+    os.waitpid( pid, 0 )
+    assert limiter.admit( client, now=100. ) == 99
+    other = ratelimit.RateLimiter( tmp_path / "buckets" )
+    assert other.admit( client, now=100. ) == 99
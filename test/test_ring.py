@@ -0,0 +1,140 @@
+import os
+import multiprocessing
+
+import pytest
+
+import ring
+import flusherproto
+
+
+def _msgs_payload( msgs ):
+    return b''.join( len(m).to_bytes( 4, byteorder='little' ) + m for m in msgs )
+
+
+def _take( consumer, maxbytes=None ):
+    got = []
+    for payload, nmsgs, _flags in consumer.records( maxbytes ):
+        got.append( ( bytes( payload ), nmsgs ) )
+        payload.release()
+    return got
+
+
+def test_ring_roundtrip( tmp_path ):
+    consumer = ring.RingConsumer( tmp_path / "ring", capacity=1000 )
+    producer = ring.RingProducer( tmp_path / "ring" )
+    try:
+        assert producer.consumer_age() < 5
+        assert _take( consumer ) == []
+
+        # Go around the ring several times, so records have to wrap
+        for i in range( 20 ):
+            payload = _msgs_payload( [ bytes( [i] ) * ( 50 + i ), b'x' ] )
+            producer.put( [ payload[:10], memoryview( payload )[10:] ], 2 )
+            producer.put( payload, 2 )
+            assert _take( consumer ) == [ ( payload, 2 ), ( payload, 2 ) ]
+            assert not consumer.release()
+
+        producer.put( b'xyz', 1, flags=5 )
+        assert [ ( bytes( p ), n, f ) for p, n, f in consumer.records() ] == [ ( b'xyz', 1, 5 ) ]
+        consumer.release()
+
+        # A producer wakes the consumer only when the ring was empty
+        consumer.clear_wakeups()
+        producer.put( b'abc', 0 )
+        producer.put( b'def', 0 )
+        assert os.read( consumer.fileno(), 100 ) == b'\0'
+
+        # maxbytes stops early, but always gives at least one record
+        assert _take( consumer, maxbytes=1 ) == [ ( b'abc', 0 ) ]
+        assert consumer.release()
+        assert _take( consumer ) == [ ( b'def', 0 ) ]
+        assert not consumer.release()
+    finally:
+        producer.close()
+        consumer.close()
+
+
+def test_ring_full( tmp_path ):
+    consumer = ring.RingConsumer( tmp_path / "ring", capacity=256 )
+    producer = ring.RingProducer( tmp_path / "ring" )
+    try:
+        with pytest.raises( ring.RingFull ):
+            producer.put( bytes( 300 ), 0 )
+
+        producer.put( bytes( 100 ), 0 )
+        producer.put( bytes( 100 ), 0 )
+        with pytest.raises( ring.RingFull ):
+            producer.put( bytes( 100 ), 0 )
+
+        # Space isn't reusable until the consumer releases it
+        assert len( _take( consumer ) ) == 2
+        with pytest.raises( ring.RingFull ):
+            producer.put( bytes( 100 ), 0 )
+        consumer.release()
+        producer.put( bytes( 100 ), 0 )
+    finally:
+        producer.close()
+        consumer.close()
+
+
+def test_ring_survives_consumer_restart( tmp_path ):
+    consumer = ring.RingConsumer( tmp_path / "ring", capacity=1024 )
+    producer = ring.RingProducer( tmp_path / "ring" )
+    producer.put( b'one', 1 )
+    producer.put( b'two', 2 )
+    # Taken but never released, as if the consumer died before its spool sync
+    assert len( _take( consumer ) ) == 2
+    consumer.close()
+
+    consumer = ring.RingConsumer( tmp_path / "ring", capacity=5000 )
+    try:
+        assert consumer.capacity == 1024
+        assert not producer.replaced()
+        assert _take( consumer ) == [ ( b'one', 1 ), ( b'two', 2 ) ]
+    finally:
+        producer.close()
+        consumer.close()
+
+
+def _produce( path, procno, n ):
+    producer = ring.RingProducer( path )
+    for i in range( n ):
+        msg = f"{procno} {i}".encode()
+        while True:
+            try:
+                producer.put( _msgs_payload( [ msg ] ), 1 )
+                break
+            except ring.RingFull:
+                pass
+    producer.close()
+
+
+def test_ring_many_producers( tmp_path ):
+    path = tmp_path / "ring"
+    consumer = ring.RingConsumer( path, capacity=4096 )
+    ctx = multiprocessing.get_context( 'fork' )
+    procs = [ ctx.Process( target=_produce, args=( path, p, 2000 ) ) for p in range( 4 ) ]
+    try:
+        for proc in procs:
+            proc.start()
+        got = []
+
+        def drain():
+            for payload, _nmsgs, _flags in consumer.records():
+                got.extend( flusherproto.split_messages( payload ) )
+                payload.release()
+            consumer.release()
+        while any( proc.is_alive() for proc in procs ):
+            drain()
+        for proc in procs:
+            proc.join()
+            assert proc.exitcode == 0
+        drain()
+
+        # Everything arrived, once, and each producer's messages in order
+        assert len( got ) == 8000
+        for p in range( 4 ):
+            mine = [ int( m.split()[1] ) for m in got if m.startswith( f"{p} ".encode() ) ]
+            assert mine == list( range( 2000 ) )
+    finally:
+        consumer.close()
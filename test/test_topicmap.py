@@ -0,0 +1,61 @@
+import os
+import time
+
+import pytest
+
+import topicmap
+
+
+def test_old_style_cache( tmp_path ):
+    path = tmp_path / "topic"
+    path.write_text( "some-topic\n" )
+    tm = topicmap.TopicMap.read( path )
+    assert tm.default == "some-topic"
+    assert tm.allowed( "some-topic" )
+    assert not tm.allowed( "other-topic" )
+
+
+def test_roundtrip( tmp_path ):
+    path = tmp_path / "topic"
+    tm = topicmap.TopicMap( "a", { "b": { "maxmsgs": 1000, "timeout": 1.0 } } )
+    tm.write( path )
+    got = topicmap.TopicMap.read( path )
+    assert got == tm
+    assert got.allowed( "a" ) and got.allowed( "b" )
+    assert got.settings( "b" )[ "maxmsgs" ] == 1000
+    assert got.settings( "a" ) == {}
+
+    got.allow( "c" )
+    got.set_default( "d" )
+    got.deny( "a" )
+    assert sorted( got.topics.keys() ) == [ "b", "c", "d" ]
+    with pytest.raises( ValueError ):
+        got.deny( "d" )
+    assert [ f.name for f in tmp_path.iterdir() ] == [ "topic" ]
+
+
+def test_topic_map_file( tmp_path ):
+    path = tmp_path / "topic"
+    tmf = topicmap.TopicMapFile( path, checkevery=0 )
+    assert not tmf.get().allowed( "a" )
+
+    topicmap.TopicMap( "a" ).write( path )
+    assert tmf.get().allowed( "a" )
+
+    # Make sure the mtime changes even on filesystems with coarse timestamps
+    topicmap.TopicMap( "b" ).write( path )
+    st = os.stat( path )
+    os.utime( path, ns=( st.st_atime_ns, st.st_mtime_ns + 1000000000 ) )
+    assert tmf.get().default == "b"
+
+    path.write_text( "{ not json" )
+    os.utime( path, ns=( st.st_atime_ns, st.st_mtime_ns + 2000000000 ) )
+    assert tmf.get().default is None
+
+    # Without checkevery=0, changes aren't noticed right away
+    tmf = topicmap.TopicMapFile( path, checkevery=60 )
+    topicmap.TopicMap( "c" ).write( path )
+    assert tmf.get().default == "c"
+    topicmap.TopicMap( "d" ).write( path )
+    os.utime( path, ns=( st.st_atime_ns, time.time_ns() + 3000000000 ) )
+    assert tmf.get().default == "c"
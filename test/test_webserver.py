@@ -0,0 +1,71 @@
+import time
+import zlib
+import socket
+import threading
+
+import flusherproto
+import webserver
+
+
+def _fake_flusher( path, reply=None ):
+    # A flusher that answers every frame with reply ( verb, payload ), or
+    #   by default OK and the same payload; returns the list of
+    #   connections it has accepted
+    listener = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    listener.bind( path )
+    listener.listen()
+    conns = []
+
+    def answer( conn ):
+        try:
+            while True:
+                _verb, _flags, payload = flusherproto.recv_frame( conn )
+                flusherproto.send_frame( conn, *( ( b'OK  ', payload ) if reply is None else reply ) )
+        except OSError:
+            conn.close()
+
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            conns.append( conn )
+            threading.Thread( target=answer, args=( conn, ), daemon=True ).start()
+
+    threading.Thread( target=accept, daemon=True ).start()
+    return conns
+
+
+def test_pool_reuse( tmp_path ):
+    conns = _fake_flusher( str( tmp_path / "sock" ) )
+    pool = webserver.FlusherConnectionPool( str( tmp_path / "sock" ), timeout=2 )
+    assert pool.request( b'MSGS', b'first' ) == ( b'OK  ', b'first' )
+
+    # A pooled connection is reused without waiting for anything
+    t0 = time.monotonic()
+    for i in range( 5 ):
+        assert pool.request( b'MSGS', b'again' ) == ( b'OK  ', b'again' )
+    assert time.monotonic() - t0 < 0.5
+    assert len( conns ) == 1
+
+    # One the flusher has closed isn't
+    conns[0].shutdown( socket.SHUT_RDWR )
+    t0 = time.monotonic()
+    assert pool.request( b'MSGS', b'new' ) == ( b'OK  ', b'new' )
+    assert time.monotonic() - t0 < 0.5
+    assert len( conns ) == 2
+
+
+def test_busy_shard_with_batch_id( tmp_path ):
+    busy = ( b'BUSY', flusherproto.MSGLEN.pack( 3 ) )
+    paths = [ str( tmp_path / f"sock.{i}" ) for i in range( 2 ) ]
+    _fake_flusher( paths[0], reply=busy )
+    _fake_flusher( paths[1] )
+    shards = webserver.FlusherShards( paths, timeout=2 )
+    payload = flusherproto.MSGLEN.pack( 1 ) + b'a'
+
+    # Without a batch ID, a busy shard's messages go to the other one
+    assert shards.send_messages( payload, 1 )[0] == b'OK  '
+    assert shards.send_messages( payload, 1 )[0] == b'OK  '
+
+    # With one, they only go to the shard that has seen the ID before
+    batchid = next( f"batch-{i}" for i in range( 100 ) if zlib.crc32( f"batch-{i}".encode() ) % 2 == 0 )
+    assert shards.send_messages( payload, 1, batchid=batchid ) == busy
@@ -0,0 +1,108 @@
+# The topic map: the topics the proxy is allowed to send messages to,
+#   the topic that messages go to if a POST doesn't say, and (optionally)
+#   flush settings for individual topics.  It lives, as JSON, in the topic
+#   cache file (KAFKA_FLUSHER_TOPIC_CACHE), which the flusher writes and
+#   the webserver reads:
+#
+#   { "default": "topic-a",
+#     "topics": { "topic-a": {},
+#                 "topic-b": { "maxmsgs": 1000, "timeout": 1.0 } } }
+#
+# Every topic in "topics" is allowed; the default topic always is.  The
+#   settings for a topic override the flusher's --num-messages (maxmsgs),
+#   --num-bytes (maxbytes), --flush-timeout (timeout), and
+#   --latency-target (latency_target) for that topic's messages.
+#
+# The topic cache file used to hold just the name of the one topic the
+#   flusher was sending to; a file like that is read as a map with that
+#   topic as the default.
+
+import os
+import json
+import time
+import pathlib
+
+
+class TopicMap:
+    def __init__( self, default=None, topics=None ):
+        self.default = default
+        self.topics = {} if topics is None else { t: dict( s ) for t, s in topics.items() }
+        if default is not None:
+            self.topics.setdefault( default, {} )
+
+    def allowed( self, topic ):
+        return topic in self.topics
+
+    def settings( self, topic ):
+        return self.topics.get( topic, {} )
+
+    def set_default( self, topic ):
+        self.default = topic
+        self.topics.setdefault( topic, {} )
+
+    def allow( self, topic ):
+        self.topics.setdefault( topic, {} )
+
+    def deny( self, topic ):
+        if topic == self.default:
+            raise ValueError( f"Can't disallow the default topic {topic}" )
+        self.topics.pop( topic, None )
+
+    def copy( self ):
+        return TopicMap( self.default, self.topics )
+
+    def __eq__( self, other ):
+        return ( isinstance( other, TopicMap )
+                 and ( self.default == other.default ) and ( self.topics == other.topics ) )
+
+    @classmethod
+    def parse( cls, text ):
+        text = text.strip()
+        if not text.startswith( '{' ):
+            # Old style cache: just the topic
+            topic = text.split( '\n' )[0].strip()
+            return cls( topic if len( topic ) > 0 else None )
+        data = json.loads( text )
+        return cls( data.get( 'default' ), data.get( 'topics', {} ) )
+
+    @classmethod
+    def read( cls, path ):
+        with open( path ) as ifp:
+            return cls.parse( ifp.read() )
+
+    def write( self, path ):
+        # There may be several flushers (shards) sharing the file, and the
+        #   webserver reads it, so replace it atomically rather than
+        #   writing it in place.
+        path = pathlib.Path( path )
+        tmpfile = path.parent / f".{path.name}.{os.getpid()}"
+        with open( tmpfile, "w" ) as ofp:
+            json.dump( { 'default': self.default, 'topics': self.topics }, ofp, indent=2, sort_keys=True )
+        os.replace( tmpfile, path )
+
+
+class TopicMapFile:
+    # Keeps a TopicMap read from a file up to date, looking to see if the
+    #   file has changed at most every checkevery seconds.  If the file
+    #   isn't there (or can't be read), the map is empty, so no topic is
+    #   allowed.
+    def __init__( self, path, checkevery=1 ):
+        self.path = pathlib.Path( path )
+        self.checkevery = checkevery
+        self.mtime = None
+        self.lastcheck = None
+        self.topicmap = TopicMap()
+
+    def get( self ):
+        now = time.monotonic()
+        if ( self.lastcheck is None ) or ( now - self.lastcheck >= self.checkevery ):
+            self.lastcheck = now
+            try:
+                mtime = self.path.stat().st_mtime_ns
+                if mtime != self.mtime:
+                    self.topicmap = TopicMap.read( self.path )
+                    self.mtime = mtime
+            except ( OSError, ValueError ):
+                self.topicmap = TopicMap()
+                self.mtime = None
+        return self.topicmap
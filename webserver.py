@@ -1,156 +1,403 @@
 import os
+import time
 import socket
-import datetime
+import select
 import logging
+import collections
 
 import flask
 import flask.views
 
+import flusherproto
+import compression
+import avroencode
+import ingest
+
 # _loglevel = logging.DEBUG
 _loglevel = logging.INFO
 
 
+# Everything that doesn't depend on flask (checking requests, the
+#   responses, and the metrics) is in ingest.py, shared with
+#   asyncserver.py.  Every gunicorn worker process keeps its own metrics
+#   in a file in KAFKA_PROXY_METRICS_DIR, and /metrics adds them all up
+#   (and adds what each flusher has).
+def _share_metrics():
+    ingest.share_metrics( logging.getLogger( __name__ ) )
+
+
+_share_metrics()
+# A forked child (e.g. a gunicorn worker, if the app was preloaded) needs
+#   its own file
+os.register_at_fork( after_in_child=_share_metrics )
+
+
+class FlusherConnectionPool:
+    # Long-lived connections to the flusher, shared by all of the requests
+    #   (gevent greenlets) handled by one gunicorn worker process.  Each
+    #   request takes a connection out of the pool, sends a frame, reads
+    #   the reply, and puts it back; up to maxidle connections are kept
+    #   open between requests.  (If more requests than that are going at
+    #   once, the extras just make their own connections and close them
+    #   when they're done.)
+    def __init__( self, socket_file, timeout=2, maxidle=8, maxidleage=60 ):
+        self.socket_file = socket_file
+        self.timeout = timeout
+        self.maxidle = maxidle
+        self.maxidleage = maxidleage
+        self.pid = os.getpid()
+        self.idle = collections.deque()
+
+    def _connect( self ):
+        sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM, 0 )
+        try:
+            sock.settimeout( self.timeout )
+            sock.connect( self.socket_file )
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    @staticmethod
+    def _healthy( sock ):
+        # An idle connection should have nothing to read.  If it's
+        #   readable, either the flusher went away (e.g. it was restarted)
+        #   and we'd read EOF, or there are stray bytes that would confuse
+        #   the next request; either way, don't use it.
+        try:
+            readable, _, _ = select.select( [ sock ], [], [], 0 )
+        except ( OSError, ValueError ):
+            return False
+        return len( readable ) == 0
+
+    def _checkout( self ):
+        if os.getpid() != self.pid:
+            # We've been forked; those connections belong to our parent
+            self.idle = collections.deque()
+            self.pid = os.getpid()
+        now = time.monotonic()
+        while len( self.idle ) > 0:
+            sock, lastused = self.idle.pop()
+            if ( now - lastused < self.maxidleage ) and self._healthy( sock ):
+                return sock, True
+            sock.close()
+        return self._connect(), False
+
+    def _checkin( self, sock ):
+        if len( self.idle ) < self.maxidle:
+            self.idle.append( ( sock, time.monotonic() ) )
+        else:
+            sock.close()
+
+    def request( self, verb, payload=b'', flags=0, timeout=None ):
+        # Send one frame to the flusher (see flusherproto.py) and return
+        #   the verb and payload of the flusher's reply.  If timeout is
+        #   given, wait that long for the reply instead of self.timeout.
+        sock, reused = self._checkout()
+        try:
+            try:
+                sock.settimeout( self.timeout if timeout is None else timeout )
+                flusherproto.send_frame( sock, verb, payload, flags )
+                respverb, _flags, resp = flusherproto.recv_frame( sock )
+            except ( ConnectionError, BrokenPipeError ):
+                if not reused:
+                    raise
+                # The flusher probably restarted since this connection was
+                #   last used; try again once on a new connection.
+                sock.close()
+                sock = self._connect()
+                sock.settimeout( self.timeout if timeout is None else timeout )
+                flusherproto.send_frame( sock, verb, payload, flags )
+                respverb, _flags, resp = flusherproto.recv_frame( sock )
+        except BaseException:
+            # Who knows what state the connection is in now
+            sock.close()
+            raise
+        self._checkin( sock )
+        return respverb, resp
+
+
+_flusher_pools = {}
+
+
+def flusher_pool( socket_file, timeout ):
+    if socket_file not in _flusher_pools:
+        _flusher_pools[ socket_file ] = FlusherConnectionPool( socket_file, timeout=timeout,
+                                                               maxidle=int( os.getenv( "KAFKA_PROXY_FLUSHER_POOL_SIZE",
+                                                                                       "8" ) ) )
+    return _flusher_pools[ socket_file ]
+
+
+class FlusherShards( ingest.ShardRouting ):
+    # The flusher shards (see ingest.ShardRouting), talked to over this
+    #   process' pooled connections
+    def __init__( self, socket_files, timeout, ringpaths=None, downtime=5 ):
+        # (This is the logger that flask.current_app.logger is, but it can
+        #   be used outside of a request.)
+        logger = logging.getLogger( __name__ )
+        rings = None if ringpaths is None else [ ingest.flusher_ring( r, logger ) for r in ringpaths ]
+        super().__init__( socket_files, timeout, rings, logger, downtime=downtime )
+        self.pools = [ flusher_pool( f, timeout ) for f in socket_files ]
+
+    def request( self, verb, payload=b'', flags=0, timeout=None, shard=None ):
+        # shard, if given, is the one to try first instead of the next one
+        #   round-robin
+        busy = None
+        lastex = None
+        for i in self.order( shard ):
+            try:
+                respverb, resp = self.pools[i].request( verb, payload, flags, timeout )
+            except ( ConnectionError, FileNotFoundError ) as ex:
+                self.unreachable( i, ex )
+                lastex = ex
+                continue
+            if self.settle( i, respverb, flags ):
+                return respverb, resp
+            busy = ( respverb, resp )
+
+        if busy is not None:
+            return busy
+        raise lastex
+
+    def send_messages( self, payload, nmsgs, topic=None, flags=0, wait=None, batchid=None ):
+        # Pass messages on to a flusher (see
+        #   ingest.ShardRouting.route_messages).  Returns the verb and
+        #   payload of the flusher's reply (or what it would have been).
+        reply, payload, flags, timeout, shard = self.route_messages( payload, nmsgs, topic, flags, wait, batchid )
+        if reply is not None:
+            return reply
+        return self.request( b'MSGS', payload, flags, timeout=timeout, shard=shard )
+
+    def broadcast( self, verb, payload=b'' ):
+        # Send the same frame to every shard.  Returns a list of
+        #   ( socket_file, verb, payload ) of the replies; verb is None and
+        #   payload is the exception if a shard couldn't be reached.
+        replies = []
+        for socket_file, pool in zip( self.socket_files, self.pools ):
+            try:
+                replies.append( ( socket_file, *pool.request( verb, payload ) ) )
+            except Exception as ex:
+                replies.append( ( socket_file, None, ex ) )
+        return replies
+
+
+_flusher_shards = {}
+
+
+def flusher_shards( socket_file, nshards, timeout, ringpath=None ):
+    # See ingest.shard_paths
+    if ( socket_file, nshards, ringpath ) not in _flusher_shards:
+        socket_files, ringpaths = ingest.shard_paths( socket_file, nshards, ringpath )
+        _flusher_shards[ ( socket_file, nshards, ringpath ) ] = FlusherShards( socket_files, timeout,
+                                                                               ringpaths=ringpaths )
+    return _flusher_shards[ ( socket_file, nshards, ringpath ) ]
+
+
+def _read_all( stream, limit ):
+    # All of stream, as a bytearray; raises compression.BodyTooLarge if
+    #   it's more than limit bytes
+    body = bytearray()
+    while True:
+        data = stream.read( 65536 )
+        if len( data ) == 0:
+            return body
+        body += data
+        if len( body ) > limit:
+            raise compression.BodyTooLarge( f"Body is more than the maximum of {limit} bytes" )
+
+
 class BaseHandleRequest( flask.views.View ):
     def __init__( self, *args, **kwargs ):
         super().__init__( *args, **kwargs )
-        self.token = os.getenv( "KAFKA_PROXY_TOKEN", "default-token-do-not-really-use-this" )
-        self.socket_file = os.getenv( "KAFKA_FLUSHER_SOCKET_PATH", "/tmp/flusher_socket" )
-        self.comm_timeout = 2
+        self.config = ingest.Config()
 
-    def send_done( self, sock ):
-        logger = flask.current_app.logger
+    def _shards( self ):
+        return flusher_shards( self.config.socket_file, self.config.nshards, self.config.comm_timeout,
+                               ringpath=self.config.ringpath )
 
-        sock.send( b'DONE' )
-        try:
-            resp = sock.recv( 256 )
-        except TimeoutError:
-            logger.error( "Timed out waiting for response from server after DONE." )
-            return False
-        if resp != b'ok':
-            logger.error( f"Got unexpected response {resp} from server after DONE." )
-            return False
+    def send_to_flusher( self, verb, payload=b'' ):
+        # Send one frame to a flusher (see flusherproto.py) over one of
+        #   this process' pooled connections and return the verb and
+        #   payload of the flusher's reply.
+        return self._shards().request( verb, payload )
 
-        return True
+    def send_messages_to_flusher( self, payload, nmsgs, topic=None, flags=0, wait=None, batchid=None ):
+        # Like send_to_flusher( b'MSGS', payload ), but may go through a
+        #   flusher's shared-memory ring instead.
+        return self._shards().send_messages( payload, nmsgs, topic, flags, wait, batchid )
+
+    def broadcast_to_flushers( self, verb, payload=b'' ):
+        return self._shards().broadcast( verb, payload )
 
 
 class HandleRequest( BaseHandleRequest ):
-    def __init__( self, *args, **kwargs ):
-        super().__init__( *args, **kwargs )
+    def forward_messages( self, post, payload, nmsgs, wait=None, status=None, batchid=None ):
+        # Send the messages in payload (which must be a valid MSGS payload)
+        #   of post (an ingest.Post) over to the flusher, which will send
+        #   them in batches via kafka producer to the kafka server.  Returns
+        #   ( err, duplicate ) (see ingest.flusher_reply).  The messages
+        #   count against the client's rate limits.
+        logger = flask.current_app.logger
 
-    def dispatch_request( self ):
-        if flask.request.headers.get( "x-kafka-proxy-token" ) != self.token:
-            return "Error, wrong x-kafka-proxy-token in HTTP headers", 500
-        if flask.request.content_type != "application/octet-stream":
-            return f"Error, expected application/octet-stream data, not {flask.request.content_type}", 500
+        ingest.rate_limiter( self.config.rate_limit_path ).charge( post.client, nmsgs, len( payload ) )
+        try:
+            logger.debug( f"Sending {nmsgs} messages to flusher..." )
+            t0 = time.perf_counter()
+            verb, resp = self.send_messages_to_flusher( payload, nmsgs, post.topic, post.flags, wait, batchid )
+            ingest.flusher_seconds.observe( time.perf_counter() - t0 )
+        except Exception as ex:
+            return ingest.flusher_failure( ex, logger ), False
+        return ingest.flusher_reply( verb, resp, len( payload ), nmsgs, wait, status, batchid, logger )
 
+    def dispatch_request( self, **kwargs ):
+        t0 = time.perf_counter()
+        try:
+            resp = self.handle_post( **kwargs )
+        except BaseException:
+            ingest.requests['500'].inc()
+            raise
+        ingest.request_seconds.observe( time.perf_counter() - t0 )
+        ingest.requests.get( str( resp[1] ), ingest.requests['other'] ).inc()
+        return resp
+
+    def handle_post( self, topic=None, schema=None ):
+        request = flask.request
         logger = flask.current_app.logger
+        err, post = ingest.check_post( self.config, request.headers, request.content_type, request.mimetype,
+                                       topic, schema )
+        if err is not None:
+            return err
 
-        # Extract the messages from the binary data sent in the POST.
-        #   All of this binary parsing makes me think I should just have
-        #   written this in C.  Or that maybe this is just overdone,
-        #   There might still be a python way (e.g. doing something with
-        #   the buffer protocol) to do this without copying.  But, as is,
-        #   I'm hoping this is more efficient than decoding base64 from
-        #   a json array.
-
-        ptr = 0
-        msgs = []
-        while ptr < len( flask.request.data ):
-            msgsize = int.from_bytes( flask.request.data[ptr:ptr+4], byteorder='little' )
-            ptr += 4
-            if ( ptr + msgsize ) > len( flask.request.data ):
-                logger.error( f"Got a {len(flask.request.data)}-byte message; "
-                              f"after parsing {len(msgs)} messages, received a "
-                              f"{msgsize} message at {ptr}, where there were only "
-                              f"{len(flask.request.data)-ptr} bytes left." )
-                now = datetime.datetime.now( tz=datetime.UTC ).isoformat()
-                return f"Error, mal-formed data at {now}", 500
-            msgs.append( b'MESG' + flask.request.data[ ptr:ptr+msgsize ] )
-            ptr += msgsize
-
-        # Send the messages over to the flusher, which will send
-        #  them in batches via kafka producer to the kafk server
-
-        sock = None
-        try:
-            sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM, 0 )
-            logger.debug( f"Trying to connect to socket at {self.socket_file}" )
-            sock.connect( self.socket_file )
-            sock.settimeout( self.comm_timeout )
-
-            logger.debug( f"Sending {len(msgs)} messages to flusher..." )
-            for msg in msgs:
-                nsent = sock.send( msg )
-                now = datetime.datetime.now( tz=datetime.UTC ).isoformat()
-                if nsent != len( msg ):
-                    logger.error( f"Only sent {nsent} of a {len(msg)}-byte message to flusher." )
-                    return f"Failed to send data to flusher at {now}", 500
-                try:
-                    resp = sock.recv( 256 )
-                except TimeoutError:
-                    logger.error( "Timeout waiting to hear from flusher" )
-                    return f"Conection to updater timed out at {now}.", 500
-                if resp == b'error':
-                    self.send_done( sock )
-                    return f"Error response from flusher at {now}", 500
-                elif resp != b'ok':
-                    logger.error( f"Unexpected response from flusher: {resp}" )
-                    return f"Unexpected response from flusher at {now}", 500
-
-            if not self.send_done( sock ):
-                now = datetime.datetime.now( tz=datetime.UTC ).isoformat()
-                return f"Error trying to tell the flusher we were done at {now}.", 500
-
-            rval = f"{len(msgs)} messages received", 200
-            return rval
+        if schema is not None:
+            return self.handle_avro( post, schema )
 
+        if post.encoding is not None:
+            # We don't know how big the body is until we decompress it, so
+            #   always stream compressed bodies.
+            try:
+                stream = compression.DecompressingReader( request.stream, post.encoding,
+                                                          self.config.max_decompressed_size )
+            except compression.CompressionError as ex:
+                return ingest.body_error( ex, logger )
+            return self.dispatch_stream( post, stream )
+
+        if ( request.content_length is None ) or ( request.content_length > self.config.stream_threshold ):
+            return self.dispatch_stream( post, request.stream )
+
+        # Everything is done through one memoryview of the body, and the
+        #   body goes to the flusher with sendmsg, so the messages never
+        #   get copied in this process.
+        data = memoryview( request.get_data( cache=True ) )
+        err, nmsgs = ingest.check_messages( data, post.flags, logger )
+        if err is not None:
+            return err
+
+        status = bytearray()
+        err, duplicate = self.forward_messages( post, data, nmsgs, post.wait, status, post.batchid )
+        if err is not None:
+            return err
+        return ingest.post_response( post, nmsgs, status, duplicate, logger )
+
+    def dispatch_stream( self, post, stream ):
+        # For big (or chunked, or compressed) POSTs: read the body a bit at
+        #   a time (see ingest.StreamedPost)
+        reader = flusherproto.MessageStreamReader( stream, chunk_size=self.config.stream_chunk_size,
+                                                   max_message_size=self.config.max_message_size )
+        return self.dispatch_chunks( post, reader )
+
+    def dispatch_chunks( self, post, chunks ):
+        # The rest of dispatch_stream: send each ( chunk, nmsgs ) of chunks
+        #   (an iterable, which may raise partway through) to the flusher
+        #   in turn, and return the response to the POST.
+        streamed = ingest.StreamedPost( post, flask.current_app.logger )
+        err = None
+        try:
+            for chunk, nmsgs in chunks:
+                chunkwait, chunkid = streamed.next_chunk( chunk )
+                err, duplicate = self.forward_messages( post, chunk, nmsgs, chunkwait, streamed.status, chunkid )
+                if err is not None:
+                    break
+                streamed.accepted( chunk, nmsgs, duplicate )
         except Exception as ex:
-            logger.exception( ex )
-            now = datetime.datetime.now( tz=datetime.UTC ).isoformat()
-            return f"Exception handling request at {now}", 500
+            err = streamed.failed( ex )
+        return streamed.response( err )
+
+    def handle_avro( self, post, schema ):
+        # For POSTs to /avro/<schema> (see ingest.check_avro).  The whole
+        #   body is read, and every record encoded, before any of them go
+        #   to the flusher; the encoded chunks then go like those of a
+        #   streamed POST (so with a batch ID, chunk n is batch
+        #   <batchid>/<n>).
+        request = flask.request
+        logger = flask.current_app.logger
+        err, avro = ingest.check_avro( self.config, request.headers, schema, logger )
+        if err is not None:
+            return err
+        parsed, schema_id = avro
 
-        finally:
-            if sock is not None:
-                sock.close()
+        try:
+            if post.encoding is not None:
+                stream = compression.DecompressingReader( request.stream, post.encoding, self.config.max_json_size )
+            elif ( request.content_length is not None ) and ( request.content_length > self.config.max_json_size ):
+                raise compression.BodyTooLarge( f"Body is {request.content_length} bytes, more than the "
+                                                f"maximum of {self.config.max_json_size}" )
+            else:
+                stream = request.stream
+            body = _read_all( stream, self.config.max_json_size )
+        except compression.CompressionError as ex:
+            return ingest.body_error( ex, logger )
+
+        t0 = time.perf_counter()
+        chunks = []
+        try:
+            for chunk in ingest.encode_avro( self.config, body, request.mimetype, parsed, schema_id ):
+                chunks.append( chunk )
+                # Encoding a big POST takes a while; let this worker's
+                #   other requests (greenlets) have a turn between chunks
+                time.sleep( 0 )
+        except avroencode.BadRecords as ex:
+            logger.error( f"Refusing Avro POST for schema {schema}: {ex}" )
+            return f"Error, {ex}", 400
+        ingest.parse_seconds.observe( time.perf_counter() - t0 )
+
+        return self.dispatch_chunks( post, chunks )
 
 
+class TopicRequest( BaseHandleRequest ):
+    # Base class for requests that change the topic map (see
+    #   topicmap.py).  Subclasses set verb (what to send the flushers; see
+    #   ingest.TOPIC_VERBS).
+    verb = None
 
-class ChangeTopic( BaseHandleRequest ):
     def dispatch_request( self, topic ):
-        if flask.request.headers.get( "x-kafka-proxy-token" ) != self.token:
-            return "Error, wrong x-kafka-proxy-token in HTTP headers", 500
+        err = ingest.check_topic_change( self.config, flask.request.headers, self.verb, topic )
+        if err is not None:
+            return err
+        replies = self.broadcast_to_flushers( self.verb, topic.encode( 'utf-8' ) )
+        return ingest.topic_change_response( self.verb, topic, replies, self.config.nshards,
+                                             flask.current_app.logger )
 
-        logger = flask.current_app.logger
 
-        sock = None
-        try:
-            sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM, 0 )
-            logger.debug( f"Trying to connect to socket at {self.socket_file}" )
-            sock.connect( self.socket_file )
-            sock.settimeout( self.comm_timeout )
+class ChangeTopic( TopicRequest ):
+    # Change the default topic
+    verb = ingest.TOPIC_VERBS['topic']
+
+
+class AllowTopic( TopicRequest ):
+    verb = ingest.TOPIC_VERBS['allowtopic']
 
-            msg = b'TPIC' + topic.encode('utf-8')
-            sock.send( msg  )
-            now = datetime.datetime.now( tz=datetime.UTC )
-            try:
-                resp = sock.recv( 256 )
-                logger.debug( f"Got response from topic change from server: {resp}" )
-            except TimeoutError:
-                logger.error( "Timed out waiting to hear from flusher about topic change." )
-                return "Timed out waiting for topic change response.", 500
-            if resp != b'ok':
-                logger.error( f"Unexpected response from flusher after topic change: {resp}" )
-                return "Unexpected response from flusher", 500
-
-            if not self.send_done( sock ):
-                now = datetime.datetime.now( tz=datetime.UTC ).isoformat()
-                return f"Error trying to tell the flusher we were done after topic change at {now}", 500
-
-        finally:
-            if sock is not None:
-                sock.close()
 
-        return f"Topic changed to {topic}", 200
+class DisallowTopic( TopicRequest ):
+    verb = ingest.TOPIC_VERBS['disallowtopic']
+
+
+class MetricsRequest( BaseHandleRequest ):
+    # Prometheus metrics (see ingest.metrics_response)
+    def dispatch_request( self ):
+        err = ingest.check_metrics( self.config, flask.request.headers )
+        if err is not None:
+            return err
+        return ingest.metrics_response( self.broadcast_to_flushers( b'STAT' ), flask.current_app.logger )
 
 
 # ======================================================================
@@ -159,4 +406,14 @@ app = flask.Flask( __name__, instance_relative_config=True )
 app.logger.setLevel( _loglevel )
 
 app.add_url_rule( "/", view_func=HandleRequest.as_view("/"), methods=["POST"], strict_slashes=False )
+app.add_url_rule( "/topics/<topic>", view_func=HandleRequest.as_view("/topics"), methods=["POST"],
+                  strict_slashes=False )
+app.add_url_rule( "/avro/<schema>", view_func=HandleRequest.as_view("/avro"), methods=["POST"], strict_slashes=False )
+app.add_url_rule( "/topics/<topic>/avro/<schema>", view_func=HandleRequest.as_view("/topics/avro"), methods=["POST"],
+                  strict_slashes=False )
 app.add_url_rule( "/topic/<topic>", view_func=ChangeTopic.as_view("/topic"), methods=["POST"], strict_slashes=False )
+app.add_url_rule( "/allowtopic/<topic>", view_func=AllowTopic.as_view("/allowtopic"), methods=["POST"],
+                  strict_slashes=False )
+app.add_url_rule( "/disallowtopic/<topic>", view_func=DisallowTopic.as_view("/disallowtopic"), methods=["POST"],
+                  strict_slashes=False )
+app.add_url_rule( "/metrics", view_func=MetricsRequest.as_view("/metrics"), methods=["GET"], strict_slashes=False )